@@ -0,0 +1,275 @@
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import tempfile
+import resource
+import threading
+import numpy as np
+import cv2
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+# Metrics where a larger value is a regression; everything else compared is "higher is better"
+LOWER_IS_BETTER = ('p50_ms', 'p95_ms', 'p99_ms', 'peak_rss_mb', 'cpu_seconds')
+
+class StubDriveService:
+    # Stands in for the googleapiclient Drive resource: records uploads instead of sending them
+    def __init__(self):
+        self.files_created = 0
+        self.uploaded_bytes = 0
+
+    def files(self):
+        return self
+
+    def create(self, body=None, media_body=None, fields=None):
+        self.files_created += 1
+        if media_body is not None:
+            self.uploaded_bytes += media_body.size()
+        return self
+
+    def execute(self):
+        return {"id": f"stub-{self.files_created}"}
+
+class RssSampler:
+    # ru_maxrss cannot be reset between stages, so each stage samples its own peak from /proc
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_kb = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _current_kb(self):
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+        except (OSError, ValueError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.peak_kb = max(self.peak_kb, self._current_kb())
+
+    def __enter__(self):
+        self.peak_kb = self._current_kb()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+
+def directory_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+def percentiles(latencies_ms):
+    if not latencies_ms:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    values = np.array(latencies_ms)
+    return {f"p{p}_ms": round(float(np.percentile(values, p)), 2) for p in (50, 95, 99)}
+
+def run_stage(name, frames, output_paths, body):
+    # Runs body(latencies) and reports throughput, latency percentiles, memory, CPU and bytes written
+    latencies = []
+    times_before = os.times()
+    bytes_before = sum(directory_bytes(p) for p in output_paths)
+    start = time.perf_counter()
+    with RssSampler() as sampler:
+        body(latencies)
+    elapsed = time.perf_counter() - start
+    times_after = os.times()
+    cpu = (times_after.user - times_before.user + times_after.system - times_before.system
+           + times_after.children_user - times_before.children_user
+           + times_after.children_system - times_before.children_system)
+    return {
+        "stage": name,
+        "seconds": round(elapsed, 3),
+        "fps": round(frames / elapsed, 2) if elapsed > 0 else None,
+        **percentiles(latencies),
+        "peak_rss_mb": round(sampler.peak_kb / 1024, 1),
+        "cpu_seconds": round(cpu, 3),
+        "bytes_written": sum(directory_bytes(p) for p in output_paths) - bytes_before,
+    }
+
+def draw_face(frame, cx, cy, size):
+    cv2.ellipse(frame, (cx, cy), (size, int(size * 1.3)), 0, 0, 360, (140, 170, 220), -1)
+    for dx in (-size // 3, size // 3):
+        cv2.circle(frame, (cx + dx, cy - size // 4), max(2, size // 8), (40, 40, 40), -1)
+    cv2.ellipse(frame, (cx, cy + size // 2), (size // 3, max(2, size // 8)), 0, 0, 180, (60, 60, 150), -1)
+
+def generate_video(path, resolution, seconds, fps, num_faces=2, seed=0):
+    # OpenCV-drawn scene: textured background, a moving gradient and faces drifting across it
+    width, height = (int(x) for x in resolution.split('x'))
+    rng = np.random.default_rng(seed)
+    background = cv2.GaussianBlur(rng.integers(0, 255, (height, width, 3), dtype=np.uint8), (0, 0), 8)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    size = max(12, height // 10)
+    starts = rng.uniform(0, 1, size=(num_faces, 2))
+    velocities = rng.uniform(-0.01, 0.01, size=(num_faces, 2))
+    frame_count = int(seconds * fps)
+    for i in range(frame_count):
+        frame = np.roll(background, i * 2, axis=1)
+        for (sx, sy), (vx, vy) in zip(starts, velocities):
+            cx = int(((sx + vx * i) % 1.0) * (width - 2 * size) + size)
+            cy = int(((sy + vy * i) % 1.0) * (height - 3 * size) + 1.5 * size)
+            draw_face(frame, cx, cy, size)
+        writer.write(frame)
+    writer.release()
+    return frame_count
+
+def run_scenario(args, resolution, seconds, work_dir):
+    from video_decoder.src.decoder import VideoDecoderService
+    from video_process.src.process import ProcessorService
+    from video_encoder.src.encoder import EncoderService
+
+    job_id = f"bench_{resolution}_{seconds}s"
+    quality_levels = args.quality_levels or [resolution]
+    video_path = os.path.join(work_dir, f"{job_id}.mp4")
+    frames = generate_video(video_path, resolution, seconds, args.fps)
+    total_frames = frames * len(quality_levels)
+    metadata = {"fps": args.fps, "width": int(resolution.split('x')[0]), "height": int(resolution.split('x')[1])}
+    processing_options = {"face_detector": args.face_detector}
+    user_settings = {"quality_levels": quality_levels, "processing_options": processing_options}
+
+    decoded_root = os.path.join(work_dir, 'decoded_storage')
+    processed_root = os.path.join(work_dir, 'processed_frames')
+    encoded_root = os.path.join(work_dir, 'encoder_output')
+    enhanced_root = os.path.join(work_dir, 'enhancement', 'src', 'enhanced_frames')
+    decoded_folder = os.path.join(decoded_root, f"decoded_frames_{job_id}")
+
+    decoder = VideoDecoderService(None, None, None, decoded_root)
+    drive = StubDriveService()
+    decoder.drive_service_upload = drive
+    results = []
+
+    def decode(latencies):
+        os.makedirs(decoded_folder, exist_ok=True)
+        for quality in quality_levels:
+            start = time.perf_counter()
+            if not decoder.process_video_cpu(video_path, metadata, dict(user_settings, quality_levels=[quality]), decoded_folder):
+                raise RuntimeError(f"Decoding {quality} failed")
+            latencies.append((time.perf_counter() - start) * 1000)
+        if args.upload:
+            decoder.upload_frames(decoded_folder, job_id)
+    results.append(run_stage('decode', total_frames, [decoded_root], decode))
+    if args.upload:
+        results[-1].update(uploaded_bytes=drive.uploaded_bytes, uploaded_files=drive.files_created)
+
+    processor = ProcessorService(decoded_root, processed_root)
+    # Encoding is measured as its own stage below rather than through the HTTP hand-off
+    processor.notify_encoder = lambda *a, **kw: None
+    manager = processor.distribution_manager
+    distribute_frame = manager.distribute_frame
+
+    def process(latencies):
+        def timed_distribute(*a, **kw):
+            start = time.perf_counter()
+            try:
+                return distribute_frame(*a, **kw)
+            finally:
+                latencies.append((time.perf_counter() - start) * 1000)
+        manager.distribute_frame = timed_distribute
+        try:
+            processor.process_video(job_id, metadata, quality_levels, 'normal', args.pipeline, processing_options)
+        finally:
+            manager.distribute_frame = distribute_frame
+    results.append(run_stage('process', total_frames, [processed_root, enhanced_root, 'processed_frames'], process))
+    report_path = os.path.join(processed_root, f"processed_frames_{job_id}", "job_report.json")
+    if os.path.exists(report_path):
+        # Count what the processor actually handled rather than what was decoded
+        with open(report_path) as f:
+            processed = json.load(f)['frames']
+        results[-1].update(processed_frames=processed, fps=round(processed / results[-1]['seconds'], 2))
+
+    if 'enhance' in args.pipeline:
+        encoder = EncoderService(output_dir=encoded_root)
+
+        def encode(latencies):
+            stats = encoder._encode_video(job_id, metadata, {"codec": args.codec, "preset": args.preset}) or {}
+            latencies.extend(s['seconds'] * 1000 for s in stats.values() if s)
+        results.append(run_stage('encode', total_frames, [encoded_root], encode))
+
+    for result in results:
+        result.update(resolution=resolution, seconds=seconds, frames=frames, quality_levels=quality_levels)
+        print(json.dumps(result))
+    return results
+
+def compare_to_baseline(results, baseline, threshold):
+    baseline_index = {(r['resolution'], r['seconds'], r['stage']): r for r in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        reference = baseline_index.get((result['resolution'], result['seconds'], result['stage']))
+        if not reference:
+            continue
+        for metric in ('fps',) + LOWER_IS_BETTER:
+            current, previous = result.get(metric), reference.get(metric)
+            if current is None or not previous:
+                continue
+            change = (current - previous) / previous
+            worse = change > threshold if metric in LOWER_IS_BETTER else change < -threshold
+            if worse:
+                regressions.append({
+                    "resolution": result['resolution'], "seconds": result['seconds'], "stage": result['stage'],
+                    "metric": metric, "baseline": previous, "current": current, "change": round(change, 3)
+                })
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end decode/process/encode benchmark on synthetic videos")
+    parser.add_argument('--resolutions', nargs='+', default=['640x360', '1280x720'])
+    parser.add_argument('--durations', nargs='+', type=float, default=[2.0])
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--quality-levels', nargs='+', help="Ladder to decode into; defaults to the source resolution")
+    parser.add_argument('--pipeline', nargs='+', default=['enhance', 'recognize_faces'])
+    parser.add_argument('--face-detector', default='haar', help="Detector backend used by recognize_faces")
+    parser.add_argument('--codec', default='libx264')
+    parser.add_argument('--preset', default='veryfast')
+    parser.add_argument('--upload', action='store_true', help="Also time the decoder's upload walk against a stub Drive")
+    parser.add_argument('--work-dir', help="Keep intermediate files here instead of a temporary directory")
+    parser.add_argument('--json', default='pipeline_bench.json', help="Write results to this file")
+    parser.add_argument('--baseline', help="Compare against a results file from an earlier run")
+    parser.add_argument('--threshold', type=float, default=0.15, help="Allowed relative regression per metric")
+    args = parser.parse_args()
+
+    output_path = os.path.abspath(args.json)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    work_dir = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix='pipeline_bench_')
+    # The services resolve their sibling directories relative to <service>/src, so run from an equivalent spot
+    run_dir = os.path.join(work_dir, 'bench', 'src')
+    os.makedirs(run_dir, exist_ok=True)
+    previous_cwd = os.getcwd()
+    os.chdir(run_dir)
+
+    results = []
+    try:
+        for resolution in args.resolutions:
+            for seconds in args.durations:
+                results.extend(run_scenario(args, resolution, seconds, work_dir))
+    finally:
+        os.chdir(previous_cwd)
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {"created": time.strftime('%Y-%m-%dT%H:%M:%S'), "cpu_count": os.cpu_count(), "results": results}
+    exit_code = 0
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        report['regressions'] = compare_to_baseline(results, baseline, args.threshold)
+        for regression in report['regressions']:
+            print(f"REGRESSION {regression['stage']} {regression['resolution']} {regression['seconds']}s "
+                  f"{regression['metric']}: {regression['baseline']} -> {regression['current']} ({regression['change']:+.1%})")
+        exit_code = 1 if report['regressions'] else 0
+
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    sys.exit(exit_code)
+
+if __name__ == "__main__":
+    main()
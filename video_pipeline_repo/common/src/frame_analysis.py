@@ -0,0 +1,60 @@
+import numpy as np
+import cv2
+
+THUMBNAIL_SIZE = (64, 36)
+
+def make_thumbnail(frame, size=THUMBNAIL_SIZE):
+    # Downscale before the colour conversion so the conversion only touches a few thousand pixels
+    small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+    return small
+
+class SceneChangeDetector:
+    def __init__(self, threshold=0.35, bins=32, thumbnail_size=THUMBNAIL_SIZE):
+        self.threshold = threshold
+        self.bins = bins
+        self.thumbnail_size = thumbnail_size
+        self.reference_histogram = None
+
+    def histogram(self, frame):
+        thumbnail = make_thumbnail(frame, self.thumbnail_size)
+        hist = cv2.calcHist([thumbnail], [0], None, [self.bins], [0, 256]).ravel()
+        return hist / max(hist.sum(), 1.0)
+
+    def distance(self, histogram):
+        if self.reference_histogram is None:
+            return 1.0
+        # Half the L1 distance between normalised histograms, so 0 is identical and 1 is disjoint
+        return float(np.abs(histogram - self.reference_histogram).sum() / 2)
+
+    def check(self, frame):
+        histogram = self.histogram(frame)
+        distance = self.distance(histogram)
+        return distance >= self.threshold, distance, histogram
+
+    def set_reference(self, histogram):
+        self.reference_histogram = histogram
+
+    def reset(self):
+        self.reference_histogram = None
+
+class FrameSimilarityGate:
+    def __init__(self, mean_threshold=1.0, max_pixel_threshold=12, thumbnail_size=THUMBNAIL_SIZE):
+        self.mean_threshold = mean_threshold
+        self.max_pixel_threshold = max_pixel_threshold
+        self.thumbnail_size = thumbnail_size
+        self.reference = None
+        self.last_thumbnail = None
+
+    def is_duplicate(self, frame):
+        # Compared against the last frame that was actually processed, so slow drift cannot
+        # accumulate across a long run of reused frames
+        self.last_thumbnail = make_thumbnail(frame, self.thumbnail_size)
+        if self.reference is None:
+            return False
+        diff = cv2.absdiff(self.last_thumbnail, self.reference)
+        return float(diff.mean()) <= self.mean_threshold and int(diff.max()) <= self.max_pixel_threshold
+
+    def update_reference(self):
+        self.reference = self.last_thumbnail
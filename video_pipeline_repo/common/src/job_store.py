@@ -0,0 +1,212 @@
+import os
+import time
+import json
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# sqlite:///<path> or memory://; each service keys its rows by its own name, so one file can be shared
+JOB_STORE_URL = os.environ.get('PIPELINE_JOB_STORE', 'sqlite:///job_store/jobs.db')
+# Frames between checkpoint writes; a restart redoes at most this many frames per quality
+CHECKPOINT_INTERVAL = int(os.environ.get('PIPELINE_CHECKPOINT_FRAMES', '50'))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+UNFINISHED_STATES = (QUEUED, RUNNING)
+
+class JobStore:
+    # Backend interface: job state per (service, job_id) plus per-quality progress checkpoints
+    def enqueue(self, service, job_id, payload):
+        raise NotImplementedError
+
+    def set_state(self, service, job_id, state, error=None):
+        raise NotImplementedError
+
+    def get_job(self, service, job_id):
+        raise NotImplementedError
+
+    def unfinished_jobs(self, service):
+        raise NotImplementedError
+
+    def checkpoint(self, service, job_id, quality, frames_done, completed=False):
+        raise NotImplementedError
+
+    def checkpoints(self, service, job_id):
+        raise NotImplementedError
+
+    def clear_checkpoints(self, service, job_id):
+        raise NotImplementedError
+
+class MemoryJobStore(JobStore):
+    # Same behaviour without durability; for benchmarks and single-shot runs
+    def __init__(self):
+        self.jobs = {}
+        self.progress = {}
+        self.lock = threading.Lock()
+
+    def enqueue(self, service, job_id, payload):
+        now = time.time()
+        with self.lock:
+            self.jobs[(service, job_id)] = {"job_id": job_id, "state": QUEUED, "payload": payload, "error": None,
+                                            "created_at": now, "updated_at": now}
+
+    def set_state(self, service, job_id, state, error=None):
+        with self.lock:
+            job = self.jobs.get((service, job_id))
+            if job is not None:
+                job.update(state=state, error=error, updated_at=time.time())
+
+    def get_job(self, service, job_id):
+        with self.lock:
+            job = self.jobs.get((service, job_id))
+            return dict(job) if job else None
+
+    def unfinished_jobs(self, service):
+        with self.lock:
+            jobs = [dict(job) for (s, _), job in self.jobs.items() if s == service and job['state'] in UNFINISHED_STATES]
+        return sorted(jobs, key=lambda job: job['created_at'])
+
+    def checkpoint(self, service, job_id, quality, frames_done, completed=False):
+        with self.lock:
+            self.progress.setdefault((service, job_id), {})[quality] = {"frames_done": frames_done, "completed": completed}
+
+    def checkpoints(self, service, job_id):
+        with self.lock:
+            return {q: dict(c) for q, c in self.progress.get((service, job_id), {}).items()}
+
+    def clear_checkpoints(self, service, job_id):
+        with self.lock:
+            self.progress.pop((service, job_id), None)
+
+class SqliteJobStore(JobStore):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            service TEXT NOT NULL,
+            job_id TEXT NOT NULL,
+            state TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (service, job_id)
+        );
+        CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (service, state, created_at);
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            service TEXT NOT NULL,
+            job_id TEXT NOT NULL,
+            quality TEXT NOT NULL,
+            frames_done INTEGER NOT NULL,
+            completed INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (service, job_id, quality)
+        );
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        # One connection shared by the service's threads; writes are tiny, so a lock is cheaper than a pool
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.lock = threading.Lock()
+        with self.lock:
+            # WAL lets a reader (another service sharing the file) run alongside the writer, and
+            # synchronous=NORMAL only syncs at checkpoints, which is durable enough for progress markers
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript(self.SCHEMA)
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def enqueue(self, service, job_id, payload):
+        now = time.time()
+        self._execute(
+            "INSERT INTO jobs (service, job_id, state, payload, error, created_at, updated_at) VALUES (?, ?, ?, ?, NULL, ?, ?) "
+            "ON CONFLICT (service, job_id) DO UPDATE SET state = excluded.state, payload = excluded.payload, "
+            "error = NULL, updated_at = excluded.updated_at",
+            (service, job_id, QUEUED, json.dumps(payload, default=str), now, now))
+
+    def set_state(self, service, job_id, state, error=None):
+        self._execute("UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE service = ? AND job_id = ?",
+                      (state, error, time.time(), service, job_id))
+
+    def _row_to_job(self, row):
+        job_id, state, payload, error, created_at, updated_at = row
+        return {"job_id": job_id, "state": state, "payload": json.loads(payload), "error": error,
+                "created_at": created_at, "updated_at": updated_at}
+
+    def get_job(self, service, job_id):
+        rows = self._execute("SELECT job_id, state, payload, error, created_at, updated_at FROM jobs "
+                             "WHERE service = ? AND job_id = ?", (service, job_id))
+        return self._row_to_job(rows[0]) if rows else None
+
+    def unfinished_jobs(self, service):
+        placeholders = ', '.join('?' for _ in UNFINISHED_STATES)
+        rows = self._execute(f"SELECT job_id, state, payload, error, created_at, updated_at FROM jobs "
+                             f"WHERE service = ? AND state IN ({placeholders}) ORDER BY created_at",
+                             (service, *UNFINISHED_STATES))
+        return [self._row_to_job(row) for row in rows]
+
+    def checkpoint(self, service, job_id, quality, frames_done, completed=False):
+        self._execute(
+            "INSERT INTO checkpoints (service, job_id, quality, frames_done, completed, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (service, job_id, quality) DO UPDATE SET frames_done = excluded.frames_done, "
+            "completed = excluded.completed, updated_at = excluded.updated_at",
+            (service, job_id, quality, frames_done, int(completed), time.time()))
+
+    def checkpoints(self, service, job_id):
+        rows = self._execute("SELECT quality, frames_done, completed FROM checkpoints WHERE service = ? AND job_id = ?",
+                             (service, job_id))
+        return {quality: {"frames_done": frames_done, "completed": bool(completed)} for quality, frames_done, completed in rows}
+
+    def clear_checkpoints(self, service, job_id):
+        self._execute("DELETE FROM checkpoints WHERE service = ? AND job_id = ?", (service, job_id))
+
+def open_job_store(url=JOB_STORE_URL):
+    if url.startswith('memory://'):
+        return MemoryJobStore()
+    if url.startswith('sqlite:///'):
+        return SqliteJobStore(url[len('sqlite:///'):])
+    raise ValueError(f"Unsupported job store URL {url}; use sqlite:///<path> or memory://")
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_job_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = open_job_store()
+        return _store
+
+class FrameCheckpointer:
+    # Records a quality's progress every CHECKPOINT_INTERVAL frames; callers advance it only once a frame's output is written
+    def __init__(self, store, service, job_id, quality, start_frame=0, interval=CHECKPOINT_INTERVAL):
+        self.store = store
+        self.service = service
+        self.job_id = job_id
+        self.quality = quality
+        self.interval = max(1, interval)
+        self.last_saved = start_frame
+
+    def advance(self, frames_done):
+        if frames_done - self.last_saved >= self.interval:
+            self._save(frames_done)
+
+    def complete(self, frames_done):
+        self._save(frames_done, completed=True)
+
+    def _save(self, frames_done, completed=False):
+        try:
+            self.store.checkpoint(self.service, self.job_id, self.quality, frames_done, completed)
+            self.last_saved = frames_done
+        except Exception as e:
+            # Losing a checkpoint only costs redone work after a restart; never fail the frame for it
+            logger.warning(f"Could not checkpoint job {self.job_id}, {self.quality} at frame {frames_done}: {str(e)}")
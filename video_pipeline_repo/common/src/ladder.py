@@ -0,0 +1,142 @@
+import os
+import logging
+from dataclasses import dataclass
+
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+
+# Rung sizes name the short side of the frame, so portrait sources get the same ladder turned on its side
+DEFAULT_RUNG_HEIGHTS = (360, 480, 720, 1080)
+COMPLEXITY_SAMPLE_INTERVAL = 30
+COMPLEXITY_THUMBNAIL_SIZE = (320, 180)
+# Mean gradient magnitude and mean frame difference (0-255 scale) that count as fully complex content
+SPATIAL_NORM = 40.0
+TEMPORAL_NORM = 25.0
+
+def _env_heights():
+    value = os.environ.get('PIPELINE_LADDER_HEIGHTS')
+    if not value:
+        return DEFAULT_RUNG_HEIGHTS
+    return tuple(sorted(int(h) for h in value.split(',') if h.strip()))
+
+@dataclass
+class LadderPolicy:
+    rung_heights: tuple = DEFAULT_RUNG_HEIGHTS
+    # Smallest pixel-count ratio allowed between neighbouring rungs: complex content gets the dense end,
+    # simple content (slides, talking heads) the sparse end, since its low rungs already look like the top one
+    dense_step: float = 1.7
+    sparse_step: float = 3.0
+    max_rungs: int = 4
+
+def policy_from_env():
+    return LadderPolicy(
+        rung_heights=_env_heights(),
+        dense_step=float(os.environ.get('PIPELINE_LADDER_DENSE_STEP', '1.7')),
+        sparse_step=float(os.environ.get('PIPELINE_LADDER_SPARSE_STEP', '3.0')),
+        max_rungs=int(os.environ.get('PIPELINE_LADDER_MAX_RUNGS', '4')),
+    )
+
+def _even(value):
+    # libx264 with yuv420p rejects odd dimensions
+    return max(2, int(round(value / 2.0)) * 2)
+
+def parse_quality(quality):
+    width, height = (int(x) for x in quality.split('x'))
+    return width, height
+
+def rung_for(short_side, source_width, source_height):
+    # Scales the source to the given short side, keeping its aspect ratio
+    if source_width >= source_height:
+        return f"{_even(short_side * source_width / source_height)}x{_even(short_side)}"
+    return f"{_even(short_side)}x{_even(short_side * source_height / source_width)}"
+
+def _source_size(metadata):
+    width = int((metadata or {}).get('width') or 0)
+    height = int((metadata or {}).get('height') or 0)
+    return (width, height) if width > 0 and height > 0 else (None, None)
+
+def select_ladder(metadata, complexity=None, policy=None):
+    # Returns "WxH" rungs, smallest first, that never exceed the source and keep its aspect ratio
+    policy = policy or policy_from_env()
+    width, height = _source_size(metadata)
+    if width is None:
+        logger.warning("Source size unknown; using the full default ladder")
+        return [f"{_even(h * 16 / 9)}x{h}" for h in policy.rung_heights]
+
+    source_short = min(width, height)
+    top_short = min(source_short, max(policy.rung_heights))
+    candidates = sorted({h for h in policy.rung_heights if h < top_short} | {top_short}, reverse=True)
+
+    complexity = 1.0 if complexity is None else min(1.0, max(0.0, complexity))
+    min_step = policy.sparse_step - (policy.sparse_step - policy.dense_step) * complexity
+    kept = [candidates[0]]
+    for short_side in candidates[1:]:
+        if len(kept) >= policy.max_rungs:
+            break
+        # Rungs are compared by pixel count, which is what decode, stage and encode time scale with
+        if (kept[-1] / short_side) ** 2 >= min_step:
+            kept.append(short_side)
+
+    ladder = [rung_for(short_side, width, height) for short_side in reversed(kept)]
+    logger.info(f"Selected ladder {ladder} for a {width}x{height} source (complexity {complexity:.2f})")
+    return ladder
+
+def fit_ladder(quality_levels, metadata):
+    # For ladders requested explicitly: clamps each rung to the source and fixes its aspect ratio, but keeps
+    # the requested spacing; rungs that end up the same size are merged
+    width, height = _source_size(metadata)
+    if width is None:
+        return list(quality_levels)
+    source_short = min(width, height)
+    fitted = []
+    for quality in quality_levels:
+        short_side = min(min(parse_quality(quality)), source_short)
+        rung = rung_for(short_side, width, height)
+        if rung not in fitted:
+            fitted.append(rung)
+    if fitted != list(quality_levels):
+        logger.info(f"Fitted requested ladder {list(quality_levels)} to the {width}x{height} source: {fitted}")
+    return sorted(fitted, key=lambda q: parse_quality(q)[0] * parse_quality(q)[1])
+
+def split_ladder(quality_levels, pipeline_config, processing_options):
+    # Returns the rungs to decode and process, and the rungs derived from the top one. Deriving downscales
+    # enhanced frames, so it needs the enhance stage; the decoder and the processor both decide through here
+    # so the processor never looks for a rung the decoder skipped
+    if not (processing_options or {}).get('derive_ladder') or len(quality_levels) < 2 or 'enhance' not in pipeline_config:
+        return list(quality_levels), []
+    top_quality = max(quality_levels, key=lambda q: parse_quality(q)[0] * parse_quality(q)[1])
+    return [top_quality], [q for q in quality_levels if q != top_quality]
+
+class ComplexityEstimator:
+    # Fed from a pass that already reads every frame; looks at one frame per interval, on a thumbnail
+    def __init__(self, sample_interval=COMPLEXITY_SAMPLE_INTERVAL, thumbnail_size=COMPLEXITY_THUMBNAIL_SIZE):
+        self.sample_interval = max(1, sample_interval)
+        self.thumbnail_size = thumbnail_size
+        self.frames_seen = 0
+        self.spatial = []
+        self.temporal = []
+        self.previous = None
+
+    def update(self, frame):
+        self.frames_seen += 1
+        if (self.frames_seen - 1) % self.sample_interval:
+            return
+        small = cv2.resize(frame, self.thumbnail_size, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+        gray = gray.astype(np.float32)
+        gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+        gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+        self.spatial.append(float(cv2.magnitude(gx, gy).mean()))
+        if self.previous is not None:
+            self.temporal.append(float(np.abs(gray - self.previous).mean()))
+        self.previous = gray
+
+    def score(self):
+        # 0 for flat, static content up to 1 for detailed, fast-moving content; None if nothing was sampled
+        if not self.spatial:
+            return None
+        spatial = min(1.0, np.mean(self.spatial) / SPATIAL_NORM)
+        temporal = min(1.0, np.mean(self.temporal) / TEMPORAL_NORM) if self.temporal else 0.0
+        return round(float(0.5 * spatial + 0.5 * temporal), 3)
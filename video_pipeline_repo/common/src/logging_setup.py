@@ -0,0 +1,175 @@
+import os
+import sys
+import time
+import json
+import atexit
+import logging
+import threading
+from queue import Queue, Full
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_LEVEL = os.environ.get('PIPELINE_LOG_LEVEL', 'INFO').upper()
+# 'text' keeps the familiar line format with key=value fields appended; 'json' emits one object per line
+LOG_OUTPUT = os.environ.get('PIPELINE_LOG_OUTPUT', 'text')
+LOG_QUEUE_SIZE = int(os.environ.get('PIPELINE_LOG_QUEUE_SIZE', '10000'))
+DEFAULT_RATE_INTERVAL = float(os.environ.get('PIPELINE_LOG_RATE_INTERVAL', '5'))
+# A rate-limited key that has not logged for this many intervals is forgotten
+STALE_RATE_INTERVALS = 4
+STRUCTURED_FIELDS = ('job_id', 'stage', 'quality', 'frame')
+
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, service_name, output=LOG_OUTPUT):
+        super().__init__(LOG_FORMAT)
+        self.service_name = service_name
+        self.output = output
+
+    def format(self, record):
+        fields = {name: getattr(record, name) for name in STRUCTURED_FIELDS if getattr(record, name, None) is not None}
+        if self.output == 'json':
+            entry = {
+                "time": self.formatTime(record),
+                "level": record.levelname,
+                "service": self.service_name,
+                "logger": record.name,
+                "message": record.getMessage(),
+                **fields,
+            }
+            if record.exc_info:
+                entry['exception'] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+
+        line = super().format(record)
+        if not fields:
+            return line
+        # Fields go on the first line so a traceback below it stays readable
+        first, _, rest = line.partition('\n')
+        first += ' ' + ' '.join(f"{name}={value}" for name, value in fields.items())
+        return first + ('\n' + rest if rest else '')
+
+class NonBlockingQueueHandler(QueueHandler):
+    # Worker threads only pay for an enqueue; when the writer falls behind records are dropped and counted
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Merge the arguments now, since they may change once the caller moves on, but leave the
+        # timestamp and traceback formatting to the listener thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+            return
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            notice = logging.LogRecord(record.name, logging.WARNING, __file__, 0,
+                                       f"Dropped {dropped} log records; the log queue was full", None, None)
+            try:
+                self.queue.put_nowait(notice)
+            except Full:
+                self.dropped += dropped
+
+_listener = None
+_formatter = None
+_configure_lock = threading.Lock()
+
+def configure_logging(service_name, level=LOG_LEVEL):
+    # Replaces logging.basicConfig in every service: the root logger feeds a queue drained by one thread
+    global _listener, _formatter
+    with _configure_lock:
+        if _listener is None:
+            log_queue = Queue(maxsize=LOG_QUEUE_SIZE)
+            _formatter = StructuredFormatter(service_name)
+            stream = logging.StreamHandler(sys.stdout)
+            stream.setFormatter(_formatter)
+            root = logging.getLogger()
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+            root.addHandler(NonBlockingQueueHandler(log_queue))
+            _listener = QueueListener(log_queue, stream)
+            _listener.start()
+            # Flush whatever is still queued when the process exits
+            atexit.register(_listener.stop)
+        else:
+            # Stage modules configure logging on import too; the service entry point imported last names it
+            _formatter.service_name = service_name
+        logging.getLogger().setLevel(level)
+
+class RateLimitedLogger:
+    # For per-frame messages: at most one line per key per interval, reporting how many were suppressed
+    def __init__(self, logger, interval=DEFAULT_RATE_INTERVAL):
+        self.logger = logger
+        self.interval = interval
+        self.state = {}
+        self.next_sweep = 0.0
+        self.lock = threading.Lock()
+
+    def log(self, level, key, message, *args, **fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        with self.lock:
+            if now >= self.next_sweep:
+                # Keys name jobs and folders that stop logging once they finish, so entries idle for a few
+                # intervals are dropped rather than kept for the life of the process
+                self.state = {k: v for k, v in self.state.items() if now - v[0] < STALE_RATE_INTERVALS * self.interval}
+                self.next_sweep = now + self.interval
+            last, suppressed = self.state.get(key, (None, 0))
+            if last is not None and now - last < self.interval:
+                self.state[key] = (last, suppressed + 1)
+                return
+            self.state[key] = (now, 0)
+        if suppressed:
+            message += f" ({suppressed} similar messages suppressed)"
+        self.logger.log(level, message, *args, extra=fields)
+
+    def info(self, key, message, *args, **fields):
+        self.log(logging.INFO, key, message, *args, **fields)
+
+    def warning(self, key, message, *args, **fields):
+        self.log(logging.WARNING, key, message, *args, **fields)
+
+    def forget(self, key):
+        with self.lock:
+            self.state.pop(key, None)
+
+class ProgressReporter:
+    # Counts work per key and logs one aggregated line per interval instead of a line per item
+    def __init__(self, logger, description, unit='frames', interval=DEFAULT_RATE_INTERVAL):
+        self.logger = logger
+        self.description = description
+        self.unit = unit
+        self.interval = interval
+        self.progress = {}
+        self.lock = threading.Lock()
+
+    def update(self, key, count=1, **fields):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.progress.get(key)
+            if entry is None:
+                entry = self.progress[key] = {"start": now, "last": now, "total": 0, "since_last": 0, "fields": fields}
+            entry['total'] += count
+            entry['since_last'] += count
+            elapsed = now - entry['last']
+            if elapsed < self.interval:
+                return
+            total, recent = entry['total'], entry['since_last']
+            entry['last'], entry['since_last'] = now, 0
+        self.logger.info(f"{self.description}: {total} {self.unit} ({recent / elapsed:.1f}/s)", extra=entry['fields'])
+
+    def finish(self, key):
+        with self.lock:
+            entry = self.progress.pop(key, None)
+        if entry is None:
+            return
+        elapsed = time.monotonic() - entry['start']
+        rate = entry['total'] / elapsed if elapsed > 0 else 0
+        self.logger.info(f"{self.description} finished: {entry['total']} {self.unit} in {elapsed:.1f}s ({rate:.1f}/s)",
+                         extra=entry['fields'])
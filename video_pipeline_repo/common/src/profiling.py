@@ -0,0 +1,165 @@
+import os
+import io
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import logging
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PROFILING_ENABLED = os.environ.get('PIPELINE_PROFILING', '1') != '0'
+MAX_PROFILE_SECONDS = 300
+DEFAULT_SAMPLE_INTERVAL = 0.01
+
+def _frame_label(frame):
+    # The function's first line rather than the current one, so samples inside one function merge into one frame
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class StackSampler:
+    # Wall-clock sampler over every thread: idle workers show up blocked in queue.get, busy ones in their stage code
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+
+    def sample_once(self, own_thread_id):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread_id:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            labels.append(names.get(thread_id, f"thread-{thread_id}"))
+            # Collapsed stacks run root first, separated by semicolons
+            self.stacks[';'.join(reversed(labels))] += 1
+        self.samples += 1
+
+    def run(self, seconds):
+        own_thread_id = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            self.sample_once(own_thread_id)
+            time.sleep(self.interval)
+        return self
+
+    def collapsed(self):
+        # The format flamegraph.pl, speedscope and inferno all read
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+_profile_lock = threading.Lock()
+
+def collect_profile(seconds, interval=DEFAULT_SAMPLE_INTERVAL):
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise ValueError(f"seconds must be between 0 and {MAX_PROFILE_SECONDS}")
+    if not 0.001 <= interval <= 1:
+        raise ValueError("interval must be between 0.001 and 1 second")
+    # Overlapping requests would each double the sampling overhead, so only one runs at a time
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("A profile is already being collected")
+    try:
+        return StackSampler(interval).run(seconds)
+    finally:
+        _profile_lock.release()
+
+class StageProfiler:
+    # Deterministic profiling for the stages switched on; the others cost one set lookup per frame
+    def __init__(self):
+        self.enabled = set()
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def configure(self, stage, enabled):
+        with self.lock:
+            if enabled:
+                self.enabled.add(stage)
+            else:
+                self.enabled.discard(stage)
+
+    def reset(self, stage):
+        with self.lock:
+            self.stats.pop(stage, None)
+
+    @contextmanager
+    def profile(self, stage):
+        if stage not in self.enabled:
+            yield
+            return
+        # cProfile only sees the thread that enabled it, so each call gets its own profile and they are merged
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            with self.lock:
+                if stage in self.stats:
+                    self.stats[stage].add(profiler)
+                else:
+                    self.stats[stage] = pstats.Stats(profiler)
+
+    def report(self, stage, sort='cumulative', limit=40):
+        with self.lock:
+            stats = self.stats.get(stage)
+            if stats is None:
+                return None
+            output = io.StringIO()
+            stats.stream = output
+            stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    def status(self):
+        with self.lock:
+            return {"enabled": sorted(self.enabled), "collected": sorted(self.stats)}
+
+STAGE_PROFILER = StageProfiler()
+
+def register_profiling_routes(app, service_name):
+    from flask import request, jsonify, Response
+
+    if not PROFILING_ENABLED:
+        return
+
+    @app.route('/debug/profile', methods=['GET'])
+    def debug_profile():
+        try:
+            seconds = float(request.args.get('seconds', 30))
+            interval = float(request.args.get('interval', DEFAULT_SAMPLE_INTERVAL))
+            sampler = collect_profile(seconds, interval)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except RuntimeError as e:
+            return jsonify({"error": str(e)}), 409
+        logger.info(f"Collected {sampler.samples} stack samples from {service_name} over {seconds}s")
+        filename = f"{service_name}_{time.strftime('%Y%m%d_%H%M%S')}.collapsed"
+        return Response(sampler.collapsed(), mimetype='text/plain',
+                        headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+    @app.route('/debug/stage_profile', methods=['GET', 'POST'])
+    def debug_stage_profile():
+        if request.method == 'POST':
+            data = request.json or {}
+            stage = data.get('stage')
+            if not stage:
+                return jsonify({"error": "Missing stage"}), 400
+            if data.get('reset'):
+                STAGE_PROFILER.reset(stage)
+            STAGE_PROFILER.configure(stage, bool(data.get('enabled', True)))
+            return jsonify(STAGE_PROFILER.status()), 200
+
+        stage = request.args.get('stage')
+        if not stage:
+            return jsonify(STAGE_PROFILER.status()), 200
+        try:
+            report = STAGE_PROFILER.report(stage, request.args.get('sort', 'cumulative'), int(request.args.get('limit', 40)))
+        except (KeyError, ValueError) as e:
+            return jsonify({"error": f"Invalid sort or limit: {e}"}), 400
+        if report is None:
+            return jsonify({"error": f"No profile collected for stage {stage}"}), 404
+        return Response(report, mimetype='text/plain')
@@ -0,0 +1,301 @@
+import os
+import time
+import json
+import socket
+import sqlite3
+import threading
+import logging
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+# Replicas that point at the same coordinator share its jobs' frame ranges; on one machine that is one file
+SHARD_COORDINATOR_URL = os.environ.get('PIPELINE_SHARD_COORDINATOR', 'sqlite:///job_store/shards.db')
+SHARDING_ENABLED = os.environ.get('PIPELINE_SHARDING', '0') == '1'
+# Frames per range: small enough that the last range of a job does not leave the other replicas idle for long,
+# large enough that per-range setup (loading frames, fresh temporal state) stays a small share of the work
+SHARD_FRAMES = int(os.environ.get('PIPELINE_SHARD_FRAMES', '300'))
+LEASE_SECONDS = float(os.environ.get('PIPELINE_SHARD_LEASE_SECONDS', '60'))
+MAX_SHARD_ATTEMPTS = int(os.environ.get('PIPELINE_SHARD_ATTEMPTS', '3'))
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+@dataclass
+class Shard:
+    job_id: str
+    quality: str
+    index: int
+    start_frame: int
+    end_frame: int
+    # Bumped on every lease, so a replica whose lease was taken over cannot heartbeat or complete the new one
+    attempt: int
+
+    @property
+    def frames(self):
+        return self.end_frame - self.start_frame
+
+def split_ranges(quality, total_frames, shard_frames=SHARD_FRAMES):
+    shard_frames = max(1, shard_frames)
+    return [(quality, start, min(start + shard_frames, total_frames)) for start in range(0, total_frames, shard_frames)]
+
+def replica_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+class ShardCoordinator:
+    # Backend interface: frame ranges per job, handed to replicas under leases that expire unless renewed
+    def create_job(self, job_id, payload, ranges):
+        raise NotImplementedError
+
+    def acquire(self, worker_id, lease_seconds=LEASE_SECONDS):
+        raise NotImplementedError
+
+    def heartbeat(self, shard, worker_id, frames_done, lease_seconds=LEASE_SECONDS):
+        raise NotImplementedError
+
+    def complete(self, shard, worker_id, result):
+        raise NotImplementedError
+
+    def fail(self, shard, worker_id, error):
+        raise NotImplementedError
+
+    def claim_finalize(self, worker_id):
+        raise NotImplementedError
+
+    def job_payload(self, job_id):
+        raise NotImplementedError
+
+    def shard_results(self, job_id):
+        raise NotImplementedError
+
+    def job_status(self, job_id):
+        raise NotImplementedError
+
+class SqliteShardCoordinator(ShardCoordinator):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS shard_jobs (
+            job_id TEXT PRIMARY KEY,
+            payload TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            finalized_by TEXT
+        );
+        CREATE TABLE IF NOT EXISTS shards (
+            job_id TEXT NOT NULL,
+            shard_index INTEGER NOT NULL,
+            quality TEXT NOT NULL,
+            start_frame INTEGER NOT NULL,
+            end_frame INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            owner TEXT,
+            attempt INTEGER NOT NULL DEFAULT 0,
+            lease_expires REAL,
+            frames_done INTEGER NOT NULL DEFAULT 0,
+            result TEXT,
+            error TEXT,
+            PRIMARY KEY (job_id, shard_index)
+        );
+        CREATE INDEX IF NOT EXISTS shards_by_state ON shards (state, lease_expires);
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        # Every replica process opens its own connection; BEGIN IMMEDIATE serialises the lease updates between them
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript(self.SCHEMA)
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def _transaction(self, body):
+        # Runs body(connection) holding the database write lock, so read-then-update steps are atomic across processes
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = body(self.connection)
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+            return result
+
+    def create_job(self, job_id, payload, ranges):
+        # Idempotent, so a replica that restarts and resubmits the job does not split it twice
+        def create(connection):
+            if connection.execute("SELECT 1 FROM shard_jobs WHERE job_id = ?", (job_id,)).fetchall():
+                return False
+            connection.execute("INSERT INTO shard_jobs (job_id, payload, created_at) VALUES (?, ?, ?)",
+                               (job_id, json.dumps(payload, default=str), time.time()))
+            connection.executemany(
+                "INSERT INTO shards (job_id, shard_index, quality, start_frame, end_frame, state) VALUES (?, ?, ?, ?, ?, ?)",
+                [(job_id, index, quality, start, end, PENDING) for index, (quality, start, end) in enumerate(ranges)])
+            return True
+        return self._transaction(create)
+
+    def acquire(self, worker_id, lease_seconds=LEASE_SECONDS):
+        # Oldest job first, then in frame order; a range whose lease ran out is taken over like a pending one
+        def acquire(connection):
+            now = time.time()
+            while True:
+                rows = connection.execute(
+                    "SELECT s.job_id, s.shard_index, s.quality, s.start_frame, s.end_frame, s.attempt FROM shards s "
+                    "JOIN shard_jobs j ON j.job_id = s.job_id "
+                    "WHERE s.state = ? OR (s.state = ? AND s.lease_expires < ?) "
+                    "ORDER BY j.created_at, s.start_frame, s.shard_index LIMIT 1",
+                    (PENDING, LEASED, now)).fetchall()
+                if not rows:
+                    return None
+                job_id, index, quality, start, end, attempt = rows[0]
+                if attempt >= MAX_SHARD_ATTEMPTS:
+                    connection.execute("UPDATE shards SET state = ?, owner = NULL, "
+                                       "error = COALESCE(error, 'lease expired') WHERE job_id = ? AND shard_index = ?",
+                                       (FAILED, job_id, index))
+                    logger.error(f"Frames {start}-{end} of job {job_id}, {quality} failed {attempt} times; giving up on them")
+                    continue
+                if attempt:
+                    logger.warning(f"Reassigning frames {start}-{end} of job {job_id}, {quality} (attempt {attempt + 1})")
+                connection.execute("UPDATE shards SET state = ?, owner = ?, attempt = ?, lease_expires = ?, frames_done = 0 "
+                                   "WHERE job_id = ? AND shard_index = ?",
+                                   (LEASED, worker_id, attempt + 1, now + lease_seconds, job_id, index))
+                return Shard(job_id, quality, index, start, end, attempt + 1)
+        return self._transaction(acquire)
+
+    def _owned(self, shard, worker_id):
+        return ("WHERE job_id = ? AND shard_index = ? AND owner = ? AND attempt = ? AND state = ?",
+                (shard.job_id, shard.index, worker_id, shard.attempt, LEASED))
+
+    def heartbeat(self, shard, worker_id, frames_done, lease_seconds=LEASE_SECONDS):
+        # False means the lease was lost, usually because this replica stalled past it and another took over
+        where, params = self._owned(shard, worker_id)
+        with self.lock:
+            cursor = self.connection.execute(f"UPDATE shards SET lease_expires = ?, frames_done = ? {where}",
+                                             (time.time() + lease_seconds, frames_done, *params))
+            return cursor.rowcount == 1
+
+    def complete(self, shard, worker_id, result):
+        where, params = self._owned(shard, worker_id)
+        with self.lock:
+            cursor = self.connection.execute(f"UPDATE shards SET state = ?, result = ?, frames_done = ?, lease_expires = NULL {where}",
+                                             (DONE, json.dumps(result), shard.frames, *params))
+            return cursor.rowcount == 1
+
+    def fail(self, shard, worker_id, error):
+        # The range goes back to the pool for another attempt, or fails the job once attempts run out
+        state = FAILED if shard.attempt >= MAX_SHARD_ATTEMPTS else PENDING
+        where, params = self._owned(shard, worker_id)
+        with self.lock:
+            cursor = self.connection.execute(f"UPDATE shards SET state = ?, owner = NULL, lease_expires = NULL, error = ? {where}",
+                                             (state, str(error), *params))
+            return cursor.rowcount == 1
+
+    def claim_finalize(self, worker_id):
+        # Hands exactly one replica a job whose ranges have all finished, for the reassembly and hand-off steps
+        def claim(connection):
+            rows = connection.execute(
+                "SELECT job_id FROM shard_jobs j WHERE finalized_by IS NULL AND NOT EXISTS "
+                "(SELECT 1 FROM shards s WHERE s.job_id = j.job_id AND s.state IN (?, ?)) ORDER BY created_at LIMIT 1",
+                (PENDING, LEASED)).fetchall()
+            if not rows:
+                return None
+            connection.execute("UPDATE shard_jobs SET finalized_by = ? WHERE job_id = ?", (worker_id, rows[0][0]))
+            return rows[0][0]
+        return self._transaction(claim)
+
+    def job_payload(self, job_id):
+        rows = self._execute("SELECT payload FROM shard_jobs WHERE job_id = ?", (job_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def shard_results(self, job_id):
+        rows = self._execute("SELECT shard_index, quality, start_frame, end_frame, state, result, error FROM shards "
+                             "WHERE job_id = ? ORDER BY quality, start_frame", (job_id,))
+        return [{"index": index, "quality": quality, "start_frame": start, "end_frame": end, "state": state,
+                 "result": json.loads(result) if result else None, "error": error}
+                for index, quality, start, end, state, result, error in rows]
+
+    def job_status(self, job_id):
+        rows = self._execute("SELECT state, owner, COUNT(*), SUM(frames_done), SUM(end_frame - start_frame) FROM shards "
+                             "WHERE job_id = ? GROUP BY state, owner", (job_id,))
+        if not rows:
+            return None
+        status = {"shards": {}, "owners": {}, "frames_done": 0, "frames_total": 0}
+        for state, owner, count, frames_done, frames_total in rows:
+            status['shards'][state] = status['shards'].get(state, 0) + count
+            if state == LEASED:
+                status['owners'][owner] = status['owners'].get(owner, 0) + count
+            status['frames_done'] += frames_done or 0
+            status['frames_total'] += frames_total or 0
+        finalized = self._execute("SELECT finalized_by FROM shard_jobs WHERE job_id = ?", (job_id,))
+        status['finalized_by'] = finalized[0][0] if finalized else None
+        return status
+
+def open_shard_coordinator(url=SHARD_COORDINATOR_URL):
+    if url.startswith('sqlite:///'):
+        return SqliteShardCoordinator(url[len('sqlite:///'):])
+    raise ValueError(f"Unsupported shard coordinator URL {url}; use sqlite:///<path>")
+
+_coordinator = None
+_coordinator_lock = threading.Lock()
+
+def get_shard_coordinator():
+    global _coordinator
+    with _coordinator_lock:
+        if _coordinator is None:
+            _coordinator = open_shard_coordinator()
+        return _coordinator
+
+class ShardLease:
+    # Keeps a range's lease alive from a background thread while frames are processed, and records progress.
+    # Takes the place of the FrameCheckpointer for a range: the coordinator, not the job store, tracks it
+    def __init__(self, coordinator, shard, worker_id, lease_seconds=LEASE_SECONDS):
+        self.coordinator = coordinator
+        self.shard = shard
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.frames_done = shard.start_frame
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def active(self):
+        return not self.lost.is_set()
+
+    def advance(self, frames_done):
+        self.frames_done = frames_done
+
+    def complete(self, frames_done):
+        self.frames_done = frames_done
+
+    def _renew(self):
+        # Renewing at a third of the lease leaves two chances before it runs out
+        while not self.stopped.wait(self.lease_seconds / 3):
+            try:
+                renewed = self.coordinator.heartbeat(self.shard, self.worker_id, self.frames_done - self.shard.start_frame,
+                                                     self.lease_seconds)
+            except Exception as e:
+                logger.warning(f"Could not renew the lease on job {self.shard.job_id}, range {self.shard.index}: {str(e)}")
+                continue
+            if not renewed:
+                logger.warning(f"Lost the lease on frames {self.shard.start_frame}-{self.shard.end_frame} of job "
+                               f"{self.shard.job_id}, {self.shard.quality}; stopping")
+                self.lost.set()
+                return
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self._renew, daemon=True, name=f'lease-{self.shard.job_id}-{self.shard.index}')
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        return False
@@ -0,0 +1,197 @@
+import os
+import time
+import json
+import fcntl
+import shutil
+import threading
+import logging
+
+from common.src.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Per-service budget for the artifacts it manages (0 = only the free-space floor applies)
+QUOTA_BYTES = int(float(os.environ.get('PIPELINE_STORAGE_QUOTA_GB', '0')) * 1024 ** 3)
+# Free space kept on every volume an artifact root lives on; admission stops below it
+MIN_FREE_BYTES = int(float(os.environ.get('PIPELINE_STORAGE_MIN_FREE_GB', '5')) * 1024 ** 3)
+ADMISSION_RETRY_SECONDS = 30
+ARTIFACT_MANIFEST = '.artifact.json'
+
+STORAGE_BYTES = REGISTRY.gauge('storage_managed_bytes', 'Bytes held by managed intermediate artifacts', ('service',))
+STORAGE_FREE = REGISTRY.gauge('storage_free_bytes', 'Free bytes on the tightest volume holding managed artifacts', ('service',))
+STORAGE_DELETED = REGISTRY.counter('storage_artifacts_deleted_total', 'Artifacts removed, by reason', ('service', 'reason'))
+STORAGE_REJECTIONS = REGISTRY.counter('storage_admission_rejections_total', 'Jobs held back for lack of disk space', ('service',))
+
+def manifest_path(path):
+    # Directories carry their manifest inside; single files get a sidecar next to them
+    return os.path.join(path, ARTIFACT_MANIFEST) if os.path.isdir(path) else path + ARTIFACT_MANIFEST
+
+def path_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                continue
+    return total
+
+def _read_manifest(f):
+    f.seek(0)
+    content = f.read()
+    return json.loads(content) if content else None
+
+def _write_manifest(f, manifest):
+    f.seek(0)
+    f.truncate()
+    f.write(json.dumps(manifest))
+    f.flush()
+
+class StorageManager:
+    # Tracks intermediate artifacts through a manifest stored with each one, so a stage in another
+    # service can release what it consumed. Artifacts are deleted once no consumer needs them; cacheable
+    # ones are kept until the quota or free-space floor forces least-recently-used eviction.
+    def __init__(self, service_name, roots, quota_bytes=QUOTA_BYTES, min_free_bytes=MIN_FREE_BYTES):
+        self.service_name = service_name
+        self.roots = list(roots)
+        self.quota_bytes = quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self.lock = threading.Lock()
+        STORAGE_BYTES.labels(service_name).set_function(self.usage)
+        STORAGE_FREE.labels(service_name).set_function(self.free_bytes)
+
+    def register(self, path, job_id, kind, consumers=(), cacheable=False):
+        if not os.path.exists(path):
+            logger.warning(f"Cannot register missing artifact {path}")
+            return
+        now = time.time()
+        manifest = {
+            "job_id": job_id,
+            "kind": kind,
+            "consumers": sorted(set(consumers)),
+            "cacheable": cacheable,
+            "size_bytes": path_size(path),
+            "created_at": now,
+            "last_used": now,
+        }
+        with open(manifest_path(path), 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            existing = _read_manifest(f)
+            if existing:
+                # Registering again (a resumed job) keeps consumers that have not released yet
+                manifest['consumers'] = sorted(set(existing['consumers']) | set(consumers))
+                manifest['created_at'] = existing['created_at']
+            _write_manifest(f, manifest)
+        if not manifest['consumers'] and not cacheable:
+            self._delete(path, 'consumed')
+
+    def release(self, path, consumer):
+        # Returns True if this release removed the artifact
+        manifest_file = manifest_path(path)
+        if not os.path.exists(manifest_file):
+            return False
+        with open(manifest_file, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            manifest = _read_manifest(f)
+            if manifest is None:
+                return False
+            manifest['consumers'] = [c for c in manifest['consumers'] if c != consumer]
+            manifest['last_used'] = time.time()
+            _write_manifest(f, manifest)
+        if manifest['consumers'] or manifest['cacheable']:
+            return False
+        self._delete(path, 'consumed')
+        return True
+
+    def touch(self, path):
+        manifest_file = manifest_path(path)
+        if not os.path.exists(manifest_file):
+            return
+        with open(manifest_file, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            manifest = _read_manifest(f)
+            if manifest is not None:
+                manifest['last_used'] = time.time()
+                _write_manifest(f, manifest)
+
+    def _delete(self, path, reason):
+        manifest_file = manifest_path(path)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+        STORAGE_DELETED.labels(self.service_name, reason).inc()
+        logger.info(f"Removed artifact {path} ({reason})")
+
+    def artifacts(self):
+        # Artifacts sit directly under a root, as directories or files, so the scan costs one listdir per root
+        found = []
+        for root in self.roots:
+            if not os.path.isdir(root):
+                continue
+            for entry in os.scandir(root):
+                if entry.is_dir():
+                    path, manifest_file = entry.path, os.path.join(entry.path, ARTIFACT_MANIFEST)
+                elif entry.name.endswith(ARTIFACT_MANIFEST) and entry.name != ARTIFACT_MANIFEST:
+                    path, manifest_file = entry.path[:-len(ARTIFACT_MANIFEST)], entry.path
+                else:
+                    continue
+                try:
+                    with open(manifest_file) as f:
+                        found.append((path, json.load(f)))
+                except (OSError, ValueError):
+                    continue
+        return found
+
+    def usage(self):
+        return sum(manifest.get('size_bytes', 0) for _, manifest in self.artifacts())
+
+    def free_bytes(self):
+        free = []
+        for root in self.roots:
+            probe = root
+            while probe and not os.path.exists(probe):
+                probe = os.path.dirname(probe)
+            free.append(shutil.disk_usage(probe or '.').free)
+        return min(free) if free else 0
+
+    def _shortfall(self, bytes_needed):
+        shortfall = max(0, self.min_free_bytes + bytes_needed - self.free_bytes())
+        if self.quota_bytes:
+            shortfall = max(shortfall, self.usage() + bytes_needed - self.quota_bytes)
+        return shortfall
+
+    def evict(self, bytes_to_free):
+        # Only consumed, cacheable artifacts are candidates; anything a stage still needs is never evicted
+        candidates = sorted(((path, m) for path, m in self.artifacts() if m.get('cacheable') and not m.get('consumers')),
+                            key=lambda item: item[1].get('last_used', 0))
+        freed = 0
+        for path, manifest in candidates:
+            if freed >= bytes_to_free:
+                break
+            self._delete(path, 'evicted')
+            freed += manifest.get('size_bytes', 0)
+        return freed
+
+    def has_space(self, bytes_needed=0):
+        # Admission check: evicts cached artifacts if that makes room, otherwise tells the caller to hold back
+        with self.lock:
+            shortfall = self._shortfall(bytes_needed)
+            if shortfall > 0:
+                self.evict(shortfall)
+                shortfall = self._shortfall(bytes_needed)
+        if shortfall > 0:
+            STORAGE_REJECTIONS.labels(self.service_name).inc()
+            logger.warning(f"{self.service_name} is short of {shortfall / 1024 ** 2:.0f} MB of disk for new work")
+            return False
+        return True
+
+def estimate_frame_bytes(metadata, quality_levels, bytes_per_pixel=3):
+    # Upper bound for a job's frames at every rung, from the metadata ingestion publishes
+    frame_count = int((metadata or {}).get('frame_count') or 0)
+    pixels = sum(int(q.split('x')[0]) * int(q.split('x')[1]) for q in quality_levels)
+    return frame_count * pixels * bytes_per_pixel
@@ -0,0 +1,121 @@
+import os
+import math
+import logging
+import threading
+from dataclasses import dataclass, asdict
+
+logger = logging.getLogger(__name__)
+
+CGROUP_V2_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+CGROUP_V1_CPU_QUOTA = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+CGROUP_V1_CPU_PERIOD = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+CPU_BUDGET_ENV = 'PIPELINE_CPU_BUDGET'
+
+# Upper bounds used when the node has cores to spare; these match the previous hard-coded sizes
+DEFAULT_MAX_CONCURRENT_JOBS = 3
+DEFAULT_ENHANCEMENT_WORKERS = 5
+DEFAULT_RECOGNITION_WORKERS = 2
+
+def _read_file(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def read_cgroup_cpu_limit():
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    cpu_max = _read_file(CGROUP_V2_CPU_MAX)
+    if cpu_max:
+        quota, _, period = cpu_max.partition(' ')
+        if quota != 'max' and period:
+            return int(quota) / int(period)
+        return None
+
+    # cgroup v1: a quota of -1 means unlimited
+    quota = _read_file(CGROUP_V1_CPU_QUOTA)
+    period = _read_file(CGROUP_V1_CPU_PERIOD)
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+def available_cpus():
+    override = os.environ.get(CPU_BUDGET_ENV)
+    if override:
+        return float(override)
+
+    try:
+        cpus = float(len(os.sched_getaffinity(0)))
+    except AttributeError:
+        cpus = float(os.cpu_count() or 1)
+
+    cgroup_limit = read_cgroup_cpu_limit()
+    if cgroup_limit is not None:
+        cpus = min(cpus, cgroup_limit)
+    return cpus
+
+@dataclass
+class ThreadAllocation:
+    cpus: float
+    cores: int
+    max_concurrent_jobs: int
+    enhancement_workers: int
+    recognition_workers: int
+    opencv_threads: int
+    ffmpeg_threads: int
+
+def plan_allocation(cpus, max_concurrent_jobs=DEFAULT_MAX_CONCURRENT_JOBS,
+                    enhancement_workers=DEFAULT_ENHANCEMENT_WORKERS, recognition_workers=DEFAULT_RECOGNITION_WORKERS):
+    # Fractional limits (e.g. 1500m) still get a whole core for scheduling purposes
+    cores = max(1, int(math.floor(cpus)))
+
+    jobs = max(1, min(max_concurrent_jobs, cores))
+    enhancement = max(1, min(enhancement_workers, cores))
+    recognition = max(1, min(recognition_workers, max(1, cores // 2)))
+
+    # Stage workers already provide frame-level parallelism, so OpenCV only gets the cores
+    # they leave idle; ffmpeg processes of concurrent jobs split the node between them
+    opencv_threads = max(1, cores // (jobs * enhancement))
+    ffmpeg_threads = max(1, cores // jobs)
+
+    return ThreadAllocation(
+        cpus=round(cpus, 2),
+        cores=cores,
+        max_concurrent_jobs=jobs,
+        enhancement_workers=enhancement,
+        recognition_workers=recognition,
+        opencv_threads=opencv_threads,
+        ffmpeg_threads=ffmpeg_threads
+    )
+
+class ThreadBudget:
+    def __init__(self, cpus=None):
+        self.allocation = plan_allocation(cpus if cpus is not None else available_cpus())
+        self.opencv_applied = False
+        self.lock = threading.Lock()
+        logger.info(f"Thread budget: {self.as_dict()}")
+
+    def apply_opencv(self):
+        # cv2.setNumThreads is process wide, so it only needs to happen once per service
+        with self.lock:
+            if self.opencv_applied:
+                return
+            import cv2
+            cv2.setNumThreads(self.allocation.opencv_threads)
+            self.opencv_applied = True
+
+    def ffmpeg_threads_per_process(self, concurrent_processes=1):
+        return max(1, self.allocation.ffmpeg_threads // max(1, concurrent_processes))
+
+    def as_dict(self):
+        return asdict(self.allocation)
+
+_budget = None
+_budget_lock = threading.Lock()
+
+def get_thread_budget():
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = ThreadBudget()
+        return _budget
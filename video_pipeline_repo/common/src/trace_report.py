@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import argparse
+from collections import defaultdict
+
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(root_dir)
+
+from common.src.tracing import TRACE_FILE
+
+def load_spans(path, job_id=None, trace_id=None):
+    spans = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                span = json.loads(line)
+            except ValueError:
+                # A service killed mid-write leaves a partial last line; the rest of the file is still usable
+                continue
+            if job_id and span.get('job_id') != job_id:
+                continue
+            if trace_id and span.get('trace_id') != trace_id:
+                continue
+            if span.get('end_time_unix_nano') is None:
+                continue
+            spans.append(span)
+    return spans
+
+def duration_ms(span):
+    return (span['end_time_unix_nano'] - span['start_time_unix_nano']) / 1e6
+
+def build_tree(spans):
+    by_id = {span['span_id']: span for span in spans}
+    children = defaultdict(list)
+    roots = []
+    for span in spans:
+        parent = span.get('parent_span_id')
+        if parent and parent in by_id:
+            children[parent].append(span)
+        else:
+            roots.append(span)
+    return roots, children
+
+def critical_path(roots, children):
+    # Downstream services are notified asynchronously, so a child can outlive its parent; the job is
+    # done when the last thing finishes, so keep following whichever child ends last
+    if not roots:
+        return []
+    span = max(roots, key=lambda s: s['end_time_unix_nano'])
+    path = []
+    while span is not None:
+        kids = children.get(span['span_id'], [])
+        last = max(kids, key=lambda s: s['end_time_unix_nano'], default=None)
+        # Time on the path that belongs to this span rather than the child the path continues into
+        own = duration_ms(span)
+        if last is not None:
+            own -= max(0, (min(span['end_time_unix_nano'], last['end_time_unix_nano'])
+                           - max(span['start_time_unix_nano'], last['start_time_unix_nano'])) / 1e6)
+        path.append((span, max(own, 0.0)))
+        span = last
+    return path
+
+def self_time_ms(span, children):
+    # Overlapping children (parallel qualities, concurrent stages) are merged so they are not subtracted twice
+    intervals = sorted((c['start_time_unix_nano'], c['end_time_unix_nano']) for c in children.get(span['span_id'], []))
+    covered, current_start, current_end = 0, None, None
+    for start, end in intervals:
+        start, end = max(start, span['start_time_unix_nano']), min(end, span['end_time_unix_nano'])
+        if end <= start:
+            continue
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                covered += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        covered += current_end - current_start
+    return max(0.0, duration_ms(span) - covered / 1e6)
+
+def aggregate(spans, children):
+    stats = {}
+    for span in spans:
+        key = (span.get('service'), span['name'])
+        entry = stats.setdefault(key, {"count": 0, "total_ms": 0.0, "self_ms": 0.0, "max_ms": 0.0, "errors": 0})
+        elapsed = duration_ms(span)
+        entry['count'] += 1
+        entry['total_ms'] += elapsed
+        entry['self_ms'] += self_time_ms(span, children)
+        entry['max_ms'] = max(entry['max_ms'], elapsed)
+        entry['errors'] += span.get('status') == 'error'
+    return stats
+
+def print_report(spans):
+    roots, children = build_tree(spans)
+    start = min(s['start_time_unix_nano'] for s in spans)
+    end = max(s['end_time_unix_nano'] for s in spans)
+    wall_ms = (end - start) / 1e6
+    print(f"{len(spans)} spans, wall time {wall_ms:.1f} ms")
+
+    print("\nCritical path")
+    print(f"{'service':<12}{'span':<20}{'start_ms':>12}{'duration_ms':>14}{'on_path_ms':>12}{'share':>8}")
+    for span, own in critical_path(roots, children):
+        offset = (span['start_time_unix_nano'] - start) / 1e6
+        share = own / wall_ms if wall_ms else 0
+        print(f"{span.get('service', ''):<12}{span['name']:<20}{offset:>12.1f}{duration_ms(span):>14.1f}{own:>12.1f}{share:>8.1%}")
+
+    print("\nBy span name")
+    print(f"{'service':<12}{'span':<20}{'count':>8}{'total_ms':>12}{'self_ms':>12}{'mean_ms':>10}{'max_ms':>10}{'errors':>8}")
+    stats = aggregate(spans, children)
+    for (service, name), entry in sorted(stats.items(), key=lambda item: item[1]['self_ms'], reverse=True):
+        mean = entry['total_ms'] / entry['count']
+        print(f"{service or '':<12}{name:<20}{entry['count']:>8}{entry['total_ms']:>12.1f}{entry['self_ms']:>12.1f}"
+              f"{mean:>10.1f}{entry['max_ms']:>10.1f}{entry['errors']:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Critical path and per-stage time for a traced pipeline job")
+    parser.add_argument('--trace-file', default=TRACE_FILE, help="JSONL span file the services append to")
+    parser.add_argument('--job-id', help="Only spans of this job")
+    parser.add_argument('--trace-id', help="Only spans of this trace")
+    args = parser.parse_args()
+
+    spans = load_spans(args.trace_file, args.job_id, args.trace_id)
+    if not spans:
+        print(f"No finished spans found in {args.trace_file}")
+        sys.exit(1)
+    if not args.trace_id and len({s['trace_id'] for s in spans}) > 1:
+        print("Spans from several traces matched; pass --job-id or --trace-id to pick one")
+    print_report(spans)
+
+if __name__ == "__main__":
+    main()
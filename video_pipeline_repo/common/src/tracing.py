@@ -0,0 +1,137 @@
+import os
+import time
+import json
+import random
+import threading
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+TRACE_FILE = os.environ.get('PIPELINE_TRACE_FILE', 'traces/spans.jsonl')
+TRACING_ENABLED = os.environ.get('PIPELINE_TRACING', '1') != '0'
+# Every Nth frame gets per-stage spans; job-level spans are always recorded
+FRAME_SAMPLE_INTERVAL = int(os.environ.get('PIPELINE_TRACE_FRAME_INTERVAL', '30'))
+
+def _new_id(bits):
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+class TraceContext:
+    # What travels between services in notify payloads: enough to parent the next hop's spans
+    def __init__(self, trace_id, span_id=None, job_id=None, sampled=True):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.job_id = job_id
+        self.sampled = sampled
+
+    def to_dict(self):
+        return {"trace_id": self.trace_id, "span_id": self.span_id, "job_id": self.job_id, "sampled": self.sampled}
+
+    @classmethod
+    def from_dict(cls, data, job_id=None):
+        if not data or not data.get('trace_id'):
+            return None
+        return cls(data['trace_id'], data.get('span_id'), data.get('job_id') or job_id, data.get('sampled', True))
+
+class Span:
+    def __init__(self, tracer, name, context, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = context.trace_id
+        self.parent_id = context.span_id
+        self.span_id = _new_id(64)
+        self.job_id = context.job_id
+        self.attributes = attributes
+        self.status = 'ok'
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        # Children of this span, in this service or the next one
+        self.context = TraceContext(self.trace_id, self.span_id, self.job_id, context.sampled)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "name": self.name,
+            "service": self.tracer.service_name,
+            "job_id": self.job_id,
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": self.end_ns,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+class JsonlSpanExporter:
+    # One JSON object per line; several services can append to the same file
+    def __init__(self, path=TRACE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+class Tracer:
+    def __init__(self, service_name, exporter=None, enabled=TRACING_ENABLED, frame_sample_interval=FRAME_SAMPLE_INTERVAL):
+        self.service_name = service_name
+        self.exporter = exporter
+        self.enabled = enabled
+        self.frame_sample_interval = max(1, frame_sample_interval)
+
+    def _exporter(self):
+        if self.exporter is None:
+            self.exporter = JsonlSpanExporter()
+        return self.exporter
+
+    def start_trace(self, job_id):
+        return TraceContext(_new_id(128), None, job_id, sampled=self.enabled)
+
+    def context_from(self, data, job_id=None):
+        # Continue the caller's trace, or start one here when the payload has none
+        return TraceContext.from_dict(data, job_id) or self.start_trace(job_id)
+
+    def frame_sampled(self, context, frame_number):
+        return context is not None and context.sampled and frame_number % self.frame_sample_interval == 0
+
+    @contextmanager
+    def span(self, name, context, **attributes):
+        if context is None or not context.sampled or not self.enabled:
+            yield None
+            return
+        span = Span(self, name, context, attributes)
+        try:
+            yield span
+        except Exception as e:
+            span.status = 'error'
+            span.attributes['error'] = str(e)
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            try:
+                self._exporter().export(span)
+            except Exception as e:
+                logger.warning(f"Could not export span {name}: {str(e)}")
+
+_tracers = {}
+_tracers_lock = threading.Lock()
+
+def get_tracer(service_name):
+    with _tracers_lock:
+        tracer = _tracers.get(service_name)
+        if tracer is None:
+            tracer = Tracer(service_name)
+            _tracers[service_name] = tracer
+        return tracer
+
+def child_context(span, context):
+    # Spans are None when tracing is off or unsampled; keep passing the caller's context along then
+    return span.context if span is not None else context
@@ -0,0 +1,129 @@
+import os
+import sys
+import time
+import json
+import argparse
+import numpy as np
+import cv2
+
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(root_dir)
+
+from enhancement.src.enhance import EnhancementService, TemporalCLAHE
+
+QUALITY_LEVELS = ["640x360", "1280x720", "1920x1080"]
+
+def make_frames(quality, count, seed=0):
+    width, height = (int(x) for x in quality.split('x'))
+    rng = np.random.default_rng(seed)
+    # Smooth gradients plus noise so CLAHE and the blurs see something close to real footage
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    base = np.stack([np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width)), (x + y) / 2], axis=2)
+    frames = []
+    for i in range(count):
+        noise = rng.normal(0, 12, size=(height, width, 3)).astype(np.float32)
+        shifted = np.roll(base, i * 4, axis=1)
+        frames.append(np.clip(shifted + noise, 0, 255).astype(np.uint8))
+    return frames
+
+def time_path(enhance, frames, repeats):
+    # One untimed pass so buffer allocation and CLAHE construction are not measured
+    enhance(frames[0])
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for frame in frames:
+            enhance(frame)
+    elapsed = time.perf_counter() - start
+    return (len(frames) * repeats) / elapsed
+
+def time_temporal(service, frames, repeats, keyframe_interval):
+    # The fused and temporal paths take turns on every frame, so load that comes and goes during the
+    # run lands on both; keyframes are part of the temporal total
+    temporal_state = TemporalCLAHE(keyframe_interval=keyframe_interval)
+    paths = (service._enhance_frame, lambda frame: service._enhance_frame(frame, temporal_state))
+    for enhance in paths:
+        enhance(frames[0])
+    elapsed = [0.0, 0.0]
+    for _ in range(repeats):
+        for frame in frames:
+            for i, enhance in enumerate(paths):
+                start = time.perf_counter()
+                enhance(frame)
+                elapsed[i] += time.perf_counter() - start
+    return tuple((len(frames) * repeats) / total for total in elapsed)
+
+def compare_outputs(service, frames):
+    max_diff = 0
+    mismatched_pixels = 0
+    for frame in frames:
+        reference = service._enhance_frame_reference(frame)
+        fused = service._enhance_frame(frame)
+        diff = cv2.absdiff(reference, fused)
+        max_diff = max(max_diff, int(diff.max()))
+        mismatched_pixels += int(np.count_nonzero(diff))
+    return max_diff, mismatched_pixels
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fused enhancement kernel against the reference path")
+    parser.add_argument('--frames', type=int, default=30, help="Distinct frames per quality level")
+    parser.add_argument('--repeats', type=int, default=3, help="Passes over the frame set per measurement")
+    parser.add_argument('--qualities', nargs='+', default=QUALITY_LEVELS)
+    parser.add_argument('--tolerance', type=int, default=0, help="Maximum allowed per-pixel difference")
+    parser.add_argument('--threads', type=int, default=None, help="Value for cv2.setNumThreads")
+    parser.add_argument('--temporal-interval', type=int, default=0,
+                        help="Also measure temporal mode with this keyframe interval (0 disables); "
+                             "fails unless it is faster than the fused path")
+    parser.add_argument('--json', help="Write results to this file")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        cv2.setNumThreads(args.threads)
+
+    service = EnhancementService()
+    results = []
+    failed = False
+    temporal_failed = False
+    for quality in args.qualities:
+        frames = make_frames(quality, args.frames)
+        reference_fps = time_path(service._enhance_frame_reference, frames, args.repeats)
+        fused_fps = time_path(service._enhance_frame, frames, args.repeats)
+        max_diff, mismatched_pixels = compare_outputs(service, frames)
+        failed = failed or max_diff > args.tolerance
+
+        temporal_fps = None
+        if args.temporal_interval:
+            # Temporal mode reuses keyframe statistics, so it is held to being faster rather than to --tolerance
+            paired_fused_fps, temporal_fps = time_temporal(service, frames, args.repeats, args.temporal_interval)
+
+        result = {
+            "quality": quality,
+            "reference_fps": round(reference_fps, 2),
+            "fused_fps": round(fused_fps, 2),
+            "speedup": round(fused_fps / reference_fps, 3),
+            "max_abs_diff": max_diff,
+            "mismatched_pixels": mismatched_pixels,
+        }
+        if temporal_fps is not None:
+            result["temporal_fps"] = round(temporal_fps, 2)
+            result["temporal_speedup"] = round(temporal_fps / paired_fused_fps, 3)
+            temporal_failed = temporal_failed or temporal_fps <= paired_fused_fps
+        results.append(result)
+        print(f"{quality:>10}: reference {reference_fps:8.2f} fps | fused {fused_fps:8.2f} fps | "
+              f"x{result['speedup']:.2f} | max diff {max_diff} ({mismatched_pixels} pixels)"
+              + (f" | temporal {temporal_fps:8.2f} fps x{result['temporal_speedup']:.2f} over fused"
+                 if temporal_fps is not None else ""))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"threads": cv2.getNumThreads(), "results": results}, f, indent=2)
+
+    if failed:
+        print(f"Fused output differs from the reference path by more than {args.tolerance}")
+    if temporal_failed:
+        print("Temporal mode is not faster than the fused path")
+    if failed or temporal_failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
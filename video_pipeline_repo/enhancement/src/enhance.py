@@ -1,39 +1,307 @@
 import threading
-from queue import Queue
+from queue import Queue, Empty
 import numpy as np
 import cv2 
 import logging
 import sys
 import os
 
-# Configure logging to output to stdout
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(root_dir)
+
+from common.src.frame_analysis import SceneChangeDetector
+from common.src.metrics import BYTES_WRITTEN
+from common.src.profiling import STAGE_PROFILER
+from common.src.logging_setup import configure_logging
+
+configure_logging('enhancement')
 
 # logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 OUTPUT_DIR = '../../enhancement/src/enhanced_frames'
+QUEUE_POLL_INTERVAL = 0.5
 
-class EnhancementService:
+def build_grade_lut(temperature=10, tint=0):
+    # Same float32 add / clip / truncate as _color_grade, evaluated once per input value
+    values = np.arange(256, dtype=np.float32)
+    lut = np.empty((1, 256, 3), dtype=np.uint8)
+    lut[0, :, 0] = np.clip(values + temperature, 0, 255).astype(np.uint8)
+    lut[0, :, 1] = np.arange(256, dtype=np.uint8)
+    lut[0, :, 2] = np.clip(values + tint, 0, 255).astype(np.uint8)
+    return lut
+
+def compute_clahe_tile_luts(lightness, clip_limit=2.0, tile_grid_size=(8, 8)):
+    # Mirrors OpenCV's CLAHE: reflect-pad to a whole number of tiles, clip each tile histogram,
+    # redistribute the excess and turn the CDF into a per-tile LUT
+    tiles_x, tiles_y = tile_grid_size
+    height, width = lightness.shape
+    pad_bottom, pad_right = (-height) % tiles_y, (-width) % tiles_x
+    if pad_bottom or pad_right:
+        lightness = cv2.copyMakeBorder(lightness, 0, pad_bottom, 0, pad_right, cv2.BORDER_REFLECT_101)
+    tile_h, tile_w = lightness.shape[0] // tiles_y, lightness.shape[1] // tiles_x
+    tile_area = tile_h * tile_w
+    num_tiles = tiles_x * tiles_y
+
+    tiles = lightness.reshape(tiles_y, tile_h, tiles_x, tile_w).transpose(0, 2, 1, 3).reshape(num_tiles, tile_area)
+    offsets = (np.arange(num_tiles, dtype=np.int32) * 256)[:, None]
+    hist = np.bincount((tiles + offsets).ravel(), minlength=num_tiles * 256).reshape(num_tiles, 256)
+
+    if clip_limit > 0:
+        limit = max(int(clip_limit * tile_area / 256), 1)
+        excess = np.maximum(hist - limit, 0).sum(axis=1)
+        hist = np.minimum(hist, limit)
+        redistribute = excess // 256
+        hist += redistribute[:, None]
+        residual = excess - redistribute * 256
+        for tile in np.nonzero(residual)[0]:
+            step = max(256 // residual[tile], 1)
+            hist[tile, 0:step * residual[tile]:step] += 1
+
+    cdf = np.cumsum(hist, axis=1).astype(np.float32)
+    luts = np.clip(np.rint(cdf * np.float32(255.0 / tile_area)), 0, 255).astype(np.uint8)
+    return luts.reshape(tiles_y, tiles_x, 256), (tile_w, tile_h)
+
+# cv2.LUT gives every channel of a multi-channel image its own table, up to this many channels
+MAX_LUT_CHANNELS = 512
+
+class TemporalCLAHE:
+    def __init__(self, keyframe_interval=30, scene_threshold=0.35, lut_smoothing=0.0, clip_limit=2.0, tile_grid_size=(8, 8)):
+        self.keyframe_interval = keyframe_interval
+        self.lut_smoothing = lut_smoothing
+        self.clip_limit = clip_limit
+        self.tile_grid_size = tile_grid_size
+        self.scene_detector = SceneChangeDetector(scene_threshold)
+        self.frames_since_keyframe = 0
+        self.frames_seen = 0
+        self.keyframes = 0
+        self.smoothed_luts = None
+        self.band_luts = None
+        self.geometry = None
+        self.lock = threading.Lock()
+
+    def _prepare_geometry(self, shape, tile_size):
+        # Tile coordinates of every pixel, clamped the same way OpenCV clamps its interpolation
+        tiles_x, tiles_y = self.tile_grid_size
+        height, width = shape
+        tile_w, tile_h = tile_size
+        x = np.clip(np.arange(width, dtype=np.float32) / tile_w - 0.5, 0, tiles_x - 1)
+        left_tile = np.floor(x).astype(np.intp)
+        right_tile = np.minimum(left_tile + 1, tiles_x - 1)
+        # Column x takes (1 - w) of its left tile's LUT and w of its right one; as a matrix, so a keyframe
+        # interpolates every tile row's LUTs across the width in one product
+        column_weights = np.zeros((tiles_x, width), dtype=np.float32)
+        np.add.at(column_weights, (left_tile, np.arange(width)), 1 - (x - left_tile))
+        np.add.at(column_weights, (right_tile, np.arange(width)), x - left_tile)
+
+        # Rows between the same two tile rows form a band, looked up through that pair's tables
+        y = np.clip(np.arange(height, dtype=np.float32) / tile_h - 0.5, 0, tiles_y - 1)
+        top_tile = np.floor(y).astype(np.intp)
+        starts = np.flatnonzero(np.diff(top_tile, prepend=-1))
+        self.bands = [(int(start), int(stop), (int(top_tile[start]), int(min(top_tile[start] + 1, tiles_y - 1))))
+                      for start, stop in zip(starts, list(starts[1:]) + [height])]
+        self.chunks = [(start, min(start + MAX_LUT_CHANNELS, width)) for start in range(0, width, MAX_LUT_CHANNELS)]
+        self.column_weights = [np.ascontiguousarray(column_weights[:, start:stop]) for start, stop in self.chunks]
+        # Vertical weights in 1/255ths, so the blend is two scaled 8-bit multiplies and an add
+        bottom_weight = np.rint((y - top_tile) * 255).astype(np.uint8)[:, None]
+        self.bottom_weight = np.ascontiguousarray(np.broadcast_to(bottom_weight, shape))
+        self.top_weight = np.ascontiguousarray(np.broadcast_to(255 - bottom_weight, shape))
+        # Each lookup returns the top and bottom tile rows' values as the two bytes of one 16-bit entry
+        self.packed = np.empty(shape, dtype=np.uint16)
+        self.top = np.empty(shape, dtype=np.uint8)
+        self.bottom = np.empty(shape, dtype=np.uint8)
+        self.geometry = (shape, tile_size)
+
+    def _needs_keyframe(self, lightness):
+        if self.band_luts is None or self.frames_since_keyframe >= self.keyframe_interval:
+            return True, False, None
+        is_scene_change, _, histogram = self.scene_detector.check(lightness)
+        return is_scene_change, is_scene_change, histogram
+
+    def _refresh_luts(self, lightness, scene_change, histogram):
+        luts, tile_size = compute_clahe_tile_luts(lightness, self.clip_limit, self.tile_grid_size)
+        if self.lut_smoothing > 0 and self.smoothed_luts is not None and not scene_change:
+            # Blend with the previous keyframe's LUTs to damp brightness pumping between keyframes
+            self.smoothed_luts = self.lut_smoothing * self.smoothed_luts + (1 - self.lut_smoothing) * luts
+            luts = np.rint(self.smoothed_luts).astype(np.uint8)
+        else:
+            self.smoothed_luts = luts.astype(np.float32)
+        if self.geometry != (lightness.shape, tile_size):
+            self._prepare_geometry(lightness.shape, tile_size)
+
+        # Interpolate between tile columns once per keyframe: each tile row gets a table per pixel column,
+        # applied as the per-channel tables of a multi-channel cv2.LUT. A band's top and bottom tile rows
+        # are packed into one 16-bit table, so in-between frames take a single lookup and a vertical blend
+        tiles_x, tiles_y = self.tile_grid_size
+        stacked = luts.transpose(0, 2, 1).reshape(tiles_y * 256, tiles_x).astype(np.float32)
+        tables = [cv2.convertScaleAbs(stacked @ weights).reshape(tiles_y, 256, -1) for weights in self.column_weights]
+        self.band_luts = {
+            pair: [np.stack([table[pair[0]], table[pair[1]]], axis=-1).view(np.uint16).reshape(1, 256, -1) for table in tables]
+            for pair in {pair for _, _, pair in self.bands}
+        }
+
+        self.scene_detector.set_reference(histogram if histogram is not None else self.scene_detector.histogram(lightness))
+        self.frames_since_keyframe = 0
+        self.keyframes += 1
+
+    def apply(self, lightness, dst=None):
+        with self.lock:
+            # Scene changes are judged on the L channel, which costs a fraction of converting the RGB frame
+            needs_keyframe, scene_change, histogram = self._needs_keyframe(lightness)
+            if needs_keyframe:
+                self._refresh_luts(lightness, scene_change, histogram)
+
+            for start_row, stop_row, pair in self.bands:
+                for index, (start, stop) in enumerate(self.chunks):
+                    # One pixel per row, one channel per column: a view, so nothing is copied
+                    shape = (stop_row - start_row, 1, stop - start)
+                    cv2.LUT(lightness[start_row:stop_row, start:stop].reshape(shape), self.band_luts[pair][index],
+                            dst=self.packed[start_row:stop_row, start:stop].reshape(shape))
+            cv2.split(self.packed.view(np.uint8).reshape(self.packed.shape + (2,)), [self.top, self.bottom])
+
+            cv2.multiply(self.top, self.top_weight, dst=self.top, scale=1 / 255.0)
+            cv2.multiply(self.bottom, self.bottom_weight, dst=self.bottom, scale=1 / 255.0)
+            dst = cv2.add(self.top, self.bottom, dst=dst)
+
+            self.frames_since_keyframe += 1
+            self.frames_seen += 1
+            return dst
+
+class TemporalStateRegistry:
     def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def get(self, metadata):
+        # Each frame range of a sharded job is its own stream, so ranges processed side by side keep separate state
+        key = (metadata.get('stream_id', metadata['job_id']), metadata['quality'])
+        with self.lock:
+            state = self.states.get(key)
+            if state is None:
+                settings = metadata.get('temporal_enhance')
+                settings = settings if isinstance(settings, dict) else {}
+                state = TemporalCLAHE(
+                    keyframe_interval=settings.get('keyframe_interval', 30),
+                    scene_threshold=settings.get('scene_threshold', 0.35),
+                    lut_smoothing=settings.get('lut_smoothing', 0.0)
+                )
+                self.states[key] = state
+            return state
+
+    def discard_job(self, job_id):
+        with self.lock:
+            keys = [key for key in self.states if key[0] == job_id]
+            states = [(key[1], self.states.pop(key)) for key in keys]
+        for quality, state in states:
+            logger.info(f"Temporal enhancement for job {job_id}, quality {quality}: "
+                        f"{state.keyframes} keyframes over {state.frames_seen} frames")
+
+class FusedEnhancer:
+    def __init__(self, temperature=10, tint=0, clip_limit=2.0, tile_grid_size=(8, 8), kernel_size=5):
+        self.clip_limit = clip_limit
+        self.tile_grid_size = tile_grid_size
+        self.kernel_size = kernel_size
+        self.grade_lut = build_grade_lut(temperature, tint)
+        # CLAHE objects keep scratch state internally, so each thread gets its own along with its buffers
+        self.thread_state = threading.local()
+
+    def _get_state(self, shape):
+        state = self.thread_state
+        if getattr(state, 'clahe', None) is None:
+            state.clahe = cv2.createCLAHE(clipLimit=self.clip_limit, tileGridSize=self.tile_grid_size)
+            state.buffers = {}
+        if shape not in state.buffers:
+            height, width = shape[:2]
+            state.buffers[shape] = {
+                'denoised': np.empty(shape, dtype=np.uint8),
+                'lab': np.empty(shape, dtype=np.uint8),
+                'lightness': np.empty((height, width), dtype=np.uint8),
+                'equalized': np.empty((height, width), dtype=np.uint8),
+                'graded': np.empty(shape, dtype=np.uint8),
+                'sharpen_blur': np.empty(shape, dtype=np.uint8),
+            }
+        return state.clahe, state.buffers[shape]
+
+    def enhance(self, frame, temporal_state=None):
+        clahe, buffers = self._get_state(frame.shape)
+        ksize = (self.kernel_size, self.kernel_size)
+
+        # Noise reduction
+        cv2.GaussianBlur(frame, (5, 5), 0, dst=buffers['denoised'])
+
+        # Color correction: CLAHE on the L channel without split/merge copies
+        cv2.cvtColor(buffers['denoised'], cv2.COLOR_RGB2LAB, dst=buffers['lab'])
+        cv2.extractChannel(buffers['lab'], 0, dst=buffers['lightness'])
+        if temporal_state is not None:
+            # Reuse the tile LUTs of the last keyframe instead of re-deriving them for every frame
+            temporal_state.apply(buffers['lightness'], dst=buffers['equalized'])
+        else:
+            clahe.apply(buffers['lightness'], dst=buffers['equalized'])
+        cv2.insertChannel(buffers['equalized'], buffers['lab'], 0)
+        cv2.cvtColor(buffers['lab'], cv2.COLOR_LAB2RGB, dst=buffers['graded'])
+
+        # Color grading as a single per-channel lookup
+        cv2.LUT(buffers['graded'], self.grade_lut, dst=buffers['graded'])
+
+        # Deblurring (Unsharp Masking). The blur here runs on the graded frame, so it cannot
+        # share the denoising blur without changing the output.
+        cv2.GaussianBlur(buffers['graded'], ksize, 0, dst=buffers['sharpen_blur'])
+
+        # The result leaves this thread, so it is the only per-frame allocation
+        return cv2.addWeighted(buffers['graded'], 1.5, buffers['sharpen_blur'], -0.5, 0)
+
+def downscale_frame(frame, width, height):
+    if frame.shape[1] == width and frame.shape[0] == height:
+        return frame
+    # Area averaging is OpenCV's highest quality filter for reductions and avoids aliasing
+    return cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+
+def save_enhanced_frame(frame, metadata, output_dir=OUTPUT_DIR):
+    job_id = metadata['job_id']
+    frame_number = metadata['frame_number']
+    quality = metadata['quality']
+    
+    job_dir = os.path.join(output_dir, f"job_{job_id}", f"quality_{quality}")
+    os.makedirs(job_dir, exist_ok=True)
+    
+    frame_path = os.path.join(job_dir, f"frame_{frame_number:06d}.png")
+    try:
+        cv2.imwrite(frame_path, cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+        BYTES_WRITTEN.labels('enhancement', 'enhanced_frames').inc(os.path.getsize(frame_path))
+        logger.debug("Enhanced frame saved: %s", frame_path)
+    except Exception as e:
+        logger.error(f"Error saving enhanced frame: {str(e)}")  
+
+class EnhancementService:
+    def __init__(self, temporal_states=None):
         self.input_queue = Queue()
         self.output_queue = Queue()
         self.is_running = True
         self.output_dir = OUTPUT_DIR
+        self.enhancer = FusedEnhancer()
+        # Shared between the service instances of a pool, since consecutive frames of a stream
+        # can land on different instances
+        self.temporal_states = temporal_states if temporal_states is not None else TemporalStateRegistry()
     
     def start(self):
         while self.is_running:
-            if not self.input_queue.empty():
-                frame, metadata = self.input_queue.get()
-                enhanced_frame = self._enhance_frame(frame)
-                self._save_enhanced_frame(enhanced_frame, metadata)
-                self.output_queue.put((enhanced_frame, enhanced_frame))
+            try:
+                # Block instead of spinning so idle workers leave the CPU to busy ones
+                frame, metadata = self.input_queue.get(timeout=QUEUE_POLL_INTERVAL)
+            except Empty:
+                continue
+            with STAGE_PROFILER.profile('enhance'):
+                temporal_state = self.temporal_states.get(metadata) if metadata.get('temporal_enhance') else None
+                enhanced_frame = self._enhance_frame(frame, temporal_state)
+                # Streaming jobs hand the enhanced frame straight to the encoder instead of writing PNGs
+                if metadata.get('save_frames', True):
+                    self._save_enhanced_frame(enhanced_frame, metadata)
+            self.output_queue.put((enhanced_frame, enhanced_frame))
     
-    def _enhance_frame(self, frame):
+    def _enhance_frame(self, frame, temporal_state=None):
+        return self.enhancer.enhance(frame, temporal_state)
+
+    def _enhance_frame_reference(self, frame):
         # Apply noise reduction (Gaussian Blur)
         frame = cv2.GaussianBlur(frame, (5, 5), 0)
         
@@ -67,19 +335,7 @@ class EnhancementService:
         return cv2.addWeighted(frame, 1.5, gaussian, -0.5, 0)
 
     def _save_enhanced_frame(self, frame, metadata):
-        job_id = metadata['job_id']
-        frame_number = metadata['frame_number']
-        quality = metadata['quality']
-        
-        job_dir = os.path.join(self.output_dir, f"job_{job_id}", f"quality_{quality}")
-        os.makedirs(job_dir, exist_ok=True)
-        
-        frame_path = os.path.join(job_dir, f"frame_{frame_number:06d}.png")
-        try:
-            cv2.imwrite(frame_path, cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
-            logger.info(f"Enhanced frame saved: {frame_path}")
-        except Exception as e:
-            logger.error(f"Error saving enhanced frame: {str(e)}")  
+        save_enhanced_frame(frame, metadata, self.output_dir)
     
     def stop(self):
         self.is_running = False
\ No newline at end of file
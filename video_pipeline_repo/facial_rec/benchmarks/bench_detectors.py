@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+import json
+import argparse
+import numpy as np
+import cv2
+
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(root_dir)
+
+from facial_rec.src.detectors import DETECTORS, create_detector
+from facial_rec.src.tracking import box_iou
+
+def load_labelled_set(labels_path):
+    # JSON list of {"image": path, "faces": [[left, top, right, bottom], ...]}; paths are relative to the file
+    with open(labels_path) as f:
+        entries = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(labels_path))
+    samples = []
+    for entry in entries:
+        image = cv2.imread(os.path.join(base_dir, entry['image']))
+        if image is None:
+            print(f"Skipping unreadable image {entry['image']}")
+            continue
+        samples.append((image, [tuple(box) for box in entry['faces']]))
+    return samples
+
+def resize_sample(image, faces, quality):
+    width, height = (int(x) for x in quality.split('x'))
+    sx, sy = width / image.shape[1], height / image.shape[0]
+    resized = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    return resized, [(l * sx, t * sy, r * sx, b * sy) for l, t, r, b in faces]
+
+def evaluate(detector, samples, repeats, iou_threshold):
+    latencies = []
+    matched, labelled, detected = 0, 0, 0
+    for image, faces in samples:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            boxes = detector.detect(image)
+            latencies.append((time.perf_counter() - start) * 1000)
+        labelled += len(faces)
+        detected += len(boxes)
+        unmatched = list(boxes)
+        for face in faces:
+            best = max(unmatched, key=lambda box: box_iou(face, box), default=None)
+            if best is not None and box_iou(face, best) >= iou_threshold:
+                unmatched.remove(best)
+                matched += 1
+    latencies = np.array(latencies)
+    return {
+        "mean_ms": round(float(latencies.mean()), 2),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 2),
+        "recall": round(matched / labelled, 3) if labelled else None,
+        "precision": round(matched / detected, 3) if detected else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare face detector backends for speed and recall")
+    parser.add_argument('labels', help="JSON file listing images and their labelled face boxes")
+    parser.add_argument('--backends', nargs='+', default=list(DETECTORS), choices=list(DETECTORS))
+    parser.add_argument('--qualities', nargs='+', default=['640x360', '1280x720', '1920x1080'])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--iou-threshold', type=float, default=0.4, help="Backends draw boxes differently, so keep this loose")
+    parser.add_argument('--min-recall', type=float, default=0.9, help="Accuracy bar used to pick the cheapest backend")
+    parser.add_argument('--json', help="Write results to this file")
+    args = parser.parse_args()
+
+    samples = load_labelled_set(args.labels)
+    if not samples:
+        print(f"No labelled images could be read from {args.labels}")
+        sys.exit(1)
+
+    results = []
+    for backend in args.backends:
+        try:
+            detector = create_detector(backend)
+        except (ImportError, FileNotFoundError) as e:
+            print(f"Skipping {backend}: {e}")
+            continue
+        for quality in args.qualities:
+            resized = [resize_sample(image, faces, quality) for image, faces in samples]
+            result = {"backend": backend, "quality": quality, **evaluate(detector, resized, args.repeats, args.iou_threshold)}
+            results.append(result)
+            print(json.dumps(result))
+
+    recommendations = {}
+    for quality in args.qualities:
+        eligible = [r for r in results if r['quality'] == quality and r['recall'] is not None and r['recall'] >= args.min_recall]
+        best = min(eligible, key=lambda r: r['mean_ms'], default=None)
+        recommendations[quality] = best['backend'] if best else None
+    print(json.dumps({"cheapest_meeting_recall": recommendations, "min_recall": args.min_recall}, indent=2))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"results": results, "recommendations": recommendations}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+import json
+import argparse
+import numpy as np
+
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(root_dir)
+
+from facial_rec.src.gallery import FaceGallery, ENCODING_SIZE
+
+# Spreads chosen so synthetic identities sit ~0.9 apart and probes ~0.35 from their identity,
+# roughly what dlib's 128-d face encodings look like
+IDENTITY_SPREAD = 0.056
+PROBE_NOISE = 0.031
+
+def make_gallery(num_identities, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(0, IDENTITY_SPREAD, size=(num_identities, ENCODING_SIZE)).astype(np.float32)
+    gallery = FaceGallery()
+    gallery.enroll(None, centers)
+    gallery.names = [f"person_{i:06d}" for i in range(num_identities)]
+    return gallery, centers
+
+def make_probes(centers, count, seed=1):
+    rng = np.random.default_rng(seed)
+    identities = rng.integers(0, len(centers), size=count)
+    probes = centers[identities] + rng.normal(0, PROBE_NOISE, size=(count, ENCODING_SIZE)).astype(np.float32)
+    return probes, identities
+
+def time_matching(gallery, probes, faces_per_frame, nprobe):
+    matches = []
+    start = time.perf_counter()
+    for i in range(0, len(probes), faces_per_frame):
+        matches.extend(gallery.match(probes[i:i + faces_per_frame], nprobe=nprobe))
+    elapsed = time.perf_counter() - start
+    return matches, len(probes) / elapsed, (elapsed / max(1, len(probes) // faces_per_frame)) * 1000
+
+def accuracy(matches, identities):
+    correct = sum(1 for (name, _), identity in zip(matches, identities) if name == f"person_{identity:06d}")
+    return correct / len(identities)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark face gallery matching at large identity counts")
+    parser.add_argument('--identities', type=int, nargs='+', default=[10000, 50000])
+    parser.add_argument('--probes', type=int, default=2000)
+    parser.add_argument('--faces-per-frame', type=int, default=4)
+    parser.add_argument('--nprobe', type=int, default=8, help="Clusters scanned per query with the coarse index")
+    parser.add_argument('--json', help="Write results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for num_identities in args.identities:
+        gallery, centers = make_gallery(num_identities)
+        probes, identities = make_probes(centers, args.probes)
+
+        exact_matches, exact_fps, exact_ms = time_matching(gallery, probes, args.faces_per_frame, args.nprobe)
+
+        start = time.perf_counter()
+        gallery.build_index()
+        build_seconds = time.perf_counter() - start
+        indexed_matches, indexed_fps, indexed_ms = time_matching(gallery, probes, args.faces_per_frame, args.nprobe)
+
+        result = {
+            "identities": num_identities,
+            "faces_per_frame": args.faces_per_frame,
+            "exact_faces_per_sec": round(exact_fps, 1),
+            "exact_ms_per_frame": round(exact_ms, 3),
+            "exact_accuracy": round(accuracy(exact_matches, identities), 4),
+            "index_clusters": len(gallery.centroids),
+            "index_build_seconds": round(build_seconds, 2),
+            "indexed_faces_per_sec": round(indexed_fps, 1),
+            "indexed_ms_per_frame": round(indexed_ms, 3),
+            "indexed_accuracy": round(accuracy(indexed_matches, identities), 4),
+        }
+        results.append(result)
+        print(json.dumps(result))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import os
+import sys
+import time
+import json
+import argparse
+import numpy as np
+import cv2
+
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(root_dir)
+
+from facial_rec.src.facial_rec import FacialRecognitionService
+from facial_rec.src.tracking import box_iou
+
+def read_frames(video_path, quality, max_frames):
+    width, height = (int(x) for x in quality.split('x'))
+    capture = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < max_frames:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        frames.append(cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA))
+    capture.release()
+    return frames
+
+def run(service, frames, metadata, tracked):
+    boxes = []
+    start = time.perf_counter()
+    for frame_number, frame in enumerate(frames):
+        frame_metadata = dict(metadata, frame_number=frame_number)
+        if tracked:
+            faces = service._track_faces(frame, frame_metadata)
+        else:
+            faces = service._recognize_faces(frame, frame_metadata)
+        boxes.append([box for _, box in faces])
+    return boxes, len(frames) / (time.perf_counter() - start)
+
+def score(reference_boxes, tracked_boxes, iou_threshold):
+    ious = []
+    for reference, tracked in zip(reference_boxes, tracked_boxes):
+        for box in reference:
+            ious.append(max((box_iou(box, candidate) for candidate in tracked), default=0.0))
+    if not ious:
+        return 1.0, 1.0
+    ious = np.array(ious)
+    return float(ious.mean()), float((ious >= iou_threshold).mean())
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare detect-every-frame with detect-every-N plus tracking")
+    parser.add_argument('video', help="Input video with faces (talking head, surveillance, ...)")
+    parser.add_argument('--quality', default='1280x720')
+    parser.add_argument('--max-frames', type=int, default=300)
+    parser.add_argument('--detect-interval', type=int, default=10)
+    parser.add_argument('--iou-threshold', type=float, default=0.5)
+    parser.add_argument('--min-mean-iou', type=float, default=0.6, help="Fail if tracked boxes fall below this mean IoU")
+    parser.add_argument('--min-recall', type=float, default=0.9, help="Fail if fewer reference faces are matched")
+    parser.add_argument('--json', help="Write results to this file")
+    args = parser.parse_args()
+
+    frames = read_frames(args.video, args.quality, args.max_frames)
+    if not frames:
+        print(f"No frames could be read from {args.video}")
+        sys.exit(1)
+
+    service = FacialRecognitionService()
+    metadata = {"job_id": "bench", "quality": args.quality, "face_tracking": {"detect_interval": args.detect_interval}}
+    reference_boxes, detect_fps = run(service, frames, metadata, tracked=False)
+    tracked_boxes, tracked_fps = run(service, frames, metadata, tracked=True)
+    tracker = service.trackers.get(metadata)
+    mean_iou, recall = score(reference_boxes, tracked_boxes, args.iou_threshold)
+
+    result = {
+        "quality": args.quality,
+        "frames": len(frames),
+        "detect_interval": args.detect_interval,
+        "detect_every_frame_fps": round(detect_fps, 2),
+        "tracked_fps": round(tracked_fps, 2),
+        "speedup": round(tracked_fps / detect_fps, 2),
+        "detections": tracker.detections,
+        "mean_iou": round(mean_iou, 3),
+        "recall_at_iou": round(recall, 3),
+    }
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if mean_iou < args.min_mean_iou or recall < args.min_recall:
+        print("Tracked boxes are outside the accepted tolerance")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import os
+import logging
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+
+MODELS_DIR = os.environ.get('FACE_MODELS_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models'))
+SSD_PROTOTXT = os.path.join(MODELS_DIR, 'deploy.prototxt')
+SSD_MODEL = os.path.join(MODELS_DIR, 'res10_300x300_ssd_iter_140000.caffemodel')
+YUNET_MODEL = os.path.join(MODELS_DIR, 'face_detection_yunet_2023mar.onnx')
+DEFAULT_DETECTOR = 'hog'
+
+def _to_bgr(frame):
+    frame = np.ascontiguousarray(frame)
+    if frame.ndim == 2:
+        return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+    if frame.shape[2] == 4:
+        return cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+    return frame
+
+def _clip_box(left, top, right, bottom, width, height):
+    return (max(0, int(left)), max(0, int(top)), min(width, int(right)), min(height, int(bottom)))
+
+def _require_model(*paths):
+    for path in paths:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Face detector model not found: {path} (set FACE_MODELS_DIR or pass the path explicitly)")
+
+class HogDetector:
+    # dlib's HOG detector through face_recognition; the original detector for this service
+    name = 'hog'
+
+    def __init__(self, upsample=1):
+        import face_recognition
+        self.face_recognition = face_recognition
+        self.upsample = upsample
+
+    def detect(self, frame):
+        rgb = cv2.cvtColor(_to_bgr(frame), cv2.COLOR_BGR2RGB)
+        locations = self.face_recognition.face_locations(rgb, number_of_times_to_upsample=self.upsample)
+        return [(left, top, right, bottom) for (top, right, bottom, left) in locations]
+
+class SsdDetector:
+    # OpenCV's res10 SSD (Caffe) through cv2.dnn
+    name = 'ssd'
+
+    def __init__(self, prototxt=SSD_PROTOTXT, model=SSD_MODEL, confidence=0.5, input_size=(300, 300)):
+        _require_model(prototxt, model)
+        self.net = cv2.dnn.readNetFromCaffe(prototxt, model)
+        self.confidence = confidence
+        self.input_size = input_size
+
+    def detect(self, frame):
+        frame = _to_bgr(frame)
+        height, width = frame.shape[:2]
+        blob = cv2.dnn.blobFromImage(cv2.resize(frame, self.input_size), 1.0, self.input_size, (104.0, 177.0, 123.0))
+        self.net.setInput(blob)
+        detections = self.net.forward()[0, 0]
+        boxes = []
+        for detection in detections[detections[:, 2] >= self.confidence]:
+            left, top, right, bottom = detection[3:7] * np.array([width, height, width, height])
+            box = _clip_box(left, top, right, bottom, width, height)
+            if box[2] > box[0] and box[3] > box[1]:
+                boxes.append(box)
+        return boxes
+
+class YuNetDetector:
+    # OpenCV's YuNet (ONNX) through cv2.FaceDetectorYN
+    name = 'yunet'
+
+    def __init__(self, model=YUNET_MODEL, score_threshold=0.6, nms_threshold=0.3):
+        _require_model(model)
+        self.detector = cv2.FaceDetectorYN.create(model, "", (320, 320), score_threshold, nms_threshold)
+        self.input_size = None
+
+    def detect(self, frame):
+        frame = _to_bgr(frame)
+        height, width = frame.shape[:2]
+        if self.input_size != (width, height):
+            self.detector.setInputSize((width, height))
+            self.input_size = (width, height)
+        _, faces = self.detector.detect(frame)
+        if faces is None:
+            return []
+        return [_clip_box(x, y, x + w, y + h, width, height) for x, y, w, h in faces[:, :4]]
+
+class HaarDetector:
+    # Viola-Jones cascade on a downscaled gray frame; the cheapest and least accurate option
+    name = 'haar'
+
+    def __init__(self, cascade='haarcascade_frontalface_default.xml', scale_factor=1.1, min_neighbors=5,
+                 min_size=(24, 24), detect_width=640):
+        path = cascade if os.path.exists(cascade) else os.path.join(cv2.data.haarcascades, cascade)
+        self.classifier = cv2.CascadeClassifier(path)
+        if self.classifier.empty():
+            raise FileNotFoundError(f"Could not load Haar cascade: {path}")
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = tuple(min_size)
+        self.detect_width = detect_width
+
+    def detect(self, frame):
+        frame = _to_bgr(frame)
+        height, width = frame.shape[:2]
+        scale = min(1.0, self.detect_width / width)
+        small = frame if scale == 1.0 else cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        gray = cv2.equalizeHist(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY))
+        faces = self.classifier.detectMultiScale(gray, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors,
+                                                 minSize=self.min_size)
+        return [_clip_box(x / scale, y / scale, (x + w) / scale, (y + h) / scale, width, height) for x, y, w, h in faces]
+
+DETECTORS = {
+    'hog': HogDetector,
+    'ssd': SsdDetector,
+    'yunet': YuNetDetector,
+    'haar': HaarDetector,
+}
+
+def detector_spec(setting):
+    # A job asks for a backend by name, or by {"backend": name, ...constructor options}
+    if not setting:
+        return DEFAULT_DETECTOR, {}
+    if isinstance(setting, str):
+        return setting, {}
+    options = dict(setting)
+    return options.pop('backend', DEFAULT_DETECTOR), options
+
+def create_detector(setting=None):
+    name, options = detector_spec(setting)
+    if name not in DETECTORS:
+        raise ValueError(f"Unknown face detector backend: {name} (expected one of {', '.join(DETECTORS)})")
+    return DETECTORS[name](**options)
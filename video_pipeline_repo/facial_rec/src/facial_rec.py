@@ -1,65 +1,201 @@
 import threading
-from queue import Queue
+from queue import Queue, Empty
 import numpy as np
 import cv2 
-import face_recognition
+import json
 import logging
 import os
 import sys 
 
-# Configure logging to output to stdout
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(root_dir)
+
+from facial_rec.src.tracking import FaceTrackerRegistry
+from facial_rec.src.gallery import get_gallery
+from facial_rec.src.detectors import create_detector, detector_spec, DEFAULT_DETECTOR
+from common.src.profiling import STAGE_PROFILER
+from common.src.logging_setup import configure_logging
+
+configure_logging('facial_rec')
 
 # logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+QUEUE_POLL_INTERVAL = 0.5
+
+def save_annotated_frame(frame, recognized_faces, metadata):
+    for name, (left, top, right, bottom) in recognized_faces:
+        label = name if name != "Unknown" else "Face Detected"
+        cv2.rectangle(frame, (left, top), (right, bottom), (0, 255, 0), 2)
+        cv2.putText(frame, label, (left, top - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 255, 0), 2)
+
+    output_folder = os.path.join('processed_frames', metadata['job_id'], metadata['quality'])
+    os.makedirs(output_folder, exist_ok=True)
+    frame_filename = f"frame_{metadata['frame_number']:06d}.png"
+    frame_path = os.path.join(output_folder, frame_filename)
+    cv2.imwrite(frame_path, frame)
+
 class FacialRecognitionService:
-    def __init__(self):
+    def __init__(self, trackers=None):
         self.input_queue = Queue()
         self.output_queue = Queue()
         self.is_running = True
+        # Shared across the recognition pool so a stream keeps its tracks whichever instance gets the frame
+        self.trackers = trackers if trackers is not None else FaceTrackerRegistry()
+        # Backends are built on first use and owned by this worker; cv2.dnn nets are not thread-safe
+        self.detectors = {}
     
     def start(self):
         while self.is_running:
-            if not self.input_queue.empty():
-                logger.info(f"Reading frame in the facial recognition service now")
-                frame, metadata = self.input_queue.get()
-                logger.info(f"Frame before facial recognition: shape={frame.shape}, dtype={frame.dtype}, first pixel={frame[0,0]}")
+            try:
+                # Block instead of spinning so idle workers leave the CPU to busy ones
+                frame, metadata = self.input_queue.get(timeout=QUEUE_POLL_INTERVAL)
+            except Empty:
+                continue
+            logger.debug("Frame before facial recognition: shape=%s, dtype=%s", frame.shape, frame.dtype)
+            try:
+                with STAGE_PROFILER.profile('recognize'):
+                    recognized_faces = self._process_frame(frame, metadata)
+            except Exception:
+                # The process service blocks on this queue, so a failed frame still has to answer it
+                logger.exception(f"Facial recognition failed on frame {metadata.get('frame_number')} of job {metadata.get('job_id')}")
+                recognized_faces = None
+            self.output_queue.put((None, recognized_faces))  # Return the face boxes to the process service
+
+    def _process_frame(self, frame, metadata):
+        if metadata.get('face_hints') is not None:
+            # Boxes were already detected on another rung of the quality ladder
+            recognized_faces = self._faces_from_hints(frame, metadata)
+        elif metadata.get('face_tracking'):
+            recognized_faces = self._track_faces(frame, metadata)
+        else:
+            if metadata.get('motion_gate') == 'roi' and metadata.get('motion_regions') is not None:
+                # Only search the parts of the frame that changed
+                recognized_faces = self._recognize_faces_in_regions(frame, metadata['motion_regions'], metadata)
+            else:
                 recognized_faces = self._recognize_faces(frame, metadata)
-                self._save_annotated_frame(frame, recognized_faces, metadata)
-                self.output_queue.put((None, None))  # Send empty output to process service
+            if metadata.get('face_gallery'):
+                recognized_faces = self._identify_faces(frame, recognized_faces, metadata)
+        if metadata.get('save_annotated_frames', True):
+            self._save_annotated_frame(frame, recognized_faces, metadata)
+        return recognized_faces
     
+    def warm_up(self, face_detector=None):
+        # Loads the detector model now rather than on this worker's first frame
+        return self._detector({'face_detector': face_detector})
+
+    def _detector(self, metadata):
+        setting = metadata.get('face_detector')
+        name, options = detector_spec(setting)
+        key = (name, json.dumps(options, sort_keys=True))
+        detector = self.detectors.get(key)
+        if detector is None:
+            try:
+                detector = create_detector(setting)
+            except (ValueError, FileNotFoundError) as e:
+                if name == DEFAULT_DETECTOR:
+                    raise
+                logger.error(f"Face detector {name} unavailable ({e}); falling back to {DEFAULT_DETECTOR}")
+                detector = self.detectors.get((DEFAULT_DETECTOR, '{}')) or create_detector(DEFAULT_DETECTOR)
+            self.detectors[key] = detector
+        return detector
+
     def _recognize_faces(self, frame, metadata):
-        # Ensure the frame is contiguous and in the correct format
-        frame = np.ascontiguousarray(frame)
-        if frame.shape[2] == 3:  # If it's a 3-channel image
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        elif frame.shape[2] == 4:  # If it has an alpha channel
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2RGB)
-        
-        logger.info(f"Frame shape before running facial rec: {frame.shape}, dtype: {frame.dtype}")
-        face_locations = face_recognition.face_locations(frame)
-        
+        detector = self._detector(metadata)
+        logger.debug("Frame shape before running facial rec: %s, dtype: %s, detector: %s", frame.shape, frame.dtype, detector.name)
+        return [("Unknown", box) for box in detector.detect(frame)]
+
+    def _recognize_faces_in_regions(self, frame, regions, metadata):
         recognized_faces = []
-        for (top, right, bottom, left) in face_locations:
-            recognized_faces.append(("Unknown", (left, top, right, bottom)))
+        for (x0, y0, x1, y1) in regions:
+            if x1 <= x0 or y1 <= y0:
+                continue
+            for name, (left, top, right, bottom) in self._recognize_faces(frame[y0:y1, x0:x1], metadata):
+                recognized_faces.append((name, (left + x0, top + y0, right + x0, bottom + y0)))
+        return recognized_faces
 
+    def _track_faces(self, frame, metadata):
+        # Full detection on keyframes, scene cuts and low-confidence tracks; optical flow in between
+        tracker = self.trackers.get(metadata)
+        with tracker.lock:
+            if tracker.needs_detection(frame):
+                detected = self._recognize_faces(frame, metadata)
+                boxes = tracker.update_from_detections(frame, [box for _, box in detected])
+            else:
+                boxes = tracker.propagate(frame)
+            recognized_faces = [("Unknown", box) for box in boxes]
+            if metadata.get('face_gallery'):
+                recognized_faces = self._identify_tracked_faces(frame, recognized_faces, tracker, metadata)
         return recognized_faces
 
+    def _identify_faces(self, frame, recognized_faces, metadata):
+        if not recognized_faces:
+            return recognized_faces
+        import face_recognition
+        gallery = get_gallery(metadata['face_gallery'])
+        height, width = frame.shape[:2]
+        rgb = cv2.cvtColor(np.ascontiguousarray(frame[:, :, :3]), cv2.COLOR_BGR2RGB)
+        # Tracked boxes can drift past the frame edge; the landmark model needs them inside it
+        locations = [
+            (max(top, 0), min(right, width), min(bottom, height), max(left, 0))
+            for _, (left, top, right, bottom) in recognized_faces
+        ]
+        encodings = face_recognition.face_encodings(rgb, known_face_locations=locations)
+        matches = gallery.match(encodings)
+        return [(name, box) for (name, _), (_, box) in zip(matches, recognized_faces)]
+
+    def _identify_tracked_faces(self, frame, recognized_faces, tracker, metadata):
+        # A face is encoded once per track; unknown tracks get another try on detection frames only
+        track_ids = [track.track_id for track in tracker.tracks]
+        retry_unknown = tracker.frames_since_detection == 1
+        pending = [
+            i for i, track_id in enumerate(track_ids)
+            if track_id not in tracker.identities or (retry_unknown and tracker.identities[track_id] == "Unknown")
+        ]
+        if pending:
+            identified = self._identify_faces(frame, [recognized_faces[i] for i in pending], metadata)
+            for i, (name, _) in zip(pending, identified):
+                tracker.identities[track_ids[i]] = name
+        tracker.identities = {track_id: tracker.identities[track_id] for track_id in track_ids}
+        return [(tracker.identities[track_id], box) for track_id, (_, box) in zip(track_ids, recognized_faces)]
+
+    def _faces_from_hints(self, frame, metadata):
+        hints = [tuple(box) for box in metadata['face_hints']]
+        labels = metadata.get('face_hint_labels') or ["Unknown"] * len(hints)
+        faces = list(zip(labels, hints))
+        if metadata.get('refine_faces'):
+            faces = self._refine_faces(frame, faces, metadata)
+        return faces
+
+    def _refine_faces(self, frame, faces, metadata, padding=0.25):
+        # Takes and returns (label, box) pairs, so a box dropped here cannot shift the labels of the rest
+        height, width = frame.shape[:2]
+        refined = []
+        for label, (left, top, right, bottom) in faces:
+            pad_x = int((right - left) * padding)
+            pad_y = int((bottom - top) * padding)
+            x0, y0 = max(0, left - pad_x), max(0, top - pad_y)
+            x1, y1 = min(width, right + pad_x), min(height, bottom + pad_y)
+            if x1 <= x0 or y1 <= y0:
+                continue
+
+            locations = [box for _, box in self._recognize_faces(frame[y0:y1, x0:x1], metadata)]
+            if not locations:
+                # Keep the rescaled box when the high resolution pass cannot confirm it
+                refined.append((label, (left, top, right, bottom)))
+                continue
+
+            # Pick the detection whose centre is closest to the hinted box centre
+            cx, cy = (left + right) / 2 - x0, (top + bottom) / 2 - y0
+            r_left, r_top, r_right, r_bottom = min(
+                locations,
+                key=lambda loc: ((loc[0] + loc[2]) / 2 - cx) ** 2 + ((loc[1] + loc[3]) / 2 - cy) ** 2
+            )
+            refined.append((label, (r_left + x0, r_top + y0, r_right + x0, r_bottom + y0)))
+        return refined
+
     def _save_annotated_frame(self, frame, recognized_faces, metadata):
-        for _, (left, top, right, bottom) in recognized_faces:
-            cv2.rectangle(frame, (left, top), (right, bottom), (0, 255, 0), 2)
-            cv2.putText(frame, "Face Detected", (left, top - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 255, 0), 2)
-
-        output_folder = os.path.join('processed_frames', metadata['job_id'], metadata['quality'])
-        os.makedirs(output_folder, exist_ok=True)
-        frame_filename = f"frame_{metadata['frame_number']:06d}.png"
-        frame_path = os.path.join(output_folder, frame_filename)
-        cv2.imwrite(frame_path, frame)
+        save_annotated_frame(frame, recognized_faces, metadata)
 
     def stop(self):
         self.is_running = False
\ No newline at end of file
@@ -0,0 +1,155 @@
+import os
+import threading
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ENCODING_SIZE = 128
+DEFAULT_TOLERANCE = 0.6  # face_recognition's recommended distance threshold
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+class FaceGallery:
+    def __init__(self, tolerance=DEFAULT_TOLERANCE):
+        self.tolerance = tolerance
+        self.names = []
+        self.encodings = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        self.squared_norms = np.empty(0, dtype=np.float32)
+        self.centroids = None
+        self.cluster_members = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def enroll(self, name, encodings):
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        with self.lock:
+            self.names.extend([name] * len(encodings))
+            self.encodings = np.ascontiguousarray(np.vstack([self.encodings, encodings]))
+            self.squared_norms = np.einsum('ij,ij->i', self.encodings, self.encodings)
+            # Any coarse index is stale once new rows arrive
+            self.centroids = None
+            self.cluster_members = None
+
+    def enroll_images(self, name, image_paths):
+        import face_recognition
+        encodings = []
+        for image_path in image_paths:
+            image = face_recognition.load_image_file(image_path)
+            found = face_recognition.face_encodings(image)
+            if len(found) != 1:
+                logger.warning(f"Skipping {image_path} for {name}: expected one face, found {len(found)}")
+                continue
+            encodings.append(found[0])
+        if encodings:
+            self.enroll(name, encodings)
+        return len(encodings)
+
+    @classmethod
+    def from_directory(cls, directory, tolerance=DEFAULT_TOLERANCE):
+        # One sub-directory per identity, holding that person's reference images
+        gallery = cls(tolerance)
+        for name in sorted(os.listdir(directory)):
+            identity_dir = os.path.join(directory, name)
+            if not os.path.isdir(identity_dir):
+                continue
+            image_paths = [os.path.join(identity_dir, f) for f in sorted(os.listdir(identity_dir))
+                           if f.lower().endswith(IMAGE_EXTENSIONS)]
+            gallery.enroll_images(name, image_paths)
+        logger.info(f"Enrolled {len(gallery)} reference encodings from {directory}")
+        return gallery
+
+    @classmethod
+    def load(cls, path, tolerance=DEFAULT_TOLERANCE):
+        with np.load(path, allow_pickle=False) as data:
+            gallery = cls(tolerance)
+            gallery.enroll(None, data['encodings'])
+            gallery.names = [str(name) for name in data['names']]
+            if 'centroids' in data:
+                gallery.centroids = data['centroids']
+                gallery.cluster_members = gallery._members_from_assignments(data['assignments'], len(gallery.centroids))
+        logger.info(f"Loaded face gallery with {len(gallery)} encodings from {path}")
+        return gallery
+
+    def save(self, path):
+        arrays = {"names": np.array(self.names), "encodings": self.encodings}
+        if self.centroids is not None:
+            assignments = np.empty(len(self.names), dtype=np.int32)
+            for cluster, members in enumerate(self.cluster_members):
+                assignments[members] = cluster
+            arrays.update(centroids=self.centroids, assignments=assignments)
+        np.savez(path, **arrays)
+
+    def _squared_distances(self, queries, rows=None):
+        encodings = self.encodings if rows is None else self.encodings[rows]
+        norms = self.squared_norms if rows is None else self.squared_norms[rows]
+        query_norms = np.einsum('ij,ij->i', queries, queries)
+        distances = query_norms[:, None] + norms[None, :] - 2.0 * (queries @ encodings.T)
+        return np.maximum(distances, 0.0, out=distances)
+
+    def _members_from_assignments(self, assignments, num_clusters):
+        order = np.argsort(assignments, kind='stable')
+        bounds = np.searchsorted(assignments[order], np.arange(num_clusters + 1))
+        return [order[bounds[i]:bounds[i + 1]] for i in range(num_clusters)]
+
+    def build_index(self, num_clusters=None, iterations=10, seed=0):
+        # Coarse k-means partition (IVF): queries only scan the clusters nearest to them
+        count = len(self.names)
+        if count == 0:
+            return
+        num_clusters = num_clusters or max(1, int(np.sqrt(count)))
+        rng = np.random.default_rng(seed)
+        centroids = self.encodings[rng.choice(count, size=min(num_clusters, count), replace=False)].copy()
+        for _ in range(iterations):
+            centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+            assignments = np.argmin(centroid_norms[None, :] - 2.0 * (self.encodings @ centroids.T), axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, self.encodings)
+            counts = np.bincount(assignments, minlength=len(centroids))
+            populated = counts > 0
+            centroids[populated] = sums[populated] / counts[populated, None]
+        with self.lock:
+            self.centroids = centroids.astype(np.float32)
+            self.cluster_members = self._members_from_assignments(assignments, len(centroids))
+
+    def match(self, query_encodings, nprobe=8):
+        queries = np.asarray(query_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        if len(queries) == 0 or len(self.names) == 0:
+            return [("Unknown", None)] * len(queries)
+
+        if self.centroids is None:
+            # Exhaustive search: one matrix product for every face in the frame
+            distances = self._squared_distances(queries)
+            best = np.argmin(distances, axis=1)
+            best_distances = np.sqrt(distances[np.arange(len(queries)), best])
+        else:
+            best = np.empty(len(queries), dtype=np.int64)
+            best_distances = np.empty(len(queries), dtype=np.float32)
+            centroid_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+            nearest_clusters = np.argsort(centroid_norms[None, :] - 2.0 * (queries @ self.centroids.T), axis=1)[:, :nprobe]
+            for i, clusters in enumerate(nearest_clusters):
+                rows = np.concatenate([self.cluster_members[c] for c in clusters])
+                if len(rows) == 0:
+                    best[i], best_distances[i] = 0, np.inf
+                    continue
+                distances = self._squared_distances(queries[i:i + 1], rows)[0]
+                j = int(np.argmin(distances))
+                best[i], best_distances[i] = rows[j], np.sqrt(distances[j])
+
+        return [
+            (self.names[index], float(distance)) if distance <= self.tolerance else ("Unknown", float(distance))
+            for index, distance in zip(best, best_distances)
+        ]
+
+_galleries = {}
+_galleries_lock = threading.Lock()
+
+def get_gallery(path):
+    # Galleries are loaded once per process and shared by every recognition worker
+    with _galleries_lock:
+        gallery = _galleries.get(path)
+        if gallery is None:
+            gallery = FaceGallery.from_directory(path) if os.path.isdir(path) else FaceGallery.load(path)
+            _galleries[path] = gallery
+        return gallery
@@ -0,0 +1,168 @@
+import threading
+import logging
+import numpy as np
+import cv2
+
+from common.src.frame_analysis import SceneChangeDetector
+
+logger = logging.getLogger(__name__)
+
+TRACKING_WIDTH = 320
+LK_PARAMS = dict(
+    winSize=(15, 15),
+    maxLevel=2,
+    criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03)
+)
+
+def box_iou(a, b):
+    left, top = max(a[0], b[0]), max(a[1], b[1])
+    right, bottom = min(a[2], b[2]), min(a[3], b[3])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+class FaceTrack:
+    def __init__(self, track_id, box):
+        self.track_id = track_id
+        self.box = np.array(box, dtype=np.float32)  # left, top, right, bottom in tracking-scale pixels
+        self.points = None
+        self.initial_points = 0
+        self.confidence = 1.0
+
+class FaceTracker:
+    def __init__(self, detect_interval=10, scene_threshold=0.35, min_confidence=0.5, min_points=4, max_fb_error=1.0):
+        self.detect_interval = detect_interval
+        self.min_confidence = min_confidence
+        self.min_points = min_points
+        self.max_fb_error = max_fb_error
+        self.scene_detector = SceneChangeDetector(scene_threshold)
+        self.tracks = []
+        self.identities = {}  # track_id -> gallery name, so each face is encoded once per track
+        self.next_track_id = 0
+        self.previous_gray = None
+        self.scale = 1.0
+        self.frames_since_detection = 0
+        self.detections = 0
+        self.tracked_frames = 0
+        self.lock = threading.Lock()
+
+    def _tracking_gray(self, frame):
+        self.scale = min(1.0, TRACKING_WIDTH / frame.shape[1])
+        small = frame
+        if self.scale < 1.0:
+            small = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+
+    def needs_detection(self, frame):
+        if self.previous_gray is None or self.frames_since_detection >= self.detect_interval:
+            return True
+        if any(track.confidence < self.min_confidence for track in self.tracks):
+            return True
+        is_scene_change, _, _ = self.scene_detector.check(frame)
+        return is_scene_change
+
+    def _seed_points(self, gray, track):
+        left, top, right, bottom = track.box.astype(int)
+        mask = np.zeros_like(gray)
+        mask[max(top, 0):max(bottom, 0), max(left, 0):max(right, 0)] = 255
+        points = cv2.goodFeaturesToTrack(gray, maxCorners=20, qualityLevel=0.01, minDistance=3, mask=mask)
+        if points is None or len(points) < self.min_points:
+            # Flat faces (low light, small boxes) get a regular grid over the inner box instead
+            xs = np.linspace(left + (right - left) * 0.2, right - (right - left) * 0.2, 4)
+            ys = np.linspace(top + (bottom - top) * 0.2, bottom - (bottom - top) * 0.2, 4)
+            points = np.array([[[x, y]] for y in ys for x in xs], dtype=np.float32)
+        track.points = points.astype(np.float32)
+        track.initial_points = len(track.points)
+        track.confidence = 1.0
+
+    def update_from_detections(self, frame, boxes):
+        gray = self._tracking_gray(frame)
+        scaled_boxes = [np.array(box, dtype=np.float32) * self.scale for box in boxes]
+
+        # Keep track ids stable by matching fresh detections to the boxes being tracked
+        tracks = []
+        unmatched = list(self.tracks)
+        for box in scaled_boxes:
+            best = max(unmatched, key=lambda track: box_iou(track.box, box), default=None)
+            if best is not None and box_iou(best.box, box) > 0.3:
+                unmatched.remove(best)
+                best.box = box
+                track = best
+            else:
+                track = FaceTrack(self.next_track_id, box)
+                self.next_track_id += 1
+            self._seed_points(gray, track)
+            tracks.append(track)
+
+        self.tracks = tracks
+        self.previous_gray = gray
+        self.frames_since_detection = 1
+        self.detections += 1
+        self.scene_detector.set_reference(self.scene_detector.histogram(frame))
+        return self.boxes()
+
+    def propagate(self, frame):
+        gray = self._tracking_gray(frame)
+        surviving = []
+        for track in self.tracks:
+            new_points, status, _ = cv2.calcOpticalFlowPyrLK(self.previous_gray, gray, track.points, None, **LK_PARAMS)
+            back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.previous_gray, new_points, None, **LK_PARAMS)
+            fb_error = np.linalg.norm((track.points - back_points).reshape(-1, 2), axis=1)
+            good = (status.ravel() == 1) & (back_status.ravel() == 1) & (fb_error < self.max_fb_error)
+            if good.sum() < self.min_points:
+                continue
+
+            old = track.points.reshape(-1, 2)[good]
+            new = new_points.reshape(-1, 2)[good]
+            dx, dy = np.median(new - old, axis=0)
+
+            # Scale change is the median ratio of pairwise point distances
+            old_dist = np.linalg.norm(old[:, None, :] - old[None, :, :], axis=2)
+            new_dist = np.linalg.norm(new[:, None, :] - new[None, :, :], axis=2)
+            pairs = old_dist > 1e-3
+            scale = float(np.median(new_dist[pairs] / old_dist[pairs])) if pairs.any() else 1.0
+
+            left, top, right, bottom = track.box
+            cx, cy = (left + right) / 2 + dx, (top + bottom) / 2 + dy
+            half_w, half_h = (right - left) * scale / 2, (bottom - top) * scale / 2
+            track.box = np.array([cx - half_w, cy - half_h, cx + half_w, cy + half_h], dtype=np.float32)
+            track.points = new.reshape(-1, 1, 2)
+            track.confidence = good.sum() / max(track.initial_points, 1)
+            surviving.append(track)
+
+        self.tracks = surviving
+        self.previous_gray = gray
+        self.frames_since_detection += 1
+        self.tracked_frames += 1
+        return self.boxes()
+
+    def boxes(self):
+        return [tuple(int(round(v / self.scale)) for v in track.box) for track in self.tracks]
+
+class FaceTrackerRegistry:
+    def __init__(self):
+        self.trackers = {}
+        self.lock = threading.Lock()
+
+    def get(self, metadata):
+        key = (metadata.get('stream_id', metadata['job_id']), metadata['quality'])
+        with self.lock:
+            tracker = self.trackers.get(key)
+            if tracker is None:
+                settings = metadata.get('face_tracking')
+                settings = settings if isinstance(settings, dict) else {}
+                tracker = FaceTracker(
+                    detect_interval=settings.get('detect_interval', 10),
+                    scene_threshold=settings.get('scene_threshold', 0.35),
+                    min_confidence=settings.get('min_confidence', 0.5)
+                )
+                self.trackers[key] = tracker
+            return tracker
+
+    def discard_job(self, job_id):
+        with self.lock:
+            keys = [key for key in self.trackers if key[0] == job_id]
+            trackers = [(key[1], self.trackers.pop(key)) for key in keys]
+        for quality, tracker in trackers:
+            logger.info(f"Face tracking for job {job_id}, quality {quality}: "
+                        f"{tracker.detections} detections, {tracker.tracked_frames} tracked frames")
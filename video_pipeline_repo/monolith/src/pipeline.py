@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import argparse
+import threading
+import logging
+import cv2
+
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(root_dir)
+
+from video_decoder.src.decoder import VideoDecoderService
+from video_process.src.process import ProcessorService
+from video_encoder.src.encoder import EncoderService, DEFAULT_ENCODE_OPTIONS
+from common.src.job_store import MemoryJobStore
+from common.src.ladder import select_ladder, fit_ladder
+from common.src.logging_setup import configure_logging
+
+configure_logging('monolith')
+logger = logging.getLogger(__name__)
+
+OUTPUT_DIR = 'monolith_output'
+DEFAULT_PIPELINE = ['enhance']
+# Frames held between the decoder and the stages per rung; at 1080p each one is about 6 MB
+DEFAULT_QUEUE_FRAMES = 32
+QUEUE_POLL_INTERVAL = 0.5
+
+class StreamingFrameBuffer:
+    # Bounded hand-off from a decoder pipe to process_frames, so a slow stage holds the decoder back
+    # instead of frames piling up in memory
+    _END = object()
+
+    def __init__(self, max_size=DEFAULT_QUEUE_FRAMES):
+        self.queue = queue.Queue(maxsize=max_size)
+        self.abandoned = threading.Event()
+
+    def put(self, frame):
+        # Returns False once the consumer has stopped, so the producer can stop decoding
+        while not self.abandoned.is_set():
+            try:
+                self.queue.put(frame, timeout=QUEUE_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def close(self):
+        self.put(self._END)
+
+    def frames(self):
+        try:
+            while True:
+                frame = self.queue.get()
+                if frame is self._END:
+                    return
+                yield frame
+        finally:
+            self.abandoned.set()
+
+def probe_video(path):
+    # The same fields ingestion publishes for the distributed pipeline
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"Cannot open video {path}")
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        frame_count = capture.get(cv2.CAP_PROP_FRAME_COUNT)
+        return {
+            "fps": fps,
+            "width": capture.get(cv2.CAP_PROP_FRAME_WIDTH),
+            "height": capture.get(cv2.CAP_PROP_FRAME_HEIGHT),
+            "frame_count": frame_count,
+            "duration": frame_count / fps if fps > 0 else 0,
+        }
+    finally:
+        capture.release()
+
+class MonolithPipeline:
+    # Decoder, stage pools and encoder in one process: frames go decoder pipe -> bounded queue -> stages -> ffmpeg
+    # pipe, with none of the service hops or intermediate .raw/.png files
+    def __init__(self, output_dir=OUTPUT_DIR, queue_frames=DEFAULT_QUEUE_FRAMES, job_store=None):
+        self.output_dir = output_dir
+        self.queue_frames = queue_frames
+        job_store = job_store or MemoryJobStore()
+        self.decoder = VideoDecoderService(None, None, None, None, job_store=job_store)
+        self.processor = ProcessorService(None, output_dir, job_store=job_store)
+        self.processor.encoder_service = EncoderService(output_dir=output_dir, job_store=job_store)
+        self.thread_budget = self.processor.thread_budget
+
+    def _feed(self, input_path, quality, fps, threads, buffer):
+        frames = 0
+        try:
+            # bgr24 gives the same channel order the processor produces from the decoder's rgb24 .raw files
+            for frame in self.decoder.stream_frames(input_path, quality, fps, threads, pix_fmt='bgr24'):
+                if not buffer.put(frame):
+                    logger.warning(f"Processing of {quality} stopped early; stopping its decoder")
+                    break
+                frames += 1
+        except Exception as e:
+            logger.error(f"Decoding {input_path} at {quality} failed: {str(e)}")
+        finally:
+            buffer.close()
+            logger.info(f"Decoded {frames} frames of {input_path} at {quality}")
+
+    def run(self, input_path, job_id=None, quality_levels=None, pipeline_config=None, processing_options=None,
+            encode_options=None):
+        job_id = job_id or f"local_{uuid.uuid4().hex[:8]}"
+        pipeline_config = list(pipeline_config or DEFAULT_PIPELINE)
+        # Same processing_options as a distributed job; streaming encode is what makes it file-free
+        options = dict(processing_options or {})
+        options['stream_encode'] = True
+        options.setdefault('save_annotated_frames', False)
+        options.setdefault('save_frame_metadata', False)
+        if encode_options is not None:
+            options['encode_options'] = encode_options
+
+        start = time.perf_counter()
+        metadata = probe_video(input_path)
+        # Same ladder rules as ingestion and the decoder; there is no scan pass here to measure complexity
+        quality_levels = fit_ladder(quality_levels, metadata) if quality_levels else select_ladder(metadata)
+        fps = metadata['fps'] or 30
+        os.makedirs(self.output_dir, exist_ok=True)
+        processed_qualities, derived_qualities = self.processor.split_quality_ladder(job_id, quality_levels, pipeline_config, options)
+
+        buffers = {quality: StreamingFrameBuffer(self.queue_frames) for quality in processed_qualities}
+        threads = self.thread_budget.ffmpeg_threads_per_process(len(processed_qualities))
+        feeders = [threading.Thread(target=self._feed, args=(input_path, quality, fps, threads, buffer),
+                                    name=f'decode-{quality}', daemon=True)
+                   for quality, buffer in buffers.items()]
+        for feeder in feeders:
+            feeder.start()
+
+        success = False
+        try:
+            success = self.processor.process_buffers(job_id, metadata, quality_levels, buffers, processed_qualities,
+                                                     derived_qualities, 'normal', pipeline_config, options)
+        finally:
+            for buffer in buffers.values():
+                buffer.abandoned.set()
+            for feeder in feeders:
+                feeder.join()
+
+        elapsed = time.perf_counter() - start
+        logger.info(f"Job {job_id} {'finished' if success else 'failed'} in {elapsed:.1f}s; output in {self.output_dir}")
+        return {"job_id": job_id, "success": bool(success), "seconds": round(elapsed, 2), "output_dir": self.output_dir}
+
+def main():
+    parser = argparse.ArgumentParser(description="Run decode, processing and encode for a local video in a single process")
+    parser.add_argument('input', help="Local video file")
+    parser.add_argument('--job-id')
+    parser.add_argument('--output-dir', default=OUTPUT_DIR)
+    parser.add_argument('--quality-levels', nargs='+', help="Defaults to a ladder chosen from the source")
+    parser.add_argument('--pipeline', nargs='+', default=DEFAULT_PIPELINE)
+    parser.add_argument('--processing-options', default='{}', help="JSON, as sent in a distributed job's user settings")
+    parser.add_argument('--codec', default=DEFAULT_ENCODE_OPTIONS['codec'])
+    parser.add_argument('--preset', default=DEFAULT_ENCODE_OPTIONS['preset'])
+    parser.add_argument('--crf', type=int, default=DEFAULT_ENCODE_OPTIONS['crf'])
+    parser.add_argument('--packaging', default=DEFAULT_ENCODE_OPTIONS['packaging'], choices=['mp4', 'hls'])
+    parser.add_argument('--queue-frames', type=int, default=DEFAULT_QUEUE_FRAMES, help="Frames buffered per rung")
+    args = parser.parse_args()
+
+    processing_options = json.loads(args.processing_options)
+    encode_options = dict(processing_options.get('encode_options') or {},
+                          codec=args.codec, preset=args.preset, crf=args.crf, packaging=args.packaging)
+    pipeline = MonolithPipeline(output_dir=args.output_dir, queue_frames=args.queue_frames)
+    result = pipeline.run(args.input, args.job_id, args.quality_levels, args.pipeline, processing_options, encode_options)
+    print(json.dumps(result))
+    sys.exit(0 if result['success'] else 1)
+
+if __name__ == "__main__":
+    main()
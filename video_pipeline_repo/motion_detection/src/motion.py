@@ -0,0 +1,189 @@
+import threading
+import logging
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+
+MOTION_WIDTH = 320
+SHADOW_VALUE = 127  # MOG2 marks shadows with this value; they are not motion
+# In 'roi' mode a previous face box touched by motion is searched with this share of its size around it,
+# and no search region is smaller than MIN_SEARCH_SIZE pixels a side, so the detector sees a whole face
+FACE_SEARCH_MARGIN = 0.5
+MIN_SEARCH_SIZE = 96
+
+def _overlaps(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def _contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and inner[2] <= outer[2] and inner[3] <= outer[3]
+
+def _union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def _grow(box, margin, min_size, width, height):
+    # Pads the box by margin of its size, then widens it to min_size, clamped to the frame
+    left, top, right, bottom = box
+    pad_x, pad_y = (right - left) * margin, (bottom - top) * margin
+    pad_x = max(pad_x, (min_size - (right - left)) / 2)
+    pad_y = max(pad_y, (min_size - (bottom - top)) / 2)
+    return (max(0, int(left - pad_x)), max(0, int(top - pad_y)), min(width, int(right + pad_x)), min(height, int(bottom + pad_y)))
+
+def _merge_regions(regions):
+    # Overlapping boxes become one, so a person is one region rather than a handful of limbs
+    merged = []
+    for box in sorted(regions):
+        for i, other in enumerate(merged):
+            if _overlaps(box, other):
+                merged[i] = _union(box, other)
+                break
+        else:
+            merged.append(box)
+    return merged
+
+class MotionDetector:
+    def __init__(self, method='mog2', pixel_threshold=25, min_score=0.002, min_region_area=0.001, padding=0.1,
+                 history=500, var_threshold=16, warmup_frames=5):
+        if method not in ('mog2', 'diff'):
+            raise ValueError(f"Unknown motion detection method: {method}")
+        self.method = method
+        self.pixel_threshold = pixel_threshold
+        self.min_score = min_score
+        self.min_region_area = min_region_area
+        self.padding = padding
+        self.warmup_frames = warmup_frames
+        self.subtractor = None
+        if method == 'mog2':
+            self.subtractor = cv2.createBackgroundSubtractorMOG2(history=history, varThreshold=var_threshold, detectShadows=True)
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+        self.previous_gray = None
+        self.last_faces = None  # Face results carried over frames where recognition is gated off
+        self.frames_seen = 0
+        self.motion_frames = 0
+        self.lock = threading.Lock()
+
+    def _motion_gray(self, frame):
+        scale = min(1.0, MOTION_WIDTH / frame.shape[1])
+        small = frame
+        if scale < 1.0:
+            small = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+        return cv2.GaussianBlur(gray, (5, 5), 0), scale
+
+    def _foreground_mask(self, gray):
+        if self.method == 'mog2':
+            mask = self.subtractor.apply(gray)
+            _, mask = cv2.threshold(mask, SHADOW_VALUE, 255, cv2.THRESH_BINARY)
+        elif self.previous_gray is None:
+            mask = np.zeros_like(gray)
+        else:
+            _, mask = cv2.threshold(cv2.absdiff(gray, self.previous_gray), self.pixel_threshold, 255, cv2.THRESH_BINARY)
+        self.previous_gray = gray
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel)
+        return cv2.dilate(mask, self.kernel, iterations=2)
+
+    def detect(self, frame):
+        height, width = frame.shape[:2]
+        gray, scale = self._motion_gray(frame)
+        mask = self._foreground_mask(gray)
+        self.frames_seen += 1
+
+        if self.frames_seen <= self.warmup_frames:
+            # The background model is not settled yet, so treat the whole frame as moving
+            self.motion_frames += 1
+            return {"motion": True, "score": 1.0, "regions": [(0, 0, width, height)]}
+
+        score = cv2.countNonZero(mask) / mask.size
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        min_area = self.min_region_area * mask.size
+        regions = []
+        for contour in contours:
+            if cv2.contourArea(contour) < min_area:
+                continue
+            x, y, w, h = cv2.boundingRect(contour)
+            pad_x, pad_y = w * self.padding, h * self.padding
+            regions.append((
+                max(0, int((x - pad_x) / scale)), max(0, int((y - pad_y) / scale)),
+                min(width, int((x + w + pad_x) / scale)), min(height, int((y + h + pad_y) / scale))
+            ))
+        regions = _merge_regions(regions)
+
+        motion = score >= self.min_score and len(regions) > 0
+        if motion:
+            self.motion_frames += 1
+        return {"motion": motion, "score": round(float(score), 5), "regions": regions}
+
+class MotionDetectorRegistry:
+    def __init__(self):
+        self.detectors = {}
+        self.lock = threading.Lock()
+
+    def get(self, metadata):
+        key = (metadata.get('stream_id', metadata['job_id']), metadata['quality'])
+        with self.lock:
+            detector = self.detectors.get(key)
+            if detector is None:
+                settings = metadata.get('motion_detection')
+                settings = settings if isinstance(settings, dict) else {}
+                detector = MotionDetector(
+                    method=settings.get('method', 'mog2'),
+                    pixel_threshold=settings.get('pixel_threshold', 25),
+                    min_score=settings.get('min_score', 0.002),
+                    min_region_area=settings.get('min_region_area', 0.001)
+                )
+                self.detectors[key] = detector
+            return detector
+
+    def discard_job(self, job_id):
+        with self.lock:
+            keys = [key for key in self.detectors if key[0] == job_id]
+            detectors = [(key[1], self.detectors.pop(key)) for key in keys]
+        for quality, detector in detectors:
+            logger.info(f"Motion detection for job {job_id}, quality {quality}: "
+                        f"motion in {detector.motion_frames} of {detector.frames_seen} frames")
+
+class MotionDetectionService:
+    def __init__(self, detectors=None):
+        self.detectors = detectors if detectors is not None else MotionDetectorRegistry()
+
+    def detect(self, frame, metadata):
+        # Cheap enough to run inline before the pooled stages, which it can then gate
+        detector = self.detectors.get(metadata)
+        with detector.lock:
+            return detector.detect(frame)
+
+    def gate(self, metadata, motion):
+        # Returns the face results to reuse when recognition is skipped, or None when it must run
+        if not metadata.get('motion_gate') or motion['motion']:
+            return None
+        detector = self.detectors.get(metadata)
+        return list(detector.last_faces or [])
+
+    def search_regions(self, metadata, motion, width, height):
+        # Motion boxes only cover the changed pixels, which for a moving face can be thin strips along its
+        # edges; each one is grown over the previous face boxes it touches and to a size a face fits in
+        detector = self.detectors.get(metadata)
+        last_boxes = [box for _, box in detector.last_faces or []]
+        regions = []
+        for region in motion['regions']:
+            for box in last_boxes:
+                if _overlaps(region, box):
+                    region = _union(region, _grow(box, FACE_SEARCH_MARGIN, MIN_SEARCH_SIZE, width, height))
+            regions.append(_grow(region, 0, MIN_SEARCH_SIZE, width, height))
+        return _merge_regions(regions)
+
+    def remember_faces(self, metadata, recognized_faces, searched_regions=None):
+        detector = self.detectors.get(metadata)
+        if metadata.get('motion_gate') == 'roi' and detector.last_faces and searched_regions is not None:
+            # A previous face not found again is only gone if the search covered all of it; otherwise
+            # the detector may just not have seen enough of it, so its previous box is kept
+            recognized_faces = list(recognized_faces) + [
+                (name, box) for name, box in detector.last_faces
+                if not any(_contains(region, box) for region in searched_regions)
+                and not any(_overlaps(box, found) for _, found in recognized_faces)
+            ]
+        detector.last_faces = recognized_faces
+        return recognized_faces
+
+    def discard_job(self, job_id):
+        self.detectors.discard_job(job_id)
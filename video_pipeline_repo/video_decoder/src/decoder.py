@@ -3,7 +3,7 @@ import sys
 import logging
 import requests
 import subprocess
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
@@ -21,15 +21,28 @@ import time
 import json 
 import shutil
 import random
+import tempfile
+import numpy as np
 from functools import wraps 
 
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(root_dir)
+
+from common.src.thread_budget import get_thread_budget
+from common.src.metrics import (FFMPEG_DURATION, BYTES_READ, BYTES_WRITTEN, CONTENT_TYPE, track_drive_call,
+                                render_metrics)
+from common.src.tracing import get_tracer, child_context
+from common.src.profiling import register_profiling_routes
+from common.src.logging_setup import configure_logging, ProgressReporter
+from common.src.job_store import get_job_store, RUNNING, COMPLETED, FAILED
+from common.src.storage import StorageManager, ARTIFACT_MANIFEST, ADMISSION_RETRY_SECONDS, estimate_frame_bytes
+from common.src.ladder import fit_ladder, split_ladder
+
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+configure_logging('decoder')
 logger = logging.getLogger(__name__)
+tracer = get_tracer('decoder')
+upload_progress = ProgressReporter(logger, 'Uploaded files', unit='files')
 
 # Define Google Drive scope
 DRIVE_SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
@@ -40,6 +53,9 @@ UPLOAD_FOLDER_ID = '1OPOySfQNfkAp5OzvDVH9tOjob-gIYgrn'
 INPUT_CREDENTIALS_FILE = 'keys/video-decoder-input-credentials.json'
 JOB_CREDENTIALS_FILE = 'keys/video-decoder-job-credentials.json'
 UPLOAD_CREDENTIALS_FILE = 'keys/video-decoder-output-credentials.json'
+DECODED_STORAGE_PATH = 'decoded_storage/'
+# Sent to the processor when the job does not name its stages
+DEFAULT_PIPELINE_CONFIG = ['enhance']
 
 # URL of your deployed Colab notebook
 colab_url = "https://colab.research.google.com/drive/10mq3XYDyyBlc9s9gMep80u2FKIsw-6T6#scrollTo=pUPhZyP95V_v"
@@ -78,7 +94,8 @@ class TLSAdapter(HTTPAdapter):
         return super(TLSAdapter, self).init_poolmanager(*args, **kwargs)  
 
 class VideoDecoderService:
-    def __init__(self, input_credentials_path, job_credentials_path, output_credentials_path, local_storage_path, use_gpu=False):
+    def __init__(self, input_credentials_path, job_credentials_path, output_credentials_path, local_storage_path, use_gpu=False,
+                 job_store=None):
         self.input_credentials_path = input_credentials_path
         self.job_credentials_path = job_credentials_path
         self.output_credentials_path = output_credentials_path
@@ -87,6 +104,9 @@ class VideoDecoderService:
         self.drive_service_upload = None 
         self.local_storage_path = local_storage_path
         self.use_gpu = use_gpu
+        self.thread_budget = get_thread_budget()
+        self.job_store = job_store or get_job_store()
+        self.storage = StorageManager('decoder', [p for p in (local_storage_path, DECODED_STORAGE_PATH) if p])
 
     def authenticate_google_drive(self):
         input_credentials = Credentials.from_service_account_file(self.input_credentials_path, scopes=DRIVE_SCOPES)
@@ -114,17 +134,20 @@ class VideoDecoderService:
 
     def download_video(self, file_id, job_id):
         try:
-            request = self.drive_service_read.files().get_media(fileId=file_id)
-            file = io.BytesIO()
-            downloader = MediaIoBaseDownload(file, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
+            with track_drive_call('decoder', 'download'):
+                request = self.drive_service_read.files().get_media(fileId=file_id)
+                file = io.BytesIO()
+                downloader = MediaIoBaseDownload(file, request)
+                done = False
+                while done is False:
+                    status, done = downloader.next_chunk()
             
             file.seek(0)
+            BYTES_READ.labels('decoder', 'drive_download').inc(file.getbuffer().nbytes)
             
             # Get the file metadata to retrieve the original file name
-            file_metadata = self.drive_service_read.files().get(fileId=file_id, fields='name').execute()
+            with track_drive_call('decoder', 'get_metadata'):
+                file_metadata = self.drive_service_read.files().get(fileId=file_id, fields='name').execute()
             original_file_name = file_metadata.get('name')
             
             # Create job directory
@@ -142,18 +165,20 @@ class VideoDecoderService:
             logger.error(f"Error downloading video from Google Drive: {e}")
             return None
 
-    def notify_process_service(self, job_id, metadata, quality_levels, output_folder):
+    def notify_process_service(self, job_id, metadata, quality_levels, output_folder, processing_options=None, trace_context=None,
+                               pipeline_config=None):
         process_service_url = "http://localhost:5001/process"  # Adjust the URL as needed
         
-        # Default pipeline configuration for testing
-        pipeline_config = ['enhance']
+        pipeline_config = pipeline_config or DEFAULT_PIPELINE_CONFIG
 
         payload = {
             "job_id": job_id,
             "metadata": metadata,
             "quality_levels": quality_levels,
             "priority": "",  # To be filled in by the decoder service
-            "pipeline_config": pipeline_config  # To be filled in by the decoder service
+            "pipeline_config": pipeline_config,  # To be filled in by the decoder service
+            "processing_options": processing_options or {},
+            "trace": trace_context.to_dict() if trace_context else None
         }
 
         try:
@@ -165,21 +190,26 @@ class VideoDecoderService:
         except Exception as e:
             logger.error(f"Error notifying process service for job {job_id}: {str(e)}")
     
-    def process_video(self, file_path, file_id, metadata, job_id, user_settings):
+    def process_video(self, file_path, file_id, metadata, job_id, user_settings, trace_context=None, resume=False):
         try:
             # Create output folder
-            output_folder = f"decoded_storage/decoded_frames_{job_id}"
+            output_folder = os.path.join(DECODED_STORAGE_PATH, f"decoded_frames_{job_id}")
             os.makedirs(output_folder, exist_ok=True)
 
             if self.use_gpu:
                 result =  self.process_video_gpu(file_id, metadata, user_settings, job_id, output_folder)
             else:
-                result =  self.process_video_cpu(file_path, metadata, user_settings, output_folder)
+                result =  self.process_video_cpu(file_path, metadata, user_settings, output_folder, trace_context,
+                                                 job_id=job_id, resume=resume)
             
             if result:
+                # Registered before the processor hears about it, so its release always finds the manifest
+                self.storage.register(output_folder, job_id, 'decoded_frames', consumers=['processor'])
                 # Notify process service
                 quality_levels = user_settings.get('quality_levels', ['1280x720'])
-                self.notify_process_service(job_id, metadata, quality_levels, output_folder)
+                processing_options = user_settings.get('processing_options', {})
+                self.notify_process_service(job_id, metadata, quality_levels, output_folder, processing_options, trace_context,
+                                            user_settings.get('pipeline_config'))
 
                 # logger.info(f"Time to upload and cleanup for job_id = {job_id}")
                 # Start a new thread for uploading and cleaning up
@@ -191,21 +221,41 @@ class VideoDecoderService:
             logger.error(f"Unexpected error during video decoding: {e}")
             return None
 
-    def process_video_cpu(self, file_path, metadata, user_settings, output_folder):
+    def process_video_cpu(self, file_path, metadata, user_settings, output_folder, trace_context=None, job_id=None, resume=False):
         try:
             # Use metadata provided by ingestion service
             fps = metadata.get('fps')
 
             # User settings
             quality_levels = user_settings.get('quality_levels', ['1280x720'])  # Default to 720p if not specified
+            # When the processor derives the lower rungs from the top one, only that rung is decoded
+            quality_levels, _ = split_ladder(quality_levels, user_settings.get('pipeline_config') or DEFAULT_PIPELINE_CONFIG,
+                                             user_settings.get('processing_options'))
+
+            # ffmpeg cannot continue a half-written frame sequence, so a restart only skips whole rungs
+            checkpoints = {}
+            if job_id and resume:
+                checkpoints = self.job_store.checkpoints('decoder', job_id)
+            elif job_id:
+                self.job_store.clear_checkpoints('decoder', job_id)
 
             # Adaptive Bitrate Decoding
             for quality in quality_levels:
                 quality_folder = os.path.join(output_folder, f"quality_{quality}")
+                if checkpoints.get(quality, {}).get('completed') and os.path.isdir(quality_folder):
+                    logger.info(f"Quality {quality} of job {job_id} was decoded before the restart; skipping it")
+                    continue
                 os.makedirs(quality_folder, exist_ok=True)
                 # decode_command = f'ffmpeg -i "{file_path}" -vf "fps={fps},scale={quality}" "{quality_folder}/frame_%06d.raw"'
-                decode_command = f'ffmpeg -i "{file_path}" -vf "fps={fps},scale={quality}" -pix_fmt rgb24 "{quality_folder}/frame_%06d.raw"'
-                self.run_ffmpeg_command(decode_command)
+                threads = self.thread_budget.ffmpeg_threads_per_process()
+                decode_command = (f'ffmpeg -threads {threads} -i "{file_path}" -vf "fps={fps},scale={quality}" '
+                                  f'-filter_threads {threads} -pix_fmt rgb24 "{quality_folder}/frame_%06d.raw"')
+                with tracer.span('decode', trace_context, quality=quality, threads=threads):
+                    decoded = self.run_ffmpeg_command(decode_command)
+                frame_sizes = [entry.stat().st_size for entry in os.scandir(quality_folder) if entry.is_file()]
+                BYTES_WRITTEN.labels('decoder', 'decoded_frames').inc(sum(frame_sizes))
+                if job_id and decoded is not None:
+                    self.job_store.checkpoint('decoder', job_id, quality, len(frame_sizes), completed=True)
                 logger.info(f"Decoded video to quality {quality}")
             logger.info(f"Successfully decoded video on CPU: {file_path}")
             return output_folder
@@ -213,6 +263,32 @@ class VideoDecoderService:
             logger.error(f"Unexpected error during video decoding: {e}")
             return None
         
+    def stream_frames(self, file_path, quality, fps=None, threads=None, pix_fmt='rgb24'):
+        # Same decode as process_video_cpu, but frames come back over a pipe instead of as .raw files
+        width, height = (int(x) for x in quality.split('x'))
+        frame_size = width * height * 3
+        threads = threads or self.thread_budget.ffmpeg_threads_per_process()
+        video_filter = f"fps={fps},scale={quality}" if fps else f"scale={quality}"
+        command = ['ffmpeg', '-loglevel', 'error', '-threads', str(threads), '-i', file_path, '-vf', video_filter,
+                   '-filter_threads', str(threads), '-f', 'rawvideo', '-pix_fmt', pix_fmt, 'pipe:1']
+        with tempfile.TemporaryFile() as stderr, FFMPEG_DURATION.labels('decoder', 'decode_stream').time():
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr, bufsize=frame_size)
+            try:
+                while True:
+                    data = process.stdout.read(frame_size)
+                    if len(data) < frame_size:
+                        break
+                    yield np.frombuffer(data, dtype=np.uint8).reshape((height, width, 3))
+            finally:
+                # The consumer may stop early; don't leave ffmpeg blocked on a full pipe
+                if process.poll() is None:
+                    process.kill()
+                process.stdout.close()
+                returncode = process.wait()
+                if returncode not in (0, -9):
+                    stderr.seek(0)
+                    logger.error(f"FFmpeg stream decode of {file_path} at {quality} failed: {stderr.read().decode(errors='replace')}")
+
     def process_video_gpu(self, file_id, metadata, user_settings, job_id, output_folder):
         try:
             job_data = {
@@ -308,11 +384,14 @@ class VideoDecoderService:
                 'mimeType': 'application/vnd.google-apps.folder',
                 'parents': UPLOAD_FOLDER_ID
             }
-            folder = self.drive_service_upload.files().create(body=folder_metadata, fields='id').execute()
+            with track_drive_call('decoder', 'create_folder'):
+                folder = self.drive_service_upload.files().create(body=folder_metadata, fields='id').execute()
             folder_id = folder.get('id')
 
             for root, dirs, files in os.walk(output_folder):
                 for file in files:
+                    if file == ARTIFACT_MANIFEST:
+                        continue
                     file_path = os.path.join(root, file)
                     # Calculate relative path starting from the job-specific folder
                     relative_path = os.path.relpath(file_path, output_folder)
@@ -324,19 +403,24 @@ class VideoDecoderService:
                             'mimeType': 'application/vnd.google-apps.folder',
                             'parents': [folder_id]
                         }
-                        subfolder = self.drive_service_upload.files().create(body=subfolder_metadata, fields='id').execute()
+                        with track_drive_call('decoder', 'create_folder'):
+                            subfolder = self.drive_service_upload.files().create(body=subfolder_metadata, fields='id').execute()
                         parent_id = subfolder.get('id')
                     else:
                         parent_id = folder_id
 
                     file_metadata = {'name': file, 'parents': [parent_id]}
                     media = MediaFileUpload(file_path, resumable=True)
-                    logger.info(f"Attempting to upload file {file_path}")
-                    self.drive_service_upload.files().create(body=file_metadata, media_body=media, fields='id').execute()
+                    with track_drive_call('decoder', 'upload'):
+                        self.drive_service_upload.files().create(body=file_metadata, media_body=media, fields='id').execute()
+                    BYTES_WRITTEN.labels('decoder', 'drive_upload').inc(os.path.getsize(file_path))
+                    upload_progress.update(job_id, job_id=job_id, stage='upload')
 
             logger.info(f"All frames for job {job_id} uploaded successfully")
         except Exception as e:
             logger.error(f"Error uploading frames to Google Drive: {e}")
+        finally:
+            upload_progress.finish(job_id)
 
     def cleanup_local_folder(self, folder_path):
         try:
@@ -347,7 +431,8 @@ class VideoDecoderService:
 
     def run_ffmpeg_command(self, command):
         try:
-            result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
+            with FFMPEG_DURATION.labels('decoder', 'decode').time():
+                result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
             return result.stdout
         except subprocess.CalledProcessError as e:
             logger.error(f"FFmpeg command failed: {e.stderr}")
@@ -375,37 +460,89 @@ def decode_video():
     metadata = data.get('metadata')
     job_id = data.get('job_id')
     user_setting = data.get('user_setting')
+    trace = data.get('trace')
 
     logger.info(f"Received decoding request for job {job_id}")
 
     if not file_id:
         return jsonify({"error": "No file path provided"}), 400
 
+    # Requested rungs above the source or in another aspect ratio would only upscale or distort it
+    user_setting = dict(user_setting or {})
+    user_setting['quality_levels'] = fit_ladder(user_setting.get('quality_levels', ['1280x720']), metadata)
+    quality_levels = user_setting['quality_levels']
+
+    # Hold the job back while the node cannot take its decoded frames; ingestion retries after Retry-After
+    if not decoder_service.storage.has_space(estimate_frame_bytes(metadata, quality_levels)):
+        return jsonify({"error": "Not enough disk space to decode this job", "job_id": job_id}), 503, \
+            {"Retry-After": str(ADMISSION_RETRY_SECONDS)}
+
     # Download the video
     # downloaded_file_path = decoder_service.download_video(file_id, job_id)
     # if not downloaded_file_path:
     #     return jsonify({"error": "Failed to download video"}), 500
 
+    # Recorded first so a restart picks the job up again
+    decoder_service.job_store.enqueue('decoder', job_id, {
+        "file_id": file_id, "metadata": metadata, "user_setting": user_setting, "trace": trace
+    })
     # Start the decoding process asynchronously
-    threading.Thread(target=process_video_async, args=(file_id, metadata, job_id, user_setting)).start()   
+    threading.Thread(target=process_video_async, args=(file_id, metadata, job_id, user_setting, trace)).start()   
 
     return jsonify({"message": "Video decoding started", "job_id": job_id}), 200
 
-def process_video_async(file_id, metadata, job_id, user_setting):
+@app.route('/thread_budget', methods=['GET'])
+def thread_budget():
+    return jsonify(decoder_service.thread_budget.as_dict()), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype=CONTENT_TYPE)
+
+register_profiling_routes(app, 'decoder')
+
+def process_video_async(file_id, metadata, job_id, user_setting, trace=None, resume=False):
+    trace_context = tracer.context_from(trace, job_id)
+    decoder_service.job_store.set_state('decoder', job_id, RUNNING)
+    result = None
+    downloaded_file_path = None
     try:
-        # Download and process the video
-        downloaded_file_path = decoder_service.download_video(file_id, job_id)
-        if downloaded_file_path:
-            decoder_service.process_video(downloaded_file_path, file_id, metadata, job_id, user_setting)
-            logger.info(f"Video processing completed for job {job_id}")
-        else:
-            logger.error(f"Failed to download video for job {job_id}")
+        with tracer.span('decoder_job', trace_context) as span:
+            job_context = child_context(span, trace_context)
+            # Download and process the video
+            with tracer.span('download', job_context, file_id=file_id):
+                downloaded_file_path = decoder_service.download_video(file_id, job_id)
+            if downloaded_file_path:
+                # Drive keeps the original, so the local copy goes as soon as this attempt is over
+                decoder_service.storage.register(os.path.dirname(downloaded_file_path), job_id, 'source',
+                                                 consumers=['decoder'])
+                result = decoder_service.process_video(downloaded_file_path, file_id, metadata, job_id, user_setting, job_context,
+                                                       resume=resume)
+                logger.info(f"Video processing completed for job {job_id}")
+            else:
+                logger.error(f"Failed to download video for job {job_id}")
     except Exception as e:
         logger.error(f"Error processing video for job {job_id}: {str(e)}")
+    finally:
+        decoder_service.job_store.set_state('decoder', job_id, COMPLETED if result else FAILED)
+        if downloaded_file_path:
+            decoder_service.storage.release(os.path.dirname(downloaded_file_path), 'decoder')
+
+def resume_jobs():
+    recovered = decoder_service.job_store.unfinished_jobs('decoder')
+    for stored in recovered:
+        payload = stored['payload']
+        threading.Thread(target=process_video_async,
+                         args=(payload['file_id'], payload['metadata'], stored['job_id'], payload['user_setting'],
+                               payload.get('trace'), True)).start()
+    if recovered:
+        logger.info(f"Resuming {len(recovered)} unfinished decode jobs from the job store")
+    return len(recovered)
 
 def main():
     try:
         decoder_service.authenticate_google_drive()
+        resume_jobs()
         app.run(host='0.0.0.0', port=5000)
     except Exception as e:
         logger.error(f"Unhandled exception in main thread: {e}")
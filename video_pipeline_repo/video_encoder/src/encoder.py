@@ -1,78 +1,578 @@
 import os
 import cv2
 import numpy as np
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_from_directory, Response
 import threading
+import subprocess
 import logging
+import sys
+import time
+import math
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(root_dir)
+
+from common.src.thread_budget import get_thread_budget
+from common.src.metrics import REGISTRY, FFMPEG_DURATION, BYTES_READ, BYTES_WRITTEN, CONTENT_TYPE, render_metrics
+from common.src.tracing import get_tracer, child_context
+from common.src.profiling import STAGE_PROFILER, register_profiling_routes
+from common.src.logging_setup import configure_logging, RateLimitedLogger
+from common.src.job_store import get_job_store, RUNNING, COMPLETED, FAILED
+from common.src.storage import StorageManager
+from video_encoder.src.packaging import (SegmentWatcher, hls_output_args, segment_gop, write_master_playlist, log_segment,
+                                         DEFAULT_SEGMENT_SECONDS)
 
 app = Flask(__name__)
 
 # Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+configure_logging('encoder')
 logger = logging.getLogger(__name__)
 
 # This should be set to the appropriate path
 ENHANCED_FRAMES_DIR = '../../enhancement/src/enhanced_frames/'
 OUTPUT_DIR = 'encoder_output/'
+FFMPEG_BINARY = 'ffmpeg'
+FFPROBE_BINARY = 'ffprobe'
+SUPPORTED_CODECS = ('libx264', 'libx265')
+SUPPORTED_PACKAGING = ('mp4', 'hls')
+DEFAULT_ENCODE_OPTIONS = {
+    "codec": "libx264",
+    "preset": "veryfast",
+    "crf": 23,
+    "max_parallel": None,   # quality levels encoded at once; defaults to all of them
+    "read_workers": 2,      # PNG decode threads per quality level
+    "read_ahead": 8,        # decoded frames queued ahead of the encoder per quality level
+    "chunked": False,       # split each quality level into GOP-aligned chunks encoded in parallel
+    "chunk_frames": 240,    # rounded up to a whole number of GOPs
+    "gop": None,            # keyframe interval in frames; defaults to two seconds
+    "chunk_workers": None,  # concurrent chunk encoders per quality level; defaults to the ffmpeg thread budget
+    "packaging": "mp4",     # "hls" writes fMP4 segments per rung plus a master playlist
+    "segment_seconds": DEFAULT_SEGMENT_SECONDS,
+}
+
+ENCODED_FRAMES = REGISTRY.counter('encoder_frames_total', 'Frames fed to ffmpeg encoders; rate() gives frames/sec', ('mode',))
+ENCODE_FPS = REGISTRY.gauge('encoder_last_encode_fps', 'Encode speed of the most recently finished rendition', ('quality',))
+ENCODE_JOBS = REGISTRY.counter('encoder_jobs_total', 'Encode jobs by outcome', ('status',))
+
+tracer = get_tracer('encoder')
+frame_log = RateLimitedLogger(logger)
+
+def output_bytes(path):
+    if os.path.isdir(path):
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+def resolve_encode_options(encode_options=None):
+    options = dict(DEFAULT_ENCODE_OPTIONS)
+    options.update({k: v for k, v in (encode_options or {}).items() if v is not None})
+    if options['codec'] not in SUPPORTED_CODECS:
+        raise ValueError(f"Unsupported codec {options['codec']}; expected one of {', '.join(SUPPORTED_CODECS)}")
+    if options['packaging'] not in SUPPORTED_PACKAGING:
+        raise ValueError(f"Unsupported packaging {options['packaging']}; expected one of {', '.join(SUPPORTED_PACKAGING)}")
+    return options
+
+def count_video_frames(path):
+    with FFMPEG_DURATION.labels('encoder', 'probe').time():
+        result = subprocess.run(
+            [FFPROBE_BINARY, '-v', 'error', '-select_streams', 'v:0', '-count_packets',
+             '-show_entries', 'stream=nb_read_packets', '-of', 'csv=p=0', path],
+            capture_output=True, text=True
+        )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe failed for {path}: {result.stderr.strip()}")
+    return int(result.stdout.strip())
+
+def concat_videos(chunk_files, output_file):
+    # The concat demuxer with stream copy joins the chunks bit-exactly; every chunk starts on a keyframe
+    list_file = output_file + '.concat.txt'
+    with open(list_file, 'w') as f:
+        for chunk_file in chunk_files:
+            f.write(f"file '{os.path.abspath(chunk_file)}'\n")
+    try:
+        with FFMPEG_DURATION.labels('encoder', 'concat').time():
+            result = subprocess.run(
+                [FFMPEG_BINARY, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_file, '-c', 'copy',
+                 '-movflags', '+faststart', output_file],
+                capture_output=True, text=True
+            )
+    finally:
+        os.remove(list_file)
+    if result.returncode != 0:
+        logger.error(f"FFmpeg concat failed for {output_file}: {result.stderr.strip()}")
+        return False
+    return True
+
+class FFmpegPipeWriter:
+    def __init__(self, output_file, width, height, fps, pix_fmt='rgb24', codec='libx264', preset='veryfast', crf=23, threads=None,
+                 gop=None, output_args=None, operation='encode'):
+        self.output_file = output_file
+        self.width = width
+        self.height = height
+        self.frames_written = 0
+        self.stderr_output = b''
+        self.operation = operation
+        self.started_at = time.perf_counter()
+
+        command = [
+            FFMPEG_BINARY, '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', pix_fmt, '-s', f"{width}x{height}", '-r', str(fps),
+            '-i', '-',
+            '-an', '-c:v', codec, '-preset', preset, '-crf', str(crf), '-pix_fmt', 'yuv420p'
+        ]
+        x265_params = ['log-level=error']
+        if gop:
+            # Fixed, closed GOPs with no scene-cut keyframes, so independently encoded chunks line up exactly
+            command += ['-g', str(gop), '-keyint_min', str(gop), '-sc_threshold', '0']
+            x265_params += [f'keyint={gop}', f'min-keyint={gop}', 'scenecut=0', 'open-gop=0']
+        if codec == 'libx265':
+            # hvc1 is the HEVC sample entry Apple players require; x265 also logs outside -loglevel
+            command += ['-tag:v', 'hvc1', '-x265-params', ':'.join(x265_params)]
+        if threads:
+            command += ['-threads', str(threads)]
+        if output_args:
+            command += output_args
+        elif output_file.endswith('.mp4'):
+            # Put the moov atom first so players can start before the whole file has downloaded
+            command += ['-movflags', '+faststart']
+        command.append(output_file)
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        # Drain stderr so a chatty ffmpeg can never block on a full pipe
+        self.stderr_thread = threading.Thread(target=self._drain_stderr, daemon=True)
+        self.stderr_thread.start()
+
+    def _drain_stderr(self):
+        self.stderr_output = self.process.stderr.read()
+
+    def write(self, frame):
+        if frame.shape[0] != self.height or frame.shape[1] != self.width:
+            raise ValueError(f"Frame size {frame.shape[1]}x{frame.shape[0]} does not match encoder size {self.width}x{self.height}")
+        self.process.stdin.write(np.ascontiguousarray(frame).data)
+        self.frames_written += 1
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        return_code = self.process.wait()
+        self.stderr_thread.join()
+        FFMPEG_DURATION.labels('encoder', self.operation).observe(time.perf_counter() - self.started_at)
+        ENCODED_FRAMES.labels(self.operation).inc(self.frames_written)
+        if return_code != 0:
+            logger.error(f"FFmpeg exited with code {return_code} for {self.output_file}: {self.stderr_output.decode(errors='replace')}")
+            return False
+        # HLS output is a playlist; count the whole rendition directory instead
+        written = self.output_file if self.output_file.endswith('.mp4') else os.path.dirname(self.output_file)
+        BYTES_WRITTEN.labels('encoder', self.operation).inc(output_bytes(written))
+        return True
+
+def hls_job_dir(output_dir, job_id):
+    return os.path.join(output_dir, 'hls', f"job_{job_id}")
+
+class StreamingEncodeSession:
+    def __init__(self, job_id, quality, width, height, fps, output_dir=OUTPUT_DIR, threads=None, encode_options=None,
+                 publishers=None):
+        self.job_id = job_id
+        self.quality = quality
+        self.rendition_name = f"quality_{quality}"
+        self.width = width
+        self.height = height
+        self.fps = fps
+        options = resolve_encode_options(encode_options)
+        self.watcher = None
+        gop, output_args = None, None
+        if options['packaging'] == 'hls':
+            rendition_dir = os.path.join(hls_job_dir(output_dir, job_id), self.rendition_name)
+            os.makedirs(rendition_dir, exist_ok=True)
+            output_args, self.output_file = hls_output_args(rendition_dir, options['segment_seconds'])
+            gop = segment_gop(fps, options['segment_seconds'])
+            self.watcher = SegmentWatcher(job_id, self.rendition_name, rendition_dir, publishers or [log_segment])
+        else:
+            self.output_file = os.path.join(output_dir, f"job_{job_id}_quality_{quality}.mp4")
+        self.writer = FFmpegPipeWriter(self.output_file, width, height, fps, codec=options['codec'], preset=options['preset'],
+                                       crf=options['crf'], threads=threads, gop=gop, output_args=output_args, operation='stream')
+        self.next_frame_number = 0
+        self.pending_frames = {}
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def submit(self, frame_number, frame):
+        # Frames are written strictly in frame order; early arrivals wait in pending_frames
+        with self.lock:
+            if self.failed:
+                # ffmpeg is gone; the caller keeps processing the rung and close() reports the failure
+                return
+            self.pending_frames[frame_number] = frame
+            try:
+                while self.next_frame_number in self.pending_frames:
+                    self.writer.write(self.pending_frames.pop(self.next_frame_number))
+                    self.next_frame_number += 1
+            except OSError as e:
+                logger.error(f"Streaming encoder for job {self.job_id}, quality {self.quality} stopped taking frames "
+                             f"at frame {self.next_frame_number}: {e}")
+                self.failed = True
+                self.pending_frames.clear()
+
+    def close(self):
+        with self.lock:
+            if self.pending_frames:
+                logger.warning(f"Dropping {len(self.pending_frames)} out-of-order frames for job {self.job_id}, quality {self.quality}; "
+                               f"frame {self.next_frame_number} never arrived")
+                self.pending_frames.clear()
+            # Closing still reaps ffmpeg and logs its stderr after a failed write
+            success = self.writer.close() and not self.failed
+        if self.watcher:
+            self.watcher.stop()
+        if success:
+            logger.info(f"Streamed video saved: {self.output_file} ({self.writer.frames_written} frames)")
+        return success
 
 class EncoderService:
-    def __init__(self):
-        self.encoding_queue = []
-        self.encoding_lock = threading.Lock()
+    def __init__(self, output_dir=OUTPUT_DIR, job_store=None):
+        self.output_dir = output_dir
+        self.job_store = job_store or get_job_store()
+        self.storage = StorageManager('encoder', [ENHANCED_FRAMES_DIR])
+        self.thread_budget = get_thread_budget()
+        self.thread_budget.apply_opencv()
+        # Called with (job_id, rendition, path) as each HLS segment is finished
+        self.segment_publishers = [log_segment]
+
+    def add_segment_publisher(self, publisher):
+        self.segment_publishers.append(publisher)
+
+    def write_master_playlist(self, job_id, renditions, encode_options=None):
+        options = resolve_encode_options(encode_options)
+        path = write_master_playlist(hls_job_dir(self.output_dir, job_id), renditions, options['codec'], options['segment_seconds'])
+        logger.info(f"Master playlist written for job {job_id}: {path}")
+        return path
+
+    def open_stream(self, job_id, quality, width, height, fps, threads=None, encode_options=None):
+        os.makedirs(self.output_dir, exist_ok=True)
+        threads = threads or self.thread_budget.ffmpeg_threads_per_process()
+        return StreamingEncodeSession(job_id, quality, width, height, fps, output_dir=self.output_dir, threads=threads,
+                                      encode_options=encode_options, publishers=self.segment_publishers)
+
+    def start_encoding(self, job_id, metadata, encode_options=None, trace=None, resume=False):
+        if not resume:
+            self.job_store.enqueue('encoder', job_id, {"metadata": metadata, "encode_options": encode_options, "trace": trace})
+        threading.Thread(target=self._encode_video, args=(job_id, metadata, encode_options, trace, resume)).start()
+
+    def resume_jobs(self):
+        recovered = self.job_store.unfinished_jobs('encoder')
+        for stored in recovered:
+            payload = stored['payload']
+            self.start_encoding(stored['job_id'], payload['metadata'], payload.get('encode_options'), payload.get('trace'),
+                                resume=True)
+        if recovered:
+            logger.info(f"Resuming {len(recovered)} unfinished encode jobs from the job store")
+        return len(recovered)
+
+    def _encode_video(self, job_id, metadata, encode_options=None, trace=None, resume=False):
+        trace_context = tracer.context_from(trace, job_id)
+        self.job_store.set_state('encoder', job_id, RUNNING)
+        stats = None
+        try:
+            with tracer.span('encode_job', trace_context) as span:
+                stats = self._encode_job(job_id, metadata, encode_options, child_context(span, trace_context), resume)
+            return stats
+        finally:
+            succeeded = stats is not None and all(s and s['success'] for s in stats.values())
+            self.job_store.set_state('encoder', job_id, COMPLETED if succeeded else FAILED)
+            if succeeded:
+                # The PNGs were only kept for this encode; a failed one keeps them for the retry
+                self.storage.release(os.path.join(ENHANCED_FRAMES_DIR, f"job_{job_id}"), 'encoder')
+
+    def _finished_qualities(self, job_id, quality_levels, options):
+        # Renditions completed before a restart are kept; HLS jobs redo every rung so the playlists stay consistent
+        if options['packaging'] == 'hls':
+            return set()
+        checkpoints = self.job_store.checkpoints('encoder', job_id)
+        return {quality for quality in quality_levels
+                if checkpoints.get(quality, {}).get('completed')
+                and os.path.exists(os.path.join(self.output_dir, f"job_{job_id}_{quality}.mp4"))}
 
-    def start_encoding(self, job_id, metadata):
-        threading.Thread(target=self._encode_video, args=(job_id, metadata)).start()
+    def _encode_traced(self, encode_quality_level, trace_context, job_id, quality, *args):
+        with tracer.span('encode', trace_context, quality=quality):
+            return encode_quality_level(job_id, quality, *args)
 
-    def _encode_video(self, job_id, metadata):
+    def _encode_job(self, job_id, metadata, encode_options, trace_context, resume=False):
         try:
+            options = resolve_encode_options(encode_options)
             job_dir = os.path.join(ENHANCED_FRAMES_DIR, f"job_{job_id}")
-            quality_levels = [d for d in os.listdir(job_dir) if d.startswith("quality_")]
+            quality_levels = sorted(d for d in os.listdir(job_dir) if d.startswith("quality_"))
+            if resume:
+                finished = self._finished_qualities(job_id, quality_levels, options)
+                if finished:
+                    logger.info(f"Job {job_id} already has {sorted(finished)} encoded; encoding the remaining rungs")
+                quality_levels = [quality for quality in quality_levels if quality not in finished]
+                if not quality_levels:
+                    return {}
+            else:
+                self.job_store.clear_checkpoints('encoder', job_id)
+            if not quality_levels:
+                logger.warning(f"No quality levels found to encode for job {job_id}")
+                return
 
-            for quality in quality_levels:
-                frames_dir = os.path.join(job_dir, quality)
-                self._encode_quality_level(job_id, quality, frames_dir, metadata)
+            # Every quality level gets its own ffmpeg process; the node's ffmpeg threads are split between them
+            max_parallel = max(1, min(options['max_parallel'] or len(quality_levels), len(quality_levels)))
+            threads = self.thread_budget.ffmpeg_threads_per_process(max_parallel)
+            os.makedirs(self.output_dir, exist_ok=True)
 
-            logger.info(f"Encoding completed for job {job_id}")
+            renditions = None
+            if options['packaging'] == 'hls':
+                if options['chunked']:
+                    logger.warning(f"Chunked encoding does not apply to HLS packaging; encoding job {job_id} per rung")
+                    options['chunked'] = False
+                # The master playlist goes out first so players can open the stream while segments arrive
+                fps = metadata.get('fps', 30) or 30
+                renditions = [(quality, *self._frame_size(os.path.join(job_dir, quality)), fps) for quality in quality_levels]
+                renditions = [r for r in renditions if r[1]]
+                self.write_master_playlist(job_id, renditions, options)
+
+            start = time.perf_counter()
+            encode_quality_level = self._encode_quality_level_chunked if options['chunked'] else self._encode_quality_level
+            with ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix=f'encode-{job_id}') as executor:
+                futures = {
+                    quality: executor.submit(self._encode_traced, encode_quality_level, trace_context, job_id, quality,
+                                             os.path.join(job_dir, quality), metadata, options, threads, max_parallel)
+                    for quality in quality_levels
+                }
+                stats = {}
+                for quality, future in futures.items():
+                    try:
+                        stats[quality] = future.result()
+                        if stats[quality] and stats[quality]['success']:
+                            self.job_store.checkpoint('encoder', job_id, quality, stats[quality]['frames'], completed=True)
+                    except Exception as e:
+                        logger.error(f"Error encoding job {job_id}, {quality}: {str(e)}")
+
+            if renditions:
+                # Replace the estimated bandwidths with ones measured from the real segments
+                self.write_master_playlist(job_id, renditions, options)
+
+            elapsed = time.perf_counter() - start
+            ENCODE_JOBS.labels('ok' if all(s and s['success'] for s in stats.values()) and len(stats) == len(quality_levels)
+                                else 'failed').inc()
+            logger.info(f"Encoding completed for job {job_id} in {elapsed:.1f}s "
+                        f"({len(stats)}/{len(quality_levels)} quality levels, {max_parallel} in parallel)")
+            return stats
         except Exception as e:
+            ENCODE_JOBS.labels('failed').inc()
             logger.error(f"Error encoding video for job {job_id}: {str(e)}")
 
-    def _encode_quality_level(self, job_id, quality, frames_dir, metadata):
+    def _frame_size(self, frames_dir):
+        frame_files = sorted(f for f in os.listdir(frames_dir) if f.endswith('.png'))
+        frame = cv2.imread(os.path.join(frames_dir, frame_files[0])) if frame_files else None
+        if frame is None:
+            return None, None
+        return frame.shape[1], frame.shape[0]
+
+    def _read_frames(self, frames_dir, frame_files, options):
+        # Decode PNGs in a small pool, keeping a bounded window of frames ahead of the encoder
+        with ThreadPoolExecutor(max_workers=options['read_workers']) as reader:
+            pending = deque()
+            files = iter(frame_files)
+            for frame_file in files:
+                pending.append(reader.submit(cv2.imread, os.path.join(frames_dir, frame_file)))
+                if len(pending) >= options['read_ahead']:
+                    break
+            while pending:
+                frame = pending.popleft().result()
+                next_file = next(files, None)
+                if next_file is not None:
+                    pending.append(reader.submit(cv2.imread, os.path.join(frames_dir, next_file)))
+                yield frame
+
+    def _write_frames(self, writer, frames_dir, frame_files, options):
+        BYTES_READ.labels('encoder', 'enhanced_frames').inc(sum(os.path.getsize(os.path.join(frames_dir, f)) for f in frame_files))
+        with STAGE_PROFILER.profile('encode'):
+            for frame in self._read_frames(frames_dir, frame_files, options):
+                if frame is None:
+                    frame_log.warning(('unreadable', frames_dir), "Skipping unreadable frame in %s", frames_dir, stage='encode')
+                    continue
+                writer.write(frame)
+
+    def _encode_quality_level(self, job_id, quality, frames_dir, metadata, encode_options=None, threads=None, parallel_levels=1):
+        options = resolve_encode_options(encode_options)
         frame_files = sorted([f for f in os.listdir(frames_dir) if f.endswith('.png')])
         if not frame_files:
             logger.warning(f"No frames found for job {job_id}, quality {quality}")
-            return
+            return None
 
         # Read the first frame to get dimensions
         first_frame = cv2.imread(os.path.join(frames_dir, frame_files[0]))
         height, width = first_frame.shape[:2]
 
-        # Set up video writer
-        output_file = os.path.join(OUTPUT_DIR, f"job_{job_id}_{quality}.mp4")
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        fps = metadata.get('fps', 30)  # Default to 30 if not specified
-        out = cv2.VideoWriter(output_file, fourcc, fps, (width, height))
+        fps = metadata.get('fps', 30) or 30  # Default to 30 if not specified
+        watcher, gop, output_args = None, None, None
+        if options['packaging'] == 'hls':
+            rendition_dir = os.path.join(hls_job_dir(self.output_dir, job_id), quality)
+            os.makedirs(rendition_dir, exist_ok=True)
+            output_args, output_file = hls_output_args(rendition_dir, options['segment_seconds'])
+            gop = segment_gop(fps, options['segment_seconds'])
+            watcher = SegmentWatcher(job_id, quality, rendition_dir, self.segment_publishers)
+        else:
+            output_file = os.path.join(self.output_dir, f"job_{job_id}_{quality}.mp4")
+        start = time.perf_counter()
+        # cv2.imread returns BGR, so ffmpeg is told the pipe carries bgr24
+        writer = FFmpegPipeWriter(output_file, width, height, fps, pix_fmt='bgr24', codec=options['codec'],
+                                  preset=options['preset'], crf=options['crf'], threads=threads, gop=gop, output_args=output_args)
+        try:
+            self._write_frames(writer, frames_dir, frame_files, options)
+        finally:
+            success = writer.close()
+            if watcher:
+                watcher.stop()
+
+        elapsed = time.perf_counter() - start
+        stats = {
+            "output_file": output_file,
+            "frames": writer.frames_written,
+            "seconds": round(elapsed, 2),
+            "encode_fps": round(writer.frames_written / elapsed, 1) if elapsed > 0 else None,
+            "success": success,
+        }
+        if stats['encode_fps']:
+            ENCODE_FPS.labels(quality).set(stats['encode_fps'])
+        if success:
+            logger.info(f"Encoded video saved: {output_file} ({stats['frames']} frames at {stats['encode_fps']} fps, "
+                        f"{options['codec']} preset {options['preset']} crf {options['crf']})")
+        return stats
 
-        for frame_file in frame_files:
-            frame = cv2.imread(os.path.join(frames_dir, frame_file))
-            out.write(frame)
+    def _encode_chunk(self, chunk_file, frames_dir, frame_files, width, height, fps, options, gop, threads):
+        writer = FFmpegPipeWriter(chunk_file, width, height, fps, pix_fmt='bgr24', codec=options['codec'],
+                                  preset=options['preset'], crf=options['crf'], threads=threads, gop=gop, operation='chunk')
+        try:
+            self._write_frames(writer, frames_dir, frame_files, options)
+        finally:
+            success = writer.close()
+        if not success:
+            raise RuntimeError(f"Chunk encode failed: {chunk_file}")
+        return writer.frames_written
 
-        out.release()
-        logger.info(f"Encoded video saved: {output_file}")
+    def _encode_quality_level_chunked(self, job_id, quality, frames_dir, metadata, encode_options=None, threads=None, parallel_levels=1):
+        options = resolve_encode_options(encode_options)
+        frame_files = sorted([f for f in os.listdir(frames_dir) if f.endswith('.png')])
+        if not frame_files:
+            logger.warning(f"No frames found for job {job_id}, quality {quality}")
+            return None
 
-encoder_service = EncoderService()
+        first_frame = cv2.imread(os.path.join(frames_dir, frame_files[0]))
+        height, width = first_frame.shape[:2]
+        fps = metadata.get('fps', 30) or 30
+
+        # Chunks are whole GOPs, so each one opens on the keyframe the serial encode would have put there
+        gop = options['gop'] or max(1, int(round(fps * 2)))
+        chunk_frames = math.ceil(max(options['chunk_frames'], gop) / gop) * gop
+        chunks = [frame_files[i:i + chunk_frames] for i in range(0, len(frame_files), chunk_frames)]
+        workers = options['chunk_workers'] or max(1, self.thread_budget.allocation.ffmpeg_threads // parallel_levels)
+        workers = max(1, min(workers, len(chunks)))
+        chunk_threads = self.thread_budget.ffmpeg_threads_per_process(workers * parallel_levels)
+
+        output_file = os.path.join(self.output_dir, f"job_{job_id}_{quality}.mp4")
+        chunk_dir = os.path.join(self.output_dir, f"job_{job_id}_{quality}_chunks")
+        os.makedirs(chunk_dir, exist_ok=True)
+        chunk_files = [os.path.join(chunk_dir, f"chunk_{i:05d}.mp4") for i in range(len(chunks))]
+
+        start = time.perf_counter()
+        frames_written, success = 0, False
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [
+                    pool.submit(self._encode_chunk, chunk_file, frames_dir, chunk, width, height, fps, options, gop, chunk_threads)
+                    for chunk_file, chunk in zip(chunk_files, chunks)
+                ]
+                # A failed chunk fails this quality level rather than the whole job
+                failed_chunks = 0
+                for chunk_file, future in zip(chunk_files, futures):
+                    try:
+                        frames_written += future.result()
+                    except Exception as e:
+                        failed_chunks += 1
+                        logger.error(f"Error encoding {chunk_file} for job {job_id}, {quality}: {str(e)}")
+
+            if not failed_chunks:
+                success = concat_videos(chunk_files, output_file)
+            if success:
+                output_frames = count_video_frames(output_file)
+                if output_frames != frames_written:
+                    logger.error(f"Frame count mismatch for {output_file}: wrote {frames_written}, container has {output_frames}")
+                    success = False
+        except Exception as e:
+            logger.error(f"Error assembling chunks for job {job_id}, {quality}: {str(e)}")
+            success = False
+        finally:
+            # The chunks sit outside the storage manager's reach, so they are removed however the encode ends
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+
+        elapsed = time.perf_counter() - start
+        stats = {
+            "output_file": output_file,
+            "frames": frames_written,
+            "chunks": len(chunks),
+            "chunk_workers": workers,
+            "gop": gop,
+            "seconds": round(elapsed, 2),
+            "encode_fps": round(frames_written / elapsed, 1) if elapsed > 0 else None,
+            "success": success,
+        }
+        if stats['encode_fps']:
+            ENCODE_FPS.labels(quality).set(stats['encode_fps'])
+        if success:
+            logger.info(f"Encoded video saved: {output_file} ({frames_written} frames in {len(chunks)} chunks of {chunk_frames}, "
+                        f"{workers} in parallel, {stats['encode_fps']} fps)")
+        return stats
+
+_encoder_service = None
+_encoder_service_lock = threading.Lock()
+
+def get_encoder_service():
+    # Built on first use instead of at import, so the processor can import this module for streaming
+    # encodes without opening the encoder's job store or registering its storage manager
+    global _encoder_service
+    with _encoder_service_lock:
+        if _encoder_service is None:
+            _encoder_service = EncoderService()
+        return _encoder_service
 
 @app.route('/encode', methods=['POST'])
 def start_encoding():
     data = request.json
     job_id = data.get('job_id')
     metadata = data.get('metadata')
+    encode_options = data.get('encode_options') or {}
 
     if not job_id or not metadata:
         return jsonify({"error": "Missing job_id or metadata"}), 400
+    try:
+        resolve_encode_options(encode_options)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    encoder_service.start_encoding(job_id, metadata)
+    get_encoder_service().start_encoding(job_id, metadata, encode_options, data.get('trace'))
     return jsonify({"message": "Encoding started", "job_id": job_id}), 200
 
+@app.route('/hls/<job_id>/<path:filename>', methods=['GET'])
+def serve_hls(job_id, filename):
+    # Segments are served while the job is still encoding; the event playlist grows as they land
+    return send_from_directory(os.path.abspath(hls_job_dir(get_encoder_service().output_dir, job_id)), filename)
+
+@app.route('/thread_budget', methods=['GET'])
+def thread_budget():
+    return jsonify(get_encoder_service().thread_budget.as_dict()), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype=CONTENT_TYPE)
+
+register_profiling_routes(app, 'encoder')
+
 if __name__ == "__main__":
     os.makedirs(OUTPUT_DIR, exist_ok=True)
+    # Only the service process resumes jobs; the processor imports this module for streaming encodes
+    get_encoder_service().resume_jobs()
     app.run(host='0.0.0.0', port=5002)
\ No newline at end of file
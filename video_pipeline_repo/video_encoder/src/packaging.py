@@ -0,0 +1,103 @@
+import os
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+PLAYLIST_NAME = 'playlist.m3u8'
+MASTER_PLAYLIST_NAME = 'master.m3u8'
+INIT_SEGMENT_NAME = 'init.mp4'
+SEGMENT_PATTERN = 'segment_%05d.m4s'
+DEFAULT_SEGMENT_SECONDS = 4
+# Rough bits per pixel per frame for CRF 23 at the fast presets; only used until real segments exist
+ESTIMATED_BITS_PER_PIXEL = 0.08
+CODEC_TAGS = {
+    'libx264': 'avc1.640028',       # High profile, level 4.0
+    'libx265': 'hvc1.1.6.L120.90',  # Main profile, level 4.0
+}
+
+def segment_gop(fps, segment_seconds):
+    # Keyframes exactly on segment boundaries, identical across rungs, so players can switch at any segment
+    return max(1, int(round(fps * segment_seconds)))
+
+def hls_output_args(rendition_dir, segment_seconds=DEFAULT_SEGMENT_SECONDS):
+    # temp_file makes ffmpeg write each segment under a temporary name and rename it once complete
+    return [
+        '-f', 'hls',
+        '-hls_time', str(segment_seconds),
+        '-hls_segment_type', 'fmp4',
+        '-hls_playlist_type', 'event',
+        '-hls_flags', 'independent_segments+temp_file',
+        '-hls_fmp4_init_filename', INIT_SEGMENT_NAME,
+        '-hls_segment_filename', os.path.join(rendition_dir, SEGMENT_PATTERN),
+    ], os.path.join(rendition_dir, PLAYLIST_NAME)
+
+def measured_bandwidth(rendition_dir, segment_seconds):
+    sizes = [os.path.getsize(os.path.join(rendition_dir, f)) for f in os.listdir(rendition_dir) if f.endswith('.m4s')]
+    if not sizes:
+        return None
+    return int(max(sizes) * 8 / segment_seconds)
+
+def write_master_playlist(job_dir, renditions, codec, segment_seconds=DEFAULT_SEGMENT_SECONDS):
+    # renditions: (name, width, height, fps) for every rung; each lives in job_dir/<name>/playlist.m3u8
+    lines = ['#EXTM3U', '#EXT-X-VERSION:7', '#EXT-X-INDEPENDENT-SEGMENTS']
+    for name, width, height, fps in sorted(renditions, key=lambda r: r[1] * r[2], reverse=True):
+        rendition_dir = os.path.join(job_dir, name)
+        bandwidth = None
+        if os.path.isdir(rendition_dir):
+            bandwidth = measured_bandwidth(rendition_dir, segment_seconds)
+        bandwidth = bandwidth or int(width * height * fps * ESTIMATED_BITS_PER_PIXEL)
+        lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={width}x{height},'
+                     f'FRAME-RATE={float(fps):.3f},CODECS="{CODEC_TAGS.get(codec, CODEC_TAGS["libx264"])}"')
+        lines.append(f'{name}/{PLAYLIST_NAME}')
+
+    os.makedirs(job_dir, exist_ok=True)
+    path = os.path.join(job_dir, MASTER_PLAYLIST_NAME)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(temp_path, path)
+    return path
+
+class SegmentWatcher:
+    # Polls a rendition directory and hands every finished segment to the publishers, in order
+    def __init__(self, job_id, quality, rendition_dir, publishers, interval=0.5):
+        self.job_id = job_id
+        self.quality = quality
+        self.rendition_dir = rendition_dir
+        self.publishers = publishers
+        self.interval = interval
+        self.published = set()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.scan()
+
+    def scan(self):
+        if not os.path.isdir(self.rendition_dir):
+            return
+        # Segments only get their final name once complete, so anything matching is safe to publish
+        ready = sorted(f for f in os.listdir(self.rendition_dir)
+                       if f.endswith('.m4s') and f not in self.published)
+        if ready and INIT_SEGMENT_NAME not in self.published and os.path.exists(os.path.join(self.rendition_dir, INIT_SEGMENT_NAME)):
+            ready.insert(0, INIT_SEGMENT_NAME)
+        for name in ready:
+            self.published.add(name)
+            for publish in self.publishers:
+                try:
+                    publish(self.job_id, self.quality, os.path.join(self.rendition_dir, name))
+                except Exception as e:
+                    logger.error(f"Segment publisher failed for {name} of job {self.job_id}, {self.quality}: {str(e)}")
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        # Pick up the final segment, which ffmpeg renames as it exits
+        self.scan()
+        return len([name for name in self.published if name.endswith('.m4s')])
+
+def log_segment(job_id, quality, path):
+    logger.info(f"Segment ready for job {job_id}, {quality}: {path}")
@@ -16,20 +16,25 @@ import sys
 import time 
 import uuid 
 
-# Configure logging to output to stdout
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(root_dir)
+
+from common.src.tracing import get_tracer, child_context
+from common.src.logging_setup import configure_logging
+from common.src.ladder import ComplexityEstimator, select_ladder
+
+configure_logging('ingestion')
 
 # logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+tracer = get_tracer('ingestion')
 
 # Define separate scopes for Google Drive and Google Sheets
 DRIVE_SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
 DRIVE_UPLOAD_SCOPES = ['https://www.googleapis.com/auth/drive.file']
 SHEETS_SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+# How many times a decoder that is out of disk space is asked again before the job is given up
+DECODER_ADMISSION_RETRIES = 10
 
 class VideoIngestionService:
     def __init__(self, input_drive_credentials_path, sheets_credentials_path, ingestion_drive_credentials_path, sheet_id, drive_id):
@@ -188,8 +193,16 @@ class VideoIngestionService:
             return None
     
     def process_video(self, file_id):
+        # The job id is minted up front so every span of this job, here and downstream, carries it
+        job_id = self.generate_job_id()
+        trace_context = tracer.start_trace(job_id)
+        with tracer.span('ingest', trace_context, file_id=file_id) as span:
+            return self._ingest_video(file_id, job_id, child_context(span, trace_context))
+
+    def _ingest_video(self, file_id, job_id, trace_context):
         # Start processing and get the original video file path
-        video_file_path = self.start(file_id)
+        with tracer.span('download', trace_context, file_id=file_id):
+            video_file_path = self.start(file_id)
 
         if not video_file_path:
             logging.error("Failed to start video processing")
@@ -202,41 +215,50 @@ class VideoIngestionService:
             return False
         
         # Extract metadata before processing the video
-        metadata = self.extract_metadata()
+        with tracer.span('probe', trace_context):
+            metadata = self.extract_metadata()
 
         # Publish metadata to Google Sheets 
         if metadata:
             self.publish_metadata_to_sheets(metadata)
 
         frame_number = 0
-        while True:
-            frame = self.read_frame()
-            if frame is None:
-                break
-            # Process the frame here (e.g., apply your video processing pipeline)
-            frame_number += 1
+        complexity = ComplexityEstimator()
+        with tracer.span('scan_frames', trace_context) as span:
+            while True:
+                frame = self.read_frame()
+                if frame is None:
+                    break
+                # Process the frame here (e.g., apply your video processing pipeline)
+                complexity.update(frame)
+                frame_number += 1
+            if span:
+                span.set_attribute('frames', frame_number)
         self.stop()
 
+        # The ladder follows the source: no rung above its resolution, its aspect ratio, and fewer rungs for simple content
+        if metadata:
+            metadata['complexity'] = complexity.score()
+        quality_levels = select_ladder(metadata, metadata.get('complexity') if metadata else None)
+
         # Mark this video as processed to avoid reprocessing it in future polls.
         self.processed_videos.add(file_id)
 
         # Upload processed video to Google Drive
-        uploaded_file_id = self.upload_video_to_drive(video_file_path, self.drive_id)
-
-        # Generate a placeholder job ID
-        job_id = self.generate_job_id()
+        with tracer.span('upload', trace_context):
+            uploaded_file_id = self.upload_video_to_drive(video_file_path, self.drive_id)
 
         # Notify decoder service via REST API
         if uploaded_file_id:
-            self.notify_decoder_service(uploaded_file_id, metadata, job_id)
+            self.notify_decoder_service(uploaded_file_id, metadata, job_id, trace_context, quality_levels)
 
             # Delete the local file after successful upload
             self.delete_local_file(video_file_path)
         else:
             logging.error(f"Failed to upload video {video_file_path}. Local file not deleted.")
 
-    def notify_decoder_service(self, file_id, metadata, job_id):
-        user_setting = { "quality_levels" : ["640x360", "1280x720", "1920x1080"], 
+    def notify_decoder_service(self, file_id, metadata, job_id, trace_context=None, quality_levels=None):
+        user_setting = { "quality_levels" : quality_levels or select_ladder(metadata),
                 "priority": "high"}
         try:
             # url = "http://decoder-service:5000/decode"  # URL of the decoder service's API
@@ -245,9 +267,18 @@ class VideoIngestionService:
                 "file_id": file_id,
                 "metadata": metadata,
                 "job_id": job_id,
-                "user_setting": user_setting
+                "user_setting": user_setting,
+                "trace": trace_context.to_dict() if trace_context else None
             }
             response = requests.post(url, json=data)
+            # 503 means the decoder node is short of disk; wait as long as it asks rather than dropping the video
+            for _ in range(DECODER_ADMISSION_RETRIES):
+                if response.status_code != 503:
+                    break
+                delay = int(response.headers.get('Retry-After', 30))
+                logging.warning(f"Decoder is short of disk space for job {job_id}; retrying in {delay}s")
+                time.sleep(delay)
+                response = requests.post(url, json=data)
             if response.status_code == 200:
                 logging.info("Decoder service notified successfully.")
             else:
@@ -4,8 +4,7 @@ import json
 import sys 
 import threading
 import requests 
-from collections import deque
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 # from google.oauth2.service_account import Credentials
 # from googleapiclient.discovery import build
 # from googleapiclient.http import MediaIoBaseDownload
@@ -14,25 +13,36 @@ from flask import Flask, request, jsonify
 root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.append(root_dir)
 
-from enhancement.src.enhance import EnhancementService
-from facial_rec.src.facial_rec import FacialRecognitionService
+from enhancement.src.enhance import (EnhancementService, TemporalStateRegistry, downscale_frame, save_enhanced_frame,
+                                     OUTPUT_DIR as ENHANCED_FRAMES_PATH)
+from facial_rec.src.facial_rec import FacialRecognitionService, save_annotated_frame
+from facial_rec.src.tracking import FaceTrackerRegistry
+from motion_detection.src.motion import MotionDetectionService, MotionDetectorRegistry
+from video_encoder.src.encoder import EncoderService
+from common.src.thread_budget import get_thread_budget
+from common.src.frame_analysis import FrameSimilarityGate
+from common.src.metrics import REGISTRY, BYTES_READ, BYTES_WRITTEN, CONTENT_TYPE, render_metrics
+from common.src.tracing import get_tracer, child_context
+from common.src.profiling import STAGE_PROFILER, register_profiling_routes
+from common.src.logging_setup import configure_logging, RateLimitedLogger, ProgressReporter
+from common.src.job_store import get_job_store, FrameCheckpointer, RUNNING, COMPLETED, FAILED
+from common.src.storage import StorageManager, ADMISSION_RETRY_SECONDS
+from common.src.ladder import split_ladder
+from common.src.sharding import (SHARDING_ENABLED, SHARD_FRAMES, ShardLease, get_shard_coordinator, replica_id,
+                                 split_ranges)
 import logging 
 import cv2
 import numpy as np
 import concurrent.futures
 import time
 from queue import Queue
-from dataclasses import dataclass
-from typing import List, Dict, Any
+from dataclasses import dataclass, field, asdict
+from typing import List, Dict, Any, Optional
 
 app = Flask(__name__)
 
-# Configure logging to output to stdout
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+# Log records go through a queue to a single writer thread so frame workers never block on stdout
+configure_logging('processor')
 
 # logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -41,21 +51,105 @@ SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
 CREDENTIALS_FILE = 'keys/video-frame-input-credentials.json'  # Placeholder for credentials file
 FRAMES_PATH = '../../video_decoder/src/decoded_storage/'
 OUTPUT_PATH = 'processed_frames/'
+ENCODER_OUTPUT_PATH = '../../video_encoder/src/encoder_output/'
+# Extra replicas on one machine listen on their own port; they take frame ranges from the coordinator either way
+PORT = int(os.environ.get('PIPELINE_PROCESSOR_PORT', '5001'))
+SHARD_POLL_INTERVAL = 1
+# Stages whose pools are started before the replica reports ready, e.g. "enhance,recognize_faces"; by default
+# a pool starts with the first frame that needs it
+WARMUP_PIPELINE = [stage for stage in os.environ.get('PIPELINE_WARMUP', '').split(',') if stage]
+# pipeline_config steps that run on a worker pool, and the pool each one needs
+STAGE_POOLS = {'enhance': 'enhance', 'recognize_faces': 'recognize'}
+PIPELINE_STAGES = ('enhance', 'recognize_faces', 'detect_motion')
+
+JOB_QUEUE_DEPTH = REGISTRY.gauge('processor_job_queue_depth', 'Jobs waiting for a processing slot')
+ACTIVE_JOBS = REGISTRY.gauge('processor_active_jobs', 'Jobs currently being processed')
+JOB_WAIT = REGISTRY.histogram('processor_job_wait_seconds', 'Time a job spent queued before processing started',
+                              buckets=(0.1, 1, 5, 15, 30, 60, 300, 900, 1800, 3600))
+FRAME_LATENCY = REGISTRY.histogram('pipeline_frame_seconds', 'Time to run every configured stage on one frame')
+STAGE_LATENCY = REGISTRY.histogram('pipeline_stage_seconds', 'Per-frame latency of each stage, including queueing', ('stage',))
+FRAMES_PROCESSED = REGISTRY.counter('pipeline_frames_processed_total', 'Frames through the pipeline; rate() gives frames/sec',
+                                    ('quality',))
+FRAMES_REUSED = REGISTRY.counter('pipeline_frames_reused_total', 'Near-duplicate frames that reused the previous results')
+WORKERS = REGISTRY.gauge('pipeline_workers', 'Stage service instances per pool', ('pool',))
+WORKERS_BUSY = REGISTRY.gauge('pipeline_workers_busy', 'Stage service instances currently handling a frame', ('pool',))
+WORKER_BUSY_SECONDS = REGISTRY.counter(
+    'pipeline_worker_busy_seconds_total', 'Busy time summed over a pool; divide its rate by pipeline_workers for utilisation',
+    ('pool',))
+
+tracer = get_tracer('processor')
+# Per-frame messages are rate limited per key and per-frame progress is folded into periodic lines
+frame_log = RateLimitedLogger(logger)
+frame_progress = ProgressReporter(logger, 'Processed frames')
 
 class FrameBuffer:
-    def __init__(self, max_size=100):
-        self.buffer = deque(maxlen=max_size)
+    # Reads a job's decoded frames from disk as they are consumed rather than holding them all, so a resumed
+    # job's frame numbers, counted from its start frame, always belong to the files actually read
+    def __init__(self, frame_paths, read_frame):
+        self.frame_paths = frame_paths
+        self.read_frame = read_frame
         self.frame_metadata = None
 
-    def add_frame(self, frame):
-        self.buffer.append(frame)
-
-    def get_frames(self, count=1):
-        return [self.buffer.popleft() for _ in range(min(count, len(self.buffer)))]
+    def frames(self):
+        for frame_path in self.frame_paths:
+            yield self.read_frame(frame_path)
 
     def set_metadata(self, metadata):
         self.frame_metadata = metadata
 
+class LeasedFrameBuffer(FrameBuffer):
+    # Reads a frame range like FrameBuffer, but stops once the range's lease is lost so a stalled replica
+    # stops writing frames another has taken over
+    def __init__(self, lease, frame_paths, read_frame):
+        super().__init__(frame_paths, read_frame)
+        self.lease = lease
+
+    def frames(self):
+        for frame_path in self.frame_paths:
+            if not self.lease.active:
+                return
+            yield self.read_frame(frame_path)
+
+class CrossResolutionFaceDetections:
+    def __init__(self, analysis_quality, refine_quality=None, timeout=30):
+        self.analysis_quality = analysis_quality
+        self.refine_quality = refine_quality
+        self.timeout = timeout
+        self.detections = {}
+        self.finished = False
+        self.condition = threading.Condition()
+
+    def publish(self, frame_number, recognized_faces, width, height):
+        # Boxes are stored normalised to the analysis frame so any rung can rescale them
+        if recognized_faces is None:
+            normalized = None
+        else:
+            normalized = [
+                (name, (left / width, top / height, right / width, bottom / height))
+                for name, (left, top, right, bottom) in recognized_faces
+            ]
+        with self.condition:
+            self.detections[frame_number] = normalized
+            self.condition.notify_all()
+
+    def finish(self):
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def faces_for(self, frame_number, width, height):
+        with self.condition:
+            if not self.condition.wait_for(lambda: frame_number in self.detections or self.finished, timeout=self.timeout):
+                logger.warning(f"Timed out waiting for {self.analysis_quality} face detections of frame {frame_number}")
+                return None
+            normalized = self.detections.get(frame_number)
+        if normalized is None:
+            return None
+        return [
+            (name, (int(round(left * width)), int(round(top * height)), int(round(right * width)), int(round(bottom * height))))
+            for name, (left, top, right, bottom) in normalized
+        ]
+
 @dataclass
 class VideoJob:
     job_id: str
@@ -63,6 +157,15 @@ class VideoJob:
     quality_levels: List[str]
     priority: str
     pipeline_config: List[str]
+    processing_options: Dict[str, Any] = field(default_factory=dict)
+    enqueued_at: float = field(default_factory=time.time)
+    trace: Optional[Dict[str, Any]] = None
+    # Set for jobs recovered from the job store that were already running; they continue from their checkpoints
+    resume: bool = False
+
+    def to_payload(self):
+        # What the job store and the shard coordinator keep: everything needed to rebuild the job elsewhere
+        return {key: value for key, value in asdict(self).items() if key not in ('enqueued_at', 'resume')}
 
 class VideoJobQueue:
     def __init__(self):
@@ -85,18 +188,35 @@ class VideoJobQueue:
             self.active_jobs.pop(job_id, None)
 
 class ProcessorService:
-    def __init__(self, local_storage_path, output_storage_path, max_concurrent_jobs=3):
+    def __init__(self, local_storage_path, output_storage_path, max_concurrent_jobs=None, job_store=None):
         # self.drive_service = None
         self.local_storage_path = local_storage_path 
         self.output_storage_path = output_storage_path
-        self.frame_buffers = {}  # Dictionary to store buffers for different quality levels
-        self.distribution_manager = DistributionManager()
+
+        # Size job slots, stage pools and OpenCV's own pool from the CPUs this pod actually has
+        self.thread_budget = get_thread_budget()
+        self.thread_budget.apply_opencv()
+        allocation = self.thread_budget.allocation
+
+        self.distribution_manager = DistributionManager(
+            num_enhancement_workers=allocation.enhancement_workers,
+            num_recognition_workers=allocation.recognition_workers
+        )
+        self.encoder_service = EncoderService(output_dir=ENCODER_OUTPUT_PATH)
         self.job_queue = VideoJobQueue()
-        self.max_concurrent_jobs = max_concurrent_jobs
+        self.job_store = job_store or get_job_store()
+        self.storage = StorageManager('processor', [p for p in (output_storage_path, ENHANCED_FRAMES_PATH) if p])
+        self.max_concurrent_jobs = max_concurrent_jobs or allocation.max_concurrent_jobs
         self.job_threads = []
+        # Set by start_shard_workers; until then every job runs whole on this replica
+        self.shard_coordinator = None
+        self.shard_payloads = {}
+
+        JOB_QUEUE_DEPTH.set_function(self.job_queue.job_queue.qsize)
+        ACTIVE_JOBS.set_function(lambda: len(self.job_queue.active_jobs))
 
         # Start job processor thread
-        threading.Thread(target=self._process_job_queue, daemon=True).start()
+        threading.Thread(target=self._process_job_queue, daemon=True, name='job-queue').start()
 
     # def authenticate_google_drive(self):
     #     credentials = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
@@ -104,13 +224,19 @@ class ProcessorService:
 
     def _process_job_queue(self):
         while True:
-            if len(self.job_threads) < self.max_concurrent_jobs:
+            if len(self.job_threads) < self.max_concurrent_jobs and not self.job_queue.job_queue.empty():
+                # New jobs wait while the disk is short, instead of failing halfway through writing frames
+                if not self.storage.has_space():
+                    time.sleep(ADMISSION_RETRY_SECONDS)
+                    continue
                 job = self.job_queue.get_next_job()
                 if job:
+                    JOB_WAIT.observe(time.time() - job.enqueued_at)
                     self.job_queue.mark_job_active(job.job_id)
                     thread = threading.Thread(
                         target=self._process_single_video,
-                        args=(job,)
+                        args=(job,),
+                        name=f'job-{job.job_id}'
                     )
                     self.job_threads.append(thread)
                     thread.start()
@@ -119,19 +245,177 @@ class ProcessorService:
             self.job_threads = [t for t in self.job_threads if t.is_alive()]
             time.sleep(1)  # Prevent busy waiting
 
+    def submit_job(self, job: VideoJob):
+        # Persist before queueing so a restart between the two cannot lose the job
+        self.job_store.enqueue('processor', job.job_id, job.to_payload())
+        self.dispatch_job(job)
+
+    def dispatch_job(self, job: VideoJob):
+        if self.should_shard(job):
+            self.shard_job(job)
+        else:
+            self.job_queue.add_job(job)
+
+    def resume_jobs(self):
+        recovered = self.job_store.unfinished_jobs('processor')
+        for stored in recovered:
+            job = VideoJob(**stored['payload'], resume=stored['state'] == RUNNING)
+            self.dispatch_job(job)
+        if recovered:
+            logger.info(f"Recovered {len(recovered)} unfinished jobs from the job store")
+        return len(recovered)
+
     def _process_single_video(self, job: VideoJob):
+        success = False
         try:
-            self.process_video(
+            self.job_store.set_state('processor', job.job_id, RUNNING)
+            success = self.process_video(
                 job.job_id,
                 job.metadata,
                 job.quality_levels,
                 job.priority,
-                job.pipeline_config
+                job.pipeline_config,
+                job.processing_options,
+                tracer.context_from(job.trace, job.job_id),
+                resume=job.resume
             )
         finally:
+            self.job_store.set_state('processor', job.job_id, COMPLETED if success else FAILED)
             self.job_queue.mark_job_complete(job.job_id)
 
-    def fetch_decoded_frames(self, job_id, quality_levels, priority, pipeline_config):
+    def start_shard_workers(self, coordinator, workers=None):
+        # Joins this replica to the shard pool: its workers take frame ranges of any replica's jobs
+        self.shard_coordinator = coordinator
+        self.replica_id = replica_id()
+        workers = workers or self.max_concurrent_jobs
+        for i in range(workers):
+            threading.Thread(target=self._shard_worker, daemon=True, name=f'shard-{i}').start()
+        logger.info(f"Replica {self.replica_id} joined the shard pool with {workers} workers")
+
+    def should_shard(self, job: VideoJob):
+        if self.shard_coordinator is None or not job.processing_options.get('shard', True):
+            return False
+        if job.processing_options.get('stream_encode'):
+            # Each rung's ffmpeg session needs all of its frames, in order, in one process
+            logger.info(f"Job {job.job_id} streams its encode; processing it whole on this replica")
+            return False
+        return True
+
+    def shard_job(self, job: VideoJob):
+        processed_qualities, _ = self.split_quality_ladder(job.job_id, job.quality_levels, job.pipeline_config,
+                                                           job.processing_options)
+        shard_frames = int(job.processing_options.get('shard_frames') or SHARD_FRAMES)
+        try:
+            ranges = [shard_range for quality in processed_qualities
+                      for shard_range in split_ranges(quality, len(self.decoded_frame_paths(job.job_id, quality)), shard_frames)]
+        except OSError as e:
+            logger.error(f"Cannot shard job {job.job_id}: {str(e)}")
+            self.job_store.set_state('processor', job.job_id, FAILED, str(e))
+            return
+        if self.shard_coordinator.create_job(job.job_id, job.to_payload(), ranges):
+            logger.info(f"Split job {job.job_id} into {len(ranges)} frame ranges of up to {shard_frames} frames")
+        self.job_store.set_state('processor', job.job_id, RUNNING)
+
+    def sharded_job(self, job_id):
+        payload = self.shard_payloads.get(job_id)
+        if payload is None:
+            payload = self.shard_payloads[job_id] = self.shard_coordinator.job_payload(job_id)
+        return VideoJob(**payload)
+
+    def _shard_worker(self):
+        worker_id = f"{self.replica_id}/{threading.current_thread().name}"
+        while True:
+            try:
+                # Reassembling a finished job comes first, so its encode starts as early as possible
+                job_id = self.shard_coordinator.claim_finalize(worker_id)
+                if job_id:
+                    self.finalize_sharded_job(job_id)
+                    continue
+                if not self.storage.has_space():
+                    time.sleep(ADMISSION_RETRY_SECONDS)
+                    continue
+                shard = self.shard_coordinator.acquire(worker_id)
+            except Exception as e:
+                logger.error(f"Shard worker {worker_id} failed: {str(e)}")
+                shard = None
+            if shard is None:
+                time.sleep(SHARD_POLL_INTERVAL)
+                continue
+            try:
+                self.process_shard(shard, worker_id)
+            except Exception as e:
+                logger.error(f"Could not process frames {shard.start_frame}-{shard.end_frame} of job {shard.job_id}: {str(e)}")
+                self.shard_coordinator.fail(shard, worker_id, str(e))
+
+    def process_shard(self, shard, worker_id):
+        job = self.sharded_job(shard.job_id)
+        options = job.processing_options
+        _, derived_qualities = self.split_quality_ladder(job.job_id, job.quality_levels, job.pipeline_config, options)
+        # Stage state (temporal enhancement, trackers, motion models) starts fresh at every range, as at a scene cut
+        stream_id = f"{shard.job_id}/{shard.index}"
+        stage_settings = dict(self.build_stage_settings(options), stream_id=stream_id)
+        derived_outputs = {quality: None for quality in derived_qualities} if derived_qualities else None
+        trace_context = tracer.context_from(job.trace, job.job_id)
+        lease = ShardLease(self.shard_coordinator, shard, worker_id)
+        job_stats = {}
+        error = None
+        try:
+            with lease, tracer.span('process_shard', trace_context, quality=shard.quality, start_frame=shard.start_frame,
+                                    end_frame=shard.end_frame, attempt=shard.attempt) as span:
+                frame_paths = self.decoded_frame_paths(shard.job_id, shard.quality)[shard.start_frame:shard.end_frame]
+                buffer = LeasedFrameBuffer(lease, frame_paths, lambda path: self.read_frame_file(path, shard.quality))
+                self.process_frames(buffer, job.priority, job.pipeline_config, job.job_id, shard.quality, job.metadata,
+                                    stage_settings=stage_settings, derived_outputs=derived_outputs,
+                                    similarity_gate=self.build_similarity_gate(options), job_stats=job_stats,
+                                    trace_context=child_context(span, trace_context), start_frame=shard.start_frame,
+                                    checkpointer=lease)
+        except Exception as e:
+            error = str(e)
+        finally:
+            self.distribution_manager.end_job(stream_id)
+
+        if not lease.active:
+            # The replica that took the range over reports it; a fail() from here would be rejected anyway
+            return
+        stats = job_stats.get(shard.quality, {"frames": shard.start_frame, "short_circuited": 0})
+        frames = stats['frames'] - shard.start_frame
+        if error is None and frames < shard.frames:
+            error = f"processed {frames} of {shard.frames} frames"
+        if error is not None:
+            logger.error(f"Frames {shard.start_frame}-{shard.end_frame} of job {shard.job_id}, {shard.quality} failed: {error}")
+            self.shard_coordinator.fail(shard, worker_id, error)
+        elif not self.shard_coordinator.complete(shard, worker_id, {"frames": frames, "short_circuited": stats['short_circuited']}):
+            logger.warning(f"Frames {shard.start_frame}-{shard.end_frame} of job {shard.job_id}, {shard.quality} finished "
+                           f"after their lease ran out; keeping the result of the replica that took them over")
+
+    def finalize_sharded_job(self, job_id):
+        # Frames are written under their own frame numbers, so once every range is done the outputs are already
+        # in order; what is left is the per-job bookkeeping process_buffers does for an unsharded job
+        job = self.sharded_job(job_id)
+        results = self.shard_coordinator.shard_results(job_id)
+        failed = [r for r in results if r['result'] is None]
+        job_stats = {}
+        for r in results:
+            if r['result'] is not None:
+                stats = job_stats.setdefault(r['quality'], {"frames": 0, "short_circuited": 0})
+                stats['frames'] += r['result']['frames']
+                stats['short_circuited'] += r['result']['short_circuited']
+        try:
+            self.write_job_report(job_id, job_stats)
+            self.register_outputs(job_id)
+            if failed:
+                logger.error(f"Job {job_id}: {len(failed)} of {len(results)} frame ranges failed; not encoding it")
+            else:
+                logger.info(f"All {len(results)} frame ranges of job {job_id} are done")
+                if 'enhance' in job.pipeline_config:
+                    self.hand_off_enhanced_frames(job_id, job.metadata, job.processing_options,
+                                                  tracer.context_from(job.trace, job_id))
+                self.release_decoded_frames(job_id)
+        finally:
+            self.job_store.set_state('processor', job_id, FAILED if failed else COMPLETED)
+            self.shard_payloads.pop(job_id, None)
+
+    def fetch_decoded_frames(self, job_id, quality_levels, priority, pipeline_config, start_frame=0):
         # try:
         #     folder_name = f"decoded_frames_{job_id}"
         #     query = f"name = '{folder_name}' and mimeType = 'application/vnd.google-apps.folder'"
@@ -167,47 +451,54 @@ class ProcessorService:
             if not os.path.exists(job_folder):
                 raise ValueError(f"Folder for job {job_id} not found")
 
+            # Buffers belong to this job alone, so concurrent jobs never share or drain each other's rungs
+            buffers = {}
             for quality in quality_levels:
                 quality_folder = os.path.join(job_folder, f"quality_{quality}")
                 if not os.path.exists(quality_folder):
                     raise ValueError(f"Quality folder {quality} not found for job {job_id}")
 
-                self.frame_buffers[quality] = FrameBuffer()
-                self.load_frames(quality_folder, quality)
+                # Frames before start_frame were finished before a restart and are not read again
+                frame_paths = self.decoded_frame_paths(job_id, quality)[start_frame:]
+                buffers[quality] = FrameBuffer(frame_paths, lambda path, quality=quality: self.read_frame_file(path, quality))
 
             logger.info(f"Successfully fetched decoded frames for job: {job_id}")
-            return True
+            return buffers
         except Exception as e:
             logger.error(f"Error fetching decoded frames: {e}")
-            return False
-        
-    def load_frames(self, folder_path, quality):
-        frame_files = sorted([f for f in os.listdir(folder_path) if f.endswith('.raw')])
-        for frame_file in frame_files:
-            frame_path = os.path.join(folder_path, frame_file)
-            with open(frame_path, 'rb') as f:
-                frame_data = f.read()
-            # Calculate the correct dimensions
-            # total_pixels = len(frame_data) // 3  # Assuming 3 channels (RGB)
-            width = int(quality.split('x')[0])
-            height = int(quality.split('x')[1])
-            expected_size = width * height * 3  # 3 channels for RGB
-            if len(frame_data) != expected_size:
-                logger.warning(f"Frame data size mismatch for {frame_file}. Expected {expected_size}, got {len(frame_data)}")
-            frame = np.frombuffer(frame_data, dtype=np.uint8).reshape((height, width, 3))
-            # Convert BGR to RGB
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-            # Log frame information for debugging
-            # logger.info(f"Frame shape before adding to buffer: {frame.shape}, dtype: {frame.dtype}")
+            return None
         
-            self.frame_buffers[quality].add_frame(frame_rgb)
+    def decoded_frame_paths(self, job_id, quality):
+        folder_path = os.path.join(self.local_storage_path, f"decoded_frames_{job_id}", f"quality_{quality}")
+        return [os.path.join(folder_path, f) for f in sorted(os.listdir(folder_path)) if f.endswith('.raw')]
+
+    def read_frame_file(self, frame_path, quality):
+        with open(frame_path, 'rb') as f:
+            frame_data = f.read()
+        BYTES_READ.labels('processor', 'decoded_frames').inc(len(frame_data))
+        # Calculate the correct dimensions
+        # total_pixels = len(frame_data) // 3  # Assuming 3 channels (RGB)
+        width = int(quality.split('x')[0])
+        height = int(quality.split('x')[1])
+        expected_size = width * height * 3  # 3 channels for RGB
+        if len(frame_data) != expected_size:
+            frame_log.warning(('size_mismatch', os.path.dirname(frame_path)), "Frame data size mismatch for %s. Expected %d, got %d",
+                              os.path.basename(frame_path), expected_size, len(frame_data), quality=quality)
+        frame = np.frombuffer(frame_data, dtype=np.uint8).reshape((height, width, 3))
+        # Convert BGR to RGB
+        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
 
-    def notify_encoder(self, job_id, metadata):
+        # Log frame information for debugging
+        # logger.info(f"Frame shape before adding to buffer: {frame.shape}, dtype: {frame.dtype}")
+        return frame_rgb
+
+    def notify_encoder(self, job_id, metadata, encode_options=None, trace_context=None):
         encoder_service_url = "http://localhost:5002/encode"
         payload = {
             "job_id": job_id,
-            "metadata": metadata
+            "metadata": metadata,
+            "encode_options": encode_options or {},
+            "trace": trace_context.to_dict() if trace_context else None
         }
         try:
             response = requests.post(encoder_service_url, json=payload)
@@ -218,51 +509,315 @@ class ProcessorService:
         except Exception as e:
             logger.error(f"Error notifying encoder service for job {job_id}: {str(e)}")
 
-    def process_video(self, job_id, video_metadata, quality_levels, priority, pipeline_config):
-        try:
-            if self.fetch_decoded_frames(job_id, quality_levels, priority, pipeline_config):
-                threads = []
-                for quality, buffer in self.frame_buffers.items():
-                    thread = threading.Thread(
-                        target=self.process_frames,
-                        args=(buffer, priority, pipeline_config, job_id, quality, video_metadata)
-                    )
-                    threads.append(thread)
-                    thread.start()
+    def open_encode_sessions(self, job_id, quality_levels, video_metadata, encode_options=None):
+        sessions = {}
+        fps = video_metadata.get('fps', 30) or 30
+        threads = self.thread_budget.ffmpeg_threads_per_process(len(quality_levels))
+        for quality in quality_levels:
+            width, height = (int(x) for x in quality.split('x'))
+            sessions[quality] = self.encoder_service.open_stream(job_id, quality, width, height, fps, threads=threads,
+                                                                 encode_options=encode_options)
+        if (encode_options or {}).get('packaging') == 'hls':
+            self.write_master_playlist(job_id, sessions, encode_options)
+        return sessions
+
+    def write_master_playlist(self, job_id, sessions, encode_options):
+        renditions = [(s.rendition_name, s.width, s.height, s.fps) for s in sessions.values()]
+        self.encoder_service.write_master_playlist(job_id, renditions, encode_options)
 
-                for thread in threads:
-                    thread.join()
+    def close_encode_sessions(self, job_id, sessions, encode_options=None):
+        success = True
+        for quality, session in sessions.items():
+            if not session.close():
+                logger.error(f"Streaming encode failed for job {job_id}, quality {quality}")
+                success = False
+        if (encode_options or {}).get('packaging') == 'hls':
+            # Rewrite with bandwidths measured from the finished segments
+            self.write_master_playlist(job_id, sessions, encode_options)
+        return success
 
-                if 'enhance' in pipeline_config:
-                    logger.info(f"Completed enhancement processing for all frames in job {job_id}")
-                    self.notify_encoder(job_id, video_metadata)
-                if 'recognize_faces' in pipeline_config:
-                    logger.info(f"Completed facial recognition for all frames in job {job_id}")
+    def plan_face_detection(self, job_id, quality_levels, processing_options):
+        analysis_quality = processing_options.get('face_analysis_quality')
+        if not analysis_quality or len(quality_levels) < 2:
+            return None
 
-                logger.info(f"Processed all frames for job {job_id}")
+        by_area = sorted(quality_levels, key=lambda q: int(q.split('x')[0]) * int(q.split('x')[1]))
+        if analysis_quality not in quality_levels:
+            if analysis_quality != 'auto':
+                logger.warning(f"Face analysis quality {analysis_quality} is not part of job {job_id}; using {by_area[0]}")
+            analysis_quality = by_area[0]
+
+        refine_quality = processing_options.get('face_refine_quality')
+        if refine_quality == 'highest':
+            refine_quality = by_area[-1]
+        if refine_quality not in quality_levels or refine_quality == analysis_quality:
+            refine_quality = None
+
+        logger.info(f"Running face detection for job {job_id} on {analysis_quality} only"
+                    + (f", refining boxes at {refine_quality}" if refine_quality else ""))
+        return CrossResolutionFaceDetections(analysis_quality, refine_quality)
+
+    def split_quality_ladder(self, job_id, quality_levels, pipeline_config, processing_options):
+        processed_qualities, derived_qualities = split_ladder(quality_levels, pipeline_config, processing_options)
+        if derived_qualities:
+            logger.info(f"Processing job {job_id} at {processed_qualities[0]} only; deriving {derived_qualities} by downscaling")
+        elif processing_options.get('derive_ladder') and 'enhance' not in pipeline_config:
+            logger.warning(f"derive_ladder needs the enhance stage; processing every rung of job {job_id}")
+        return processed_qualities, derived_qualities
+
+    def emit_derived_rungs(self, source_frame, frame_metadata, derived_outputs):
+        for quality, encode_session in derived_outputs.items():
+            width, height = (int(x) for x in quality.split('x'))
+            derived_frame = downscale_frame(source_frame, width, height)
+            if encode_session:
+                encode_session.submit(frame_metadata['frame_number'], derived_frame)
+            else:
+                derived_metadata = dict(frame_metadata, quality=quality, width=width, height=height)
+                save_enhanced_frame(derived_frame, derived_metadata)
+
+    def build_stage_settings(self, processing_options):
+        # Per-job switches that the stage services read from each frame's metadata
+        stage_settings = {}
+        if processing_options.get('temporal_enhance'):
+            stage_settings['temporal_enhance'] = processing_options['temporal_enhance']
+        if processing_options.get('face_tracking'):
+            stage_settings['face_tracking'] = processing_options['face_tracking']
+        if processing_options.get('face_gallery'):
+            stage_settings['face_gallery'] = processing_options['face_gallery']
+        if processing_options.get('face_detector'):
+            stage_settings['face_detector'] = processing_options['face_detector']
+        if processing_options.get('motion_detection'):
+            stage_settings['motion_detection'] = processing_options['motion_detection']
+        if processing_options.get('motion_gate') in ('skip', 'roi'):
+            stage_settings['motion_gate'] = processing_options['motion_gate']
+        # Per-frame side outputs; the single-process pipeline switches them off to write nothing but the encodes
+        if processing_options.get('save_annotated_frames') is False:
+            stage_settings['save_annotated_frames'] = False
+        if processing_options.get('save_frame_metadata') is False:
+            stage_settings['save_frame_metadata'] = False
+        return stage_settings
+
+    def build_similarity_gate(self, processing_options):
+        settings = processing_options.get('dedupe_frames')
+        if not settings:
+            return None
+        settings = settings if isinstance(settings, dict) else {}
+        return FrameSimilarityGate(
+            mean_threshold=settings.get('mean_threshold', 1.0),
+            max_pixel_threshold=settings.get('max_pixel_threshold', 12)
+        )
+
+    def reuse_stage_results(self, frame, frame_metadata, previous_results, pipeline_config):
+        # Write the same per-frame artifacts the stage services would have, from the previous frame's outputs
+        results = dict(previous_results)
+        if 'enhance' in pipeline_config and results.get('enhance') is not None and frame_metadata.get('save_frames', True):
+            save_enhanced_frame(results['enhance'], frame_metadata)
+        if 'recognize_faces' in pipeline_config and results.get('recognize') is not None:
+            save_annotated_frame(frame.copy(), results['recognize'], frame_metadata)
+        return results
+
+    def write_job_report(self, job_id, job_stats):
+        report = {
+            "job_id": job_id,
+            "qualities": job_stats,
+            "frames": sum(stats['frames'] for stats in job_stats.values()),
+            "short_circuited_frames": sum(stats['short_circuited'] for stats in job_stats.values()),
+        }
+        output_folder = os.path.join(self.output_storage_path, f"processed_frames_{job_id}")
+        os.makedirs(output_folder, exist_ok=True)
+        with open(os.path.join(output_folder, "job_report.json"), 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Job {job_id}: {report['short_circuited_frames']} of {report['frames']} frames reused the previous frame's results")
+        return report
+
+    def hand_off_enhanced_frames(self, job_id, video_metadata, processing_options, trace_context=None):
+        self.storage.register(os.path.join(ENHANCED_FRAMES_PATH, f"job_{job_id}"), job_id, 'enhanced_frames',
+                              consumers=['encoder'])
+        self.notify_encoder(job_id, video_metadata, processing_options.get('encode_options'), trace_context)
+
+    def release_decoded_frames(self, job_id):
+        # Only called once a job succeeds: a failed one keeps its decoded frames so a retry or restart can resume
+        self.storage.release(os.path.join(self.local_storage_path, f"decoded_frames_{job_id}"), 'processor')
+
+    def register_outputs(self, job_id):
+        # Frame metadata and face annotations are only read by people debugging a job, so they are
+        # kept as cache and are the first thing evicted when the disk runs short
+        self.storage.register(os.path.join(self.output_storage_path, f"processed_frames_{job_id}"), job_id, 'processed_frames',
+                              cacheable=True)
+        annotated_folder = os.path.join(self.output_storage_path, job_id)
+        if os.path.isdir(annotated_folder):
+            self.storage.register(annotated_folder, job_id, 'annotated_frames', cacheable=True)
+
+    def process_video(self, job_id, video_metadata, quality_levels, priority, pipeline_config, processing_options=None,
+                      trace_context=None, resume=False):
+        processing_options = processing_options or {}
+        with tracer.span('process_job', trace_context, qualities=list(quality_levels), pipeline=list(pipeline_config)) as span:
+            return self._process_video(job_id, video_metadata, quality_levels, priority, pipeline_config, processing_options,
+                                       child_context(span, trace_context), resume)
+
+    def resume_point(self, job_id, processed_qualities, processing_options):
+        if processing_options.get('stream_encode'):
+            # A streamed encode cannot pick up halfway through an ffmpeg output, so it starts over
+            logger.info(f"Job {job_id} streams its encode; reprocessing from frame 0")
+            return 0
+        checkpoints = self.job_store.checkpoints('processor', job_id)
+        # Every rung restarts from the same frame so shared face detections and derived rungs stay aligned
+        start_frame = min((checkpoints.get(q, {}).get('frames_done', 0) for q in processed_qualities), default=0)
+        if start_frame:
+            logger.info(f"Resuming job {job_id} from frame {start_frame}")
+        return start_frame
+
+    def _process_video(self, job_id, video_metadata, quality_levels, priority, pipeline_config, processing_options, trace_context,
+                       resume=False):
+        try:
+            processed_qualities, derived_qualities = self.split_quality_ladder(job_id, quality_levels, pipeline_config, processing_options)
+            if resume:
+                start_frame = self.resume_point(job_id, processed_qualities, processing_options)
+            else:
+                start_frame = 0
+                self.job_store.clear_checkpoints('processor', job_id)
+            with tracer.span('load_frames', trace_context, qualities=list(processed_qualities), start_frame=start_frame):
+                buffers = self.fetch_decoded_frames(job_id, processed_qualities, priority, pipeline_config, start_frame)
+            if buffers:
+                success = self.process_buffers(job_id, video_metadata, quality_levels, buffers, processed_qualities,
+                                               derived_qualities, priority, pipeline_config, processing_options, trace_context,
+                                               start_frame)
+                if success:
+                    self.release_decoded_frames(job_id)
+                return success
             else:
                 logger.error(f"Failed to fetch decoded frames for job {job_id}")
         except Exception as e:
             logger.error(f"Unexpected error during video processing for job {job_id}: {str(e)}")
+        return False
+
+    def process_buffers(self, job_id, video_metadata, quality_levels, buffers, processed_qualities, derived_qualities, priority,
+                        pipeline_config, processing_options, trace_context=None, start_frame=0):
+        # In streaming mode each quality feeds its own ffmpeg session as frames come out
+        # of the pipeline, so encoding overlaps processing and no enhanced PNGs are written
+        encode_sessions = {}
+        if processing_options.get('stream_encode'):
+            encode_sessions = self.open_encode_sessions(job_id, quality_levels, video_metadata,
+                                                        processing_options.get('encode_options'))
+
+        # Optionally detect faces once per frame on one rung and rescale the boxes to the others
+        face_detections = None
+        if 'recognize_faces' in pipeline_config:
+            face_detections = self.plan_face_detection(job_id, processed_qualities, processing_options)
+        stage_settings = self.build_stage_settings(processing_options)
+        job_stats = {}
+
+        threads = []
+        for quality, buffer in buffers.items():
+            # The top rung also produces every derived rung from its output frames
+            derived_outputs = {q: encode_sessions.get(q) for q in derived_qualities} if quality in processed_qualities else None
+            thread = threading.Thread(
+                target=self.process_frames,
+                args=(buffer, priority, pipeline_config, job_id, quality, video_metadata,
+                      encode_sessions.get(quality), face_detections, stage_settings, derived_outputs,
+                      self.build_similarity_gate(processing_options), job_stats, trace_context, start_frame)
+            )
+            threads.append(thread)
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+        self.distribution_manager.end_job(job_id)
+        self.write_job_report(job_id, job_stats)
+        self.register_outputs(job_id)
+
+        if encode_sessions:
+            # Only the ffmpeg drain is left here; the rest of the encode overlapped processing
+            with tracer.span('encode_stream', trace_context, qualities=list(encode_sessions)):
+                encoded = self.close_encode_sessions(job_id, encode_sessions, processing_options.get('encode_options'))
+            if encoded:
+                logger.info(f"Completed streaming encode for all qualities in job {job_id}")
+        elif 'enhance' in pipeline_config:
+            logger.info(f"Completed enhancement processing for all frames in job {job_id}")
+            self.hand_off_enhanced_frames(job_id, video_metadata, processing_options, trace_context)
+        if 'recognize_faces' in pipeline_config:
+            logger.info(f"Completed facial recognition for all frames in job {job_id}")
+
+        logger.info(f"Processed all frames for job {job_id}")
+        return encoded if encode_sessions else True
+
+    def process_frames(self, buffer, priority, pipeline_config, job_id, quality, video_metadata, encode_session=None, face_detections=None,
+                       stage_settings=None, derived_outputs=None, similarity_gate=None, job_stats=None, trace_context=None,
+                       start_frame=0, checkpointer=None):
+        frame_number = start_frame
+        checkpointer = checkpointer or FrameCheckpointer(self.job_store, 'processor', job_id, quality, start_frame)
+        short_circuited = 0
+        previous_results = None
+        frames_counter = FRAMES_PROCESSED.labels(quality)
+        is_analysis_quality = face_detections is not None and quality == face_detections.analysis_quality
+        try:
+            for frame in buffer.frames():
+                frame_metadata = self.create_frame_metadata(frame, frame_number, job_id, quality, video_metadata)
+                if stage_settings:
+                    frame_metadata.update(stage_settings)
+                if encode_session:
+                    frame_metadata['save_frames'] = False
+                if face_detections is not None and not is_analysis_quality:
+                    hints = face_detections.faces_for(frame_number, frame_metadata['width'], frame_metadata['height'])
+                    if hints is not None:
+                        frame_metadata['face_hints'] = [box for _, box in hints]
+                        frame_metadata['face_hint_labels'] = [name for name, _ in hints]
+                        frame_metadata['refine_faces'] = quality == face_detections.refine_quality
+                # Only every Nth frame is traced; the rest pass no context so their stages record nothing
+                frame_context = trace_context if tracer.frame_sampled(trace_context, frame_number) else None
+                with tracer.span('frame', frame_context, quality=quality, frame_number=frame_number) as frame_span:
+                    frame_context = child_context(frame_span, frame_context)
+                    if similarity_gate is not None and similarity_gate.is_duplicate(frame) and previous_results is not None:
+                        results = self.reuse_stage_results(frame, frame_metadata, previous_results, pipeline_config)
+                        short_circuited += 1
+                        FRAMES_REUSED.inc()
+                        if frame_span is not None:
+                            frame_span.set_attribute('reused', True)
+                    else:
+                        with FRAME_LATENCY.time():
+                            results = self.distribution_manager.distribute_frame(frame, frame_metadata, pipeline_config,
+                                                                                 frame_context)
+                        if similarity_gate is not None:
+                            similarity_gate.update_reference()
+                            previous_results = results
+                if is_analysis_quality:
+                    face_detections.publish(frame_number, results.get('recognize'), frame_metadata['width'], frame_metadata['height'])
 
-    def process_frames(self, buffer, priority, pipeline_config, job_id, quality, video_metadata):
-        frame_number = 0
-        while len(buffer.buffer) > 0:
-            frame = buffer.get_frames(1)[0]
-            frame_metadata = self.create_frame_metadata(frame, frame_number, job_id, quality, video_metadata)
-            self.distribution_manager.distribute_frame(frame, frame_metadata, pipeline_config)
-
-            # for step in pipeline_config:
-            #     if step == 'enhance':
-            #         frame = self.enhance_frame(frame)
-            #     elif step == 'detect_motion':
-            #         self.detect_motion(frame)
-            #     elif step == 'recognize_faces':
-            #         self.recognize_faces(frame)
+                # for step in pipeline_config:
+                #     if step == 'enhance':
+                #         frame = self.enhance_frame(frame)
+                #     elif step == 'detect_motion':
+                #         self.detect_motion(frame)
+                #     elif step == 'recognize_faces':
+                #         self.recognize_faces(frame)
             
-            # Save processed frame with metadata
-            self.save_processed_frame(frame, frame_metadata, job_id, quality)
-            frame_number += 1
+                output_frame = results.get('enhance')
+                if output_frame is None:
+                    if 'enhance' in pipeline_config and (encode_session or derived_outputs):
+                        frame_log.warning(('no_enhanced_output', job_id, quality), "No enhanced output; using the source frame",
+                                          job_id=job_id, stage='enhance', quality=quality, frame=frame_number)
+                    output_frame = frame
+                with tracer.span('save', frame_context, quality=quality, frame_number=frame_number):
+                    if encode_session:
+                        encode_session.submit(frame_number, output_frame)
+                    if derived_outputs:
+                        self.emit_derived_rungs(output_frame, frame_metadata, derived_outputs)
+
+                    # Save processed frame with metadata
+                    if frame_metadata.get('save_frame_metadata', True):
+                        self.save_processed_frame(frame, frame_metadata, job_id, quality, save_image=encode_session is None)
+                frames_counter.inc()
+                frame_progress.update((job_id, quality), job_id=job_id, quality=quality)
+                frame_number += 1
+                checkpointer.advance(frame_number)
+            checkpointer.complete(frame_number)
+        finally:
+            frame_progress.finish((job_id, quality))
+            if job_stats is not None:
+                job_stats[quality] = {"frames": frame_number, "short_circuited": short_circuited}
+            if is_analysis_quality:
+                # Unblock the other rungs if this one stops early; they fall back to full detection
+                face_detections.finish()
 
     def create_frame_metadata(self, frame, frame_number, job_id, quality, video_metadata):
         height, width, _ = frame.shape
@@ -283,13 +838,15 @@ class ProcessorService:
         }
         return metadata
     
-    def save_processed_frame(self, frame, metadata, job_id, quality):
+    def save_processed_frame(self, frame, metadata, job_id, quality, save_image=True):
         output_folder = os.path.join(self.output_storage_path, f"processed_frames_{job_id}", f"quality_{quality}")
         os.makedirs(output_folder, exist_ok=True)
         
-        frame_filename = f"frame_{metadata['frame_number']:06d}.png"
-        frame_path = os.path.join(output_folder, frame_filename)
-        cv2.imwrite(frame_path, frame)
+        if save_image:
+            frame_filename = f"frame_{metadata['frame_number']:06d}.png"
+            frame_path = os.path.join(output_folder, frame_filename)
+            cv2.imwrite(frame_path, frame)
+            BYTES_WRITTEN.labels('processor', 'processed_frames').inc(os.path.getsize(frame_path))
         
         metadata_filename = f"frame_{metadata['frame_number']:06d}_metadata.json"
         metadata_path = os.path.join(output_folder, metadata_filename)
@@ -298,24 +855,77 @@ class ProcessorService:
 
 class DistributionManager:
     def __init__(self, num_enhancement_workers=5, num_recognition_workers=2):
-        # Create multiple service instances
-        self.enhancement_services = [EnhancementService() for _ in range(num_enhancement_workers)]
-        self.facial_recognition_services = [FacialRecognitionService() for _ in range(num_recognition_workers)]
+        # Pools are sized here but built on first use, so a replica whose jobs never ask for a stage
+        # never creates its services or threads
+        self.pool_sizes = {'enhance': num_enhancement_workers, 'recognize': num_recognition_workers}
+        self.started_pools = set()
+        self.pool_lock = threading.Lock()
+        self.temporal_states = TemporalStateRegistry()
+        self.enhancement_services = []
+        self.face_trackers = FaceTrackerRegistry()
+        self.facial_recognition_services = []
+        self.motion_service = MotionDetectionService(MotionDetectorRegistry())
         
         # Track service availability
-        self.enhancement_available = {i: True for i in range(num_enhancement_workers)}
-        self.recognition_available = {i: True for i in range(num_recognition_workers)}
+        self.enhancement_available = {}
+        self.recognition_available = {}
         
         # Locks for thread safety
         self.enhancement_lock = threading.Lock()
         self.recognition_lock = threading.Lock()
-        
-        self.start_services()
 
-    def start_services(self):
-        # Start all service instances
-        for service in self.enhancement_services + self.facial_recognition_services:
-            threading.Thread(target=service.start, daemon=True).start() 
+        WORKERS.labels('enhance').set_function(lambda: len(self.enhancement_services))
+        WORKERS.labels('recognize').set_function(lambda: len(self.facial_recognition_services))
+        WORKERS_BUSY.labels('enhance').set_function(lambda: sum(not a for a in self.enhancement_available.values()))
+        WORKERS_BUSY.labels('recognize').set_function(lambda: sum(not a for a in self.recognition_available.values()))
+        self.stage_latency = {stage: STAGE_LATENCY.labels(stage) for stage in ('enhance', 'recognize', 'detect_motion')}
+        self.busy_seconds = {pool: WORKER_BUSY_SECONDS.labels(pool) for pool in ('enhance', 'recognize')}
+
+    def ensure_pools(self, pipeline_config):
+        pools = {STAGE_POOLS[step] for step in pipeline_config if step in STAGE_POOLS}
+        if pools <= self.started_pools:
+            return
+        with self.pool_lock:
+            for pool in sorted(pools - self.started_pools):
+                self.start_pool(pool)
+
+    def start_pool(self, pool):
+        start = time.perf_counter()
+        size = self.pool_sizes[pool]
+        if pool == 'enhance':
+            services = [EnhancementService(temporal_states=self.temporal_states) for _ in range(size)]
+            service_list, available, lock = self.enhancement_services, self.enhancement_available, self.enhancement_lock
+        else:
+            services = [FacialRecognitionService(trackers=self.face_trackers) for _ in range(size)]
+            service_list, available, lock = self.facial_recognition_services, self.recognition_available, self.recognition_lock
+        # Named so stack samples from /debug/profile show which pool a worker belongs to
+        for idx, service in enumerate(services):
+            threading.Thread(target=service.start, daemon=True, name=f'{pool}-{idx}').start()
+        # Workers are listed before they are marked available, so get_available_service never sees a half-built pool
+        with lock:
+            service_list.extend(services)
+            available.update({idx: True for idx in range(len(services))})
+        self.started_pools.add(pool)
+        logger.info(f"Started the {pool} pool with {size} workers in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    def warm_up(self, pipeline_config, face_detector=None):
+        # Starts the pools a pipeline needs and builds their models ahead of the first frame; returns ms per step
+        timings = {}
+        for step in pipeline_config:
+            start = time.perf_counter()
+            self.ensure_pools([step])
+            if step == 'recognize_faces':
+                for service in self.facial_recognition_services:
+                    service.warm_up(face_detector)
+            timings[step] = round((time.perf_counter() - start) * 1000, 1)
+        logger.info(f"Warmed up {list(pipeline_config)}: {timings}")
+        return timings
+
+    def end_job(self, job_id):
+        # Drop per-stream state the stage services kept for this job
+        self.temporal_states.discard_job(job_id)
+        self.face_trackers.discard_job(job_id)
+        self.motion_service.discard_job(job_id)
 
     def get_available_service(self, services_dict, services_list, lock):
         with lock:
@@ -329,9 +939,33 @@ class DistributionManager:
         with lock:
             service_dict[service_idx] = True
     
-    def distribute_frame(self, frame, metadata, pipeline_config):
+    def distribute_frame(self, frame, metadata, pipeline_config, trace_context=None):
+        self.ensure_pools(pipeline_config)
         results = {}
         futures = []
+        motion = None
+        gated_faces = None
+        if 'detect_motion' in pipeline_config:
+            # Motion runs first, inline, so it can switch off or narrow face recognition for this frame
+            with self.stage_latency['detect_motion'].time(), tracer.span('detect_motion', trace_context), \
+                    STAGE_PROFILER.profile('detect_motion'):
+                motion = self.motion_service.detect(frame, metadata)
+            results['motion'] = motion
+            metadata['motion_score'] = motion['score']
+            metadata['motion_regions'] = motion['regions']
+            if 'recognize_faces' in pipeline_config:
+                gated_faces = self.motion_service.gate(metadata, motion)
+                if gated_faces is not None:
+                    frame_log.info(('motion_skip', metadata['job_id'], metadata['quality']), "No motion; skipping facial recognition",
+                                   job_id=metadata['job_id'], stage='recognize', quality=metadata['quality'],
+                                   frame=metadata['frame_number'])
+                    results['recognize'] = gated_faces
+                    # Recognition would have written this frame's annotated output; write it from the reused boxes
+                    if metadata.get('save_annotated_frames', True):
+                        save_annotated_frame(frame.copy(), gated_faces, metadata)
+                elif metadata.get('motion_gate') == 'roi':
+                    metadata['motion_regions'] = self.motion_service.search_regions(
+                        metadata, motion, frame.shape[1], frame.shape[0])
         
         with concurrent.futures.ThreadPoolExecutor() as executor:
             if 'enhance' in pipeline_config:
@@ -342,15 +976,15 @@ class DistributionManager:
                         self.enhancement_lock
                     )
                     if service:
-                            logger.info(f"Processing frame {metadata['frame_number']} through enhancement service {idx}")
-                            future = executor.submit(self._process_enhancement, frame, metadata, service, idx)
+                            future = executor.submit(self._process_enhancement, frame, metadata, service, idx, trace_context)
                             futures.append(('enhance', future, idx))
                             break
                     else:
-                        logger.info(f"Waiting for available enhancement service for frame {metadata['frame_number']}")
+                        frame_log.info('wait_enhance', "Waiting for an available enhancement service",
+                                       job_id=metadata['job_id'], stage='enhance', frame=metadata['frame_number'])
                         time.sleep(0.1)  # Wait for 100ms before trying again
             
-            if 'recognize_faces' in pipeline_config:
+            if 'recognize_faces' in pipeline_config and gated_faces is None:
                 while True:
                     idx, service = self.get_available_service(
                         self.recognition_available,
@@ -358,12 +992,12 @@ class DistributionManager:
                         self.recognition_lock
                     )
                     if service:
-                        logger.info(f"Processing frame {metadata['frame_number']} through facial recognition service {idx}")
-                        future = executor.submit(self._process_recognition, frame, metadata, service, idx)
+                        future = executor.submit(self._process_recognition, frame, metadata, service, idx, trace_context)
                         futures.append(('recognize', future, idx))
                         break 
                     else:
-                        logger.info(f"Waiting for available recognition service for frame {metadata['frame_number']}")
+                        frame_log.info('wait_recognize', "Waiting for an available recognition service",
+                                       job_id=metadata['job_id'], stage='recognize', frame=metadata['frame_number'])
                         time.sleep(0.1)  # Wait for 100ms before trying again
             
             # Collect results
@@ -381,6 +1015,9 @@ class DistributionManager:
                     logger.error(f"{task_type} processing timed out")
                 except Exception as e:
                     logger.error(f"Error processing {task_type}: {str(e)}")
+
+        if motion is not None and metadata.get('motion_gate') and gated_faces is None and results.get('recognize') is not None:
+            results['recognize'] = self.motion_service.remember_faces(metadata, results['recognize'], metadata['motion_regions'])
                 
         return results
     # def distribute_frame(self, frame, metadata, pipeline_config):
@@ -407,17 +1044,34 @@ class DistributionManager:
         # for thread in threads:
         #     thread.join()
 
-    def _process_enhancement(self, frame, metadata, service, idx):
-        service.input_queue.put((frame.copy(), metadata))
-        processed_frame, result = service.output_queue.get()
+    def _run_on_service(self, stage, frame, metadata, service, trace_context=None):
+        start = time.perf_counter()
+        with tracer.span(stage, trace_context):
+            service.input_queue.put((frame.copy(), metadata))
+            processed_frame, result = service.output_queue.get()
+        elapsed = time.perf_counter() - start
+        self.stage_latency[stage].observe(elapsed)
+        self.busy_seconds[stage].inc(elapsed)
         return result
+
+    def _process_enhancement(self, frame, metadata, service, idx, trace_context=None):
+        return self._run_on_service('enhance', frame, metadata, service, trace_context)
     
-    def _process_recognition(self, frame, metadata, service, idx):
-        service.input_queue.put((frame.copy(), metadata))
-        processed_frame, result = service.output_queue.get()
-        return result
+    def _process_recognition(self, frame, metadata, service, idx, trace_context=None):
+        return self._run_on_service('recognize', frame, metadata, service, trace_context)
     
-processor_service = ProcessorService(FRAMES_PATH, OUTPUT_PATH)
+_processor_service = None
+_processor_service_lock = threading.Lock()
+# Set by the entry point once jobs are resumed and any PIPELINE_WARMUP stages are up
+startup_complete = threading.Event()
+
+def get_processor_service():
+    # Built on first use instead of at import, so importing this module starts no threads and opens no stores
+    global _processor_service
+    with _processor_service_lock:
+        if _processor_service is None:
+            _processor_service = ProcessorService(FRAMES_PATH, OUTPUT_PATH)
+        return _processor_service
 
 @app.route('/process', methods=['POST'])
 def process_video():
@@ -437,15 +1091,73 @@ def process_video():
         metadata=data.get('metadata'),
         quality_levels=data.get('quality_levels', ['1280x720']),
         priority=data.get('priority', 'normal'),
-        pipeline_config=data.get('pipeline_config', ['enhance'])
+        pipeline_config=data.get('pipeline_config', ['enhance']),
+        processing_options=data.get('processing_options') or {},
+        trace=data.get('trace')
     )
-    processor_service.job_queue.add_job(job)
+    processor_service = get_processor_service()
+    processor_service.submit_job(job)
     return jsonify({
         "message": "Video job queued",
         "job_id": job.job_id,
         "position": processor_service.job_queue.job_queue.qsize()
     }), 200
 
+@app.route('/thread_budget', methods=['GET'])
+def thread_budget():
+    return jsonify(get_processor_service().thread_budget.as_dict()), 200
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    # Readiness only: the replica can take jobs. Pools that were not warmed up start with their first frame
+    pools = sorted(_processor_service.distribution_manager.started_pools) if _processor_service else []
+    status = {"ready": startup_complete.is_set(), "pools": pools}
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/warmup', methods=['POST'])
+def warmup():
+    data = request.json or {}
+    pipeline_config = data.get('pipeline_config') or list(STAGE_POOLS)
+    unknown = [step for step in pipeline_config if step not in PIPELINE_STAGES]
+    if unknown:
+        return jsonify({"error": f"Unknown pipeline steps: {unknown}"}), 400
+    try:
+        timings = get_processor_service().distribution_manager.warm_up(pipeline_config, data.get('face_detector'))
+    except (ValueError, FileNotFoundError, ImportError) as e:
+        return jsonify({"error": f"Warm-up failed: {e}"}), 500
+    return jsonify({"warmed_ms": timings, "pools": sorted(get_processor_service().distribution_manager.started_pools)}), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype=CONTENT_TYPE)
+
+register_profiling_routes(app, 'processor')
+
+@app.route('/shards/<job_id>', methods=['GET'])
+def shard_status(job_id):
+    processor_service = get_processor_service()
+    if processor_service.shard_coordinator is None:
+        return jsonify({"error": "Sharding is not enabled on this replica"}), 404
+    status = processor_service.shard_coordinator.job_status(job_id)
+    if status is None:
+        return jsonify({"error": f"Job {job_id} was not sharded"}), 404
+    return jsonify(status), 200
+
+def start_up():
+    processor_service = get_processor_service()
+    if SHARDING_ENABLED:
+        processor_service.start_shard_workers(get_shard_coordinator())
+    processor_service.resume_jobs()
+    if WARMUP_PIPELINE:
+        try:
+            processor_service.distribution_manager.warm_up(WARMUP_PIPELINE)
+        except Exception as e:
+            # A pool that cannot warm up still gets its chance when a job needs it
+            logger.error(f"Warm-up of {WARMUP_PIPELINE} failed: {str(e)}")
+    startup_complete.set()
+
 if __name__ == "__main__":
     # processor_service.authenticate_google_drive()
-    app.run(host='0.0.0.0', port=5001)
\ No newline at end of file
+    # The server answers /ready with 503 while start-up runs, instead of not answering at all
+    threading.Thread(target=start_up, daemon=True, name='startup').start()
+    app.run(host='0.0.0.0', port=PORT)
\ No newline at end of file